@@ -1,13 +1,25 @@
+import json
 import logging
 
 import click
 from ckan.plugins import toolkit
+from ckanext.sitesearch import db
+from ckanext.sitesearch.lib import failures as lib_failures
+from ckanext.sitesearch.lib import loadtest as lib_loadtest
+from ckanext.sitesearch.lib import outbox as lib_outbox
+from ckanext.sitesearch.lib import snapshot as lib_snapshot
+from ckanext.sitesearch.lib import stats as lib_stats
+from ckanext.sitesearch.lib import warmup as lib_warmup
 from ckanext.sitesearch.lib.rebuild import (
+    DEFAULT_CHECKPOINT_EVERY,
+    commit_all,
+    parse_shard,
     rebuild_datasets,
     rebuild_groups,
     rebuild_orgs,
     rebuild_pages,
     rebuild_users,
+    retry_failures,
 )
 
 log = logging.getLogger(__name__)
@@ -23,6 +35,23 @@ def sitesearch():
     pass
 
 
+@sitesearch.command("init")
+def init():
+    """Create the database tables used by the extension"""
+
+    db.init_db()
+    click.echo("sitesearch tables created")
+
+
+def _parse_shard(ctx, param, value):
+    if value is None:
+        return None
+    try:
+        return parse_shard(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+
 @sitesearch.command("rebuild")
 @click.argument("entity_type")
 @click.argument("entity_id", required=False)
@@ -41,21 +70,470 @@ def sitesearch():
 @click.option(
     "-q", "--quiet", help="Do not output index rebuild progress", is_flag=True
 )
-def rebuild(entity_type, commit_each, force, quiet, entity_id=None):
+@click.option(
+    "-r",
+    "--resume",
+    is_flag=True,
+    help="Continue from the last checkpoint of a previous rebuild that did not"
+    " complete. Not supported for datasets.",
+)
+@click.option(
+    "--checkpoint-every",
+    type=int,
+    default=DEFAULT_CHECKPOINT_EVERY,
+    show_default=True,
+    help="Commit the changes and store a checkpoint after indexing this number"
+    " of entities.",
+)
+@click.option(
+    "-w",
+    "--workers",
+    type=int,
+    default=1,
+    show_default=True,
+    help="Number of processes used to index the datasets. Only supported for"
+    " datasets.",
+)
+@click.option(
+    "-s",
+    "--shard",
+    callback=_parse_shard,
+    help="Only index the entities in this shard, defined as `i/n` (eg `2/4`)."
+    " Entities are split deterministically by id, so each of n hosts can"
+    " rebuild a different shard. The last changes are not committed, run"
+    " `ckan sitesearch commit` once all shards finish.",
+)
+@click.option(
+    "--warmup",
+    is_flag=True,
+    help="Replay the most frequent queries in the query log once finished,"
+    " see `ckan sitesearch warmup`.",
+)
+def rebuild(
+    entity_type,
+    commit_each,
+    force,
+    quiet,
+    resume,
+    checkpoint_every,
+    workers,
+    shard,
+    warmup,
+    entity_id=None,
+):
     """Re-index all entitities of a particular type"""
 
     defer_commit = not commit_each
+    kwargs = {"resume": resume, "checkpoint_every": checkpoint_every, "shard": shard}
+    is_datasets = entity_type in ("dataset", "datasets", "package", "packages")
+
+    if workers > 1 and not is_datasets:
+        toolkit.error_shout("Multiple workers are only supported for datasets")
+        raise click.Abort()
+
+    if shard and entity_id:
+        toolkit.error_shout("Shards can't be used when indexing a single entity")
+        raise click.Abort()
 
     if entity_type in ("orgs", "org", "organizations", "organisations"):
-        rebuild_orgs(defer_commit, force, quiet, entity_id)
+        rebuild_orgs(defer_commit, force, quiet, entity_id, **kwargs)
     elif entity_type in ("groups", "group"):
-        rebuild_groups(defer_commit, force, quiet, entity_id)
+        rebuild_groups(defer_commit, force, quiet, entity_id, **kwargs)
     elif entity_type in ("users", "user"):
-        rebuild_users(defer_commit, force, quiet, entity_id)
+        rebuild_users(defer_commit, force, quiet, entity_id, **kwargs)
     elif entity_type in ("pages", "page"):
-        rebuild_pages(defer_commit, force, quiet, entity_id)
-    elif entity_type in ("dataset", "datasets", "package", "packages"):
-        rebuild_datasets(defer_commit, force, quiet, entity_id)
+        rebuild_pages(defer_commit, force, quiet, entity_id, **kwargs)
+    elif is_datasets:
+        rebuild_datasets(
+            defer_commit, force, quiet, entity_id, workers=workers, **kwargs
+        )
     else:
         toolkit.error_shout("Unknown entity type: {}".format(entity_type))
         raise click.Abort()
+
+    if shard:
+        click.echo(
+            "\nShard {}/{} indexed, run `ckan sitesearch commit` once all shards"
+            " finish".format(*shard)
+        )
+    elif warmup:
+        _warmup(lib_warmup.DEFAULT_LIMIT, None, quiet=True)
+
+
+def _warmup(limit, path, quiet):
+    try:
+        replayed, failed = lib_warmup.warmup(limit, path, quiet)
+    except ValueError as e:
+        toolkit.error_shout(str(e))
+        raise click.Abort()
+    click.echo("{} queries replayed, {} failed".format(replayed, failed))
+
+
+@sitesearch.command("commit")
+@click.option(
+    "--warmup",
+    is_flag=True,
+    help="Replay the most frequent queries in the query log after committing,"
+    " see `ckan sitesearch warmup`.",
+)
+def commit(warmup):
+    """Commit the pending changes to the search index"""
+
+    commit_all()
+    click.echo("Changes committed")
+    if warmup:
+        _warmup(lib_warmup.DEFAULT_LIMIT, None, quiet=True)
+
+
+@sitesearch.command("warmup")
+@click.option(
+    "-n",
+    "--top",
+    type=int,
+    default=lib_warmup.DEFAULT_LIMIT,
+    show_default=True,
+    help="Number of queries to replay, the most frequent first",
+)
+@click.option(
+    "-f",
+    "--file",
+    "path",
+    type=click.Path(dir_okay=False),
+    help="Query log to read (default: ckanext.sitesearch.query_log.file)",
+)
+@click.option(
+    "--solr-config",
+    is_flag=True,
+    help="Don't replay the queries, output a `newSearcher` listener for"
+    " solrconfig.xml that runs them whenever a new searcher is opened",
+)
+@click.option("-q", "--quiet", help="Do not output the queries", is_flag=True)
+def warmup(top, path, solr_config, quiet):
+    """Replay the most frequent queries in the sampled query log"""
+
+    if solr_config:
+        try:
+            click.echo(lib_warmup.solr_warming_config(top, path))
+        except ValueError as e:
+            toolkit.error_shout(str(e))
+            raise click.Abort()
+        return
+
+    _warmup(top, path, quiet)
+
+
+@sitesearch.command("stats")
+@click.option("--json", "as_json", is_flag=True, help="Output the stats as JSON")
+@click.option(
+    "--no-sizes",
+    is_flag=True,
+    help="Don't compute the size of the stored documents, which requires reading"
+    " all of them",
+)
+@click.option(
+    "-n",
+    "--largest",
+    type=int,
+    default=lib_stats.DEFAULT_LARGEST,
+    show_default=True,
+    help="Number of largest documents to show",
+)
+def stats(as_json, no_sizes, largest):
+    """Show the number and size of the documents of each entity type"""
+
+    data = lib_stats.get_stats(sizes=not no_sizes, largest=largest)
+
+    if as_json:
+        click.echo(json.dumps(data, indent=2, sort_keys=True))
+        return
+
+    click.echo("Site: {site_id} (backend: {backend})\n".format(**data))
+    row = "{:<14} {:>10} {:>10} {:>8} {:>10} {:>10} {:>10}"
+    click.echo(
+        row.format(
+            "entity_type", "indexed", "db", "diff", "avg size", "p95 size", "avg dict"
+        )
+    )
+    for entity_type, item in data["entity_types"].items():
+        click.echo(
+            row.format(
+                entity_type,
+                item["indexed"],
+                "-" if item["db"] is None else item["db"],
+                "-" if item["diff"] is None else "{:+d}".format(item["diff"]),
+                "{:.0f}".format(item["avg_size"]) if "avg_size" in item else "-",
+                item.get("p95_size", "-"),
+                (
+                    "{:.0f}".format(item["avg_data_dict_size"])
+                    if "avg_data_dict_size" in item
+                    else "-"
+                ),
+            )
+        )
+
+    if data["largest"]:
+        click.echo("\nLargest documents (bytes):")
+        for doc in data["largest"]:
+            click.echo("{size:>10} {entity_type} {name} ({id})".format(**doc))
+
+    click.echo("\nDocuments per site:")
+    for site_id, count in sorted(data["sites"].items()):
+        click.echo("{:>10} {}".format(count, site_id))
+
+    if data["index"]:
+        click.echo("\nIndex:")
+        for key, value in sorted(data["index"].items()):
+            click.echo("{}: {}".format(key, value))
+
+
+def _parse_mix(ctx, param, value):
+    if value is None:
+        return None
+    try:
+        return lib_loadtest.parse_mix(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+
+@sitesearch.command("loadtest")
+@click.option(
+    "-n",
+    "--requests",
+    "count",
+    type=int,
+    default=lib_loadtest.DEFAULT_REQUESTS,
+    show_default=True,
+    help="Number of search calls to make",
+)
+@click.option(
+    "-c",
+    "--concurrency",
+    type=int,
+    default=lib_loadtest.DEFAULT_CONCURRENCY,
+    show_default=True,
+    help="Number of concurrent threads making calls",
+)
+@click.option(
+    "-m",
+    "--mix",
+    callback=_parse_mix,
+    help="Relative weight of each action in the generated calls, eg"
+    " `site_search=1,organization_search=3` (default: all search actions)",
+)
+@click.option(
+    "-f",
+    "--from-query-log",
+    "path",
+    type=click.Path(exists=True, dir_okay=False),
+    help="Replay the queries in this sampled query log instead of generating them",
+)
+@click.option(
+    "--seed", type=int, default=0, show_default=True, help="Seed for generated calls"
+)
+@click.option("-u", "--user", help="Make the calls as this user (default: site user)")
+@click.option("--json", "as_json", is_flag=True, help="Output the results as JSON")
+def loadtest(count, concurrency, mix, path, seed, user, as_json):
+    """Measure the throughput and latency of the search actions"""
+
+    if path:
+        calls = lib_loadtest.calls_from_query_log(path, count)
+    else:
+        calls = lib_loadtest.synthetic_calls(count, mix, seed)
+
+    report = lib_loadtest.run(calls, concurrency, user)
+
+    if as_json:
+        click.echo(json.dumps(report, indent=2, sort_keys=True))
+        return
+
+    click.echo(
+        "{requests} requests, concurrency {concurrency}, {duration:.2f}s\n"
+        "Throughput: {throughput:.1f} requests/s\n"
+        "Errors: {errors} ({error_rate:.2%})\n".format(**report)
+    )
+    row = "{:<20} {:>8} {:>8} {:>9} {:>9} {:>9} {:>9}"
+    click.echo(row.format("", "requests", "errors", "mean", "p50", "p95", "p99"))
+    items = list(report["actions"].items()) + [("all", report)]
+    for name, item in items:
+        latency = [
+            "{:.2f}".format(item["latency"][key])
+            for key in ("mean", "p50", "p95", "p99")
+        ]
+        click.echo(row.format(name, item["requests"], item["errors"], *latency))
+    click.echo("(latencies in ms)")
+    for error_type, error_count in sorted(report["error_types"].items()):
+        click.echo("{:>8} {}".format(error_count, error_type))
+
+
+@sitesearch.command("snapshot")
+@click.argument("path", type=click.Path(dir_okay=False, writable=True))
+@click.option(
+    "-t",
+    "--entity-type",
+    type=click.Choice(["organization", "group", "user", "page"]),
+    help="Only write documents of this entity type",
+)
+@click.option(
+    "-b",
+    "--batch-size",
+    type=int,
+    default=lib_snapshot.DEFAULT_BATCH_SIZE,
+    show_default=True,
+    help="Number of documents requested to the search backend at a time",
+)
+@click.option("-q", "--quiet", help="Do not output progress", is_flag=True)
+def snapshot(path, entity_type, batch_size, quiet):
+    """Write the sitesearch documents to a gzipped NDJSON file"""
+
+    count = lib_snapshot.snapshot(path, entity_type, batch_size, quiet)
+    click.echo("\n{} documents written to {}".format(count, path))
+
+
+@sitesearch.command("restore")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    "-b",
+    "--batch-size",
+    type=int,
+    default=lib_snapshot.DEFAULT_BATCH_SIZE,
+    show_default=True,
+    help="Number of documents sent to the search backend in each update",
+)
+@click.option("-q", "--quiet", help="Do not output progress", is_flag=True)
+def restore(path, batch_size, quiet):
+    """Load the documents from a file created with `snapshot`"""
+
+    restored, failed = lib_snapshot.restore(path, batch_size, quiet)
+    click.echo("\n{} documents restored, {} failed".format(restored, failed))
+    if failed:
+        raise click.Abort()
+
+
+@sitesearch.group()
+def failures():
+    """Entities that could not be indexed."""
+    pass
+
+
+def _entity_type_option(func):
+    return click.option(
+        "-t",
+        "--entity-type",
+        type=click.Choice(["organization", "group", "user", "page", "dataset"]),
+        help="Only consider this entity type",
+    )(func)
+
+
+@failures.command("list")
+@_entity_type_option
+@click.option("-a", "--all", "include_resolved", is_flag=True, help="Include resolved")
+@click.option(
+    "-s",
+    "--stats",
+    is_flag=True,
+    help="Show the number of failures per day and entity type instead",
+)
+@click.option(
+    "--days", type=int, default=30, show_default=True, help="Days to show in --stats"
+)
+def failures_list(entity_type, include_resolved, stats, days):
+    """List the entities that failed to be indexed"""
+
+    if stats:
+        rows = lib_failures.get_failure_stats(days, entity_type)
+        click.echo(
+            "{:<12} {:<14} {:>10} {:>10}".format(
+                "day", "entity_type", "failures", "resolved"
+            )
+        )
+        for day, row_entity_type, count, resolved in rows:
+            click.echo(
+                "{:<12} {:<14} {:>10} {:>10}".format(
+                    str(day), row_entity_type, count, resolved
+                )
+            )
+        return
+
+    items = lib_failures.get_failures(entity_type, include_resolved)
+    for item in items:
+        item["resolved"] = " (resolved)" if item["resolved"] else ""
+        click.echo(
+            "{entity_type} {entity_id} [{operation}] attempts: {attempts}, "
+            "last: {last_failed:%Y-%m-%d %H:%M:%S}{resolved} - "
+            "{error_class}: {message}".format(**item)
+        )
+    click.echo("{} failed entities".format(len(items)))
+
+
+@failures.command("retry")
+@_entity_type_option
+@click.option("-q", "--quiet", help="Do not output progress", is_flag=True)
+def failures_retry(entity_type, quiet):
+    """Try to index again the entities that failed"""
+
+    succeeded, failed = retry_failures(entity_type, quiet)
+    click.echo("\n{} entities indexed, {} failed again".format(succeeded, failed))
+    if failed:
+        raise click.Abort()
+
+
+@failures.command("purge")
+@_entity_type_option
+@click.option(
+    "-r", "--resolved", "resolved_only", is_flag=True, help="Only purge resolved"
+)
+@click.option(
+    "--older-than",
+    type=int,
+    help="Only purge failures older than this number of days",
+)
+def failures_purge(entity_type, resolved_only, older_than):
+    """Delete the failure records"""
+
+    deleted = lib_failures.purge(entity_type, resolved_only, older_than)
+    click.echo("{} failure records deleted".format(deleted))
+
+
+@sitesearch.group()
+def outbox():
+    """Index updates stored in the outbox."""
+    pass
+
+
+@outbox.command("relay")
+@click.option(
+    "-b",
+    "--batch-size",
+    type=int,
+    default=lib_outbox.DEFAULT_BATCH_SIZE,
+    show_default=True,
+    help="Number of outbox rows processed in each update",
+)
+@click.option(
+    "-d",
+    "--daemon",
+    is_flag=True,
+    help="Keep running, checking the outbox for new rows every --interval seconds",
+)
+@click.option(
+    "--interval",
+    type=int,
+    default=lib_outbox.DEFAULT_RELAY_INTERVAL,
+    show_default=True,
+    help="Seconds to wait when the outbox is empty in --daemon mode",
+)
+def outbox_relay(batch_size, daemon, interval):
+    """Index the entities stored in the outbox"""
+
+    if daemon:
+        lib_outbox.relay_forever(batch_size, interval)
+    else:
+        processed = lib_outbox.relay(batch_size)
+        click.echo("{} outbox rows processed".format(processed))
+
+
+@outbox.command("status")
+def outbox_status():
+    """Show the number of rows pending in the outbox"""
+
+    click.echo("{} rows pending".format(lib_outbox.pending_count()))
@@ -0,0 +1,100 @@
+import datetime
+import logging
+
+from sqlalchemy import Column, Index, MetaData, Table, types
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB, TSVECTOR
+
+from ckan import model
+
+
+log = logging.getLogger(__name__)
+
+metadata = MetaData()
+
+
+document_table = Table(
+    "sitesearch_document",
+    metadata,
+    Column("index_id", types.UnicodeText, primary_key=True),
+    Column("id", types.UnicodeText, nullable=False),
+    Column("name", types.UnicodeText),
+    Column("entity_type", types.UnicodeText, nullable=False),
+    Column("site_id", types.UnicodeText, nullable=False),
+    Column("permission_labels", ARRAY(types.UnicodeText)),
+    Column("data", JSONB, nullable=False),
+    Column("search_vector", TSVECTOR),
+    Index("idx_sitesearch_document_entity_type_site_id", "entity_type", "site_id"),
+    Index(
+        "idx_sitesearch_document_search_vector",
+        "search_vector",
+        postgresql_using="gin",
+    ),
+    Index(
+        "idx_sitesearch_document_permission_labels",
+        "permission_labels",
+        postgresql_using="gin",
+    ),
+)
+
+
+failure_table = Table(
+    "sitesearch_failure",
+    metadata,
+    Column("id", types.Integer, primary_key=True),
+    Column("entity_type", types.UnicodeText, nullable=False),
+    Column("entity_id", types.UnicodeText, nullable=False),
+    Column("site_id", types.UnicodeText, nullable=False),
+    Column("operation", types.UnicodeText, nullable=False, default="index"),
+    Column("error_class", types.UnicodeText),
+    Column("message", types.UnicodeText),
+    Column("attempt", types.Integer, nullable=False, default=1),
+    Column("created", types.DateTime, default=datetime.datetime.utcnow),
+    Column("resolved", types.Boolean, nullable=False, default=False),
+    Index("idx_sitesearch_failure_entity", "entity_type", "entity_id", "site_id"),
+    Index("idx_sitesearch_failure_created", "created"),
+)
+
+
+outbox_table = Table(
+    "sitesearch_outbox",
+    metadata,
+    Column("id", types.BigInteger, primary_key=True),
+    Column("entity_type", types.UnicodeText, nullable=False),
+    Column("entity_id", types.UnicodeText, nullable=False),
+    Column("site_id", types.UnicodeText, nullable=False),
+    Column("operation", types.UnicodeText, nullable=False, default="index"),
+    Column("created", types.DateTime, default=datetime.datetime.utcnow),
+    # Set while a relay is processing the row
+    Column("claimed", types.DateTime),
+    Index("idx_sitesearch_outbox_site_id_id", "site_id", "id"),
+)
+
+
+_checked_tables = set()
+
+
+def init_db():
+    """Create the tables used by the extension, if they don't exist yet
+
+    Run by the `ckan sitesearch init` command, so no DDL is run while
+    serving requests.
+    """
+    metadata.create_all(model.meta.engine, checkfirst=True)
+    log.debug("sitesearch tables created")
+
+
+def check_table(table):
+    """Raise an error if `table` doesn't exist in the database
+
+    Only checked the first time in each process.
+    """
+    if table.name in _checked_tables:
+        return
+    with model.meta.engine.connect() as conn:
+        exists = model.meta.engine.dialect.has_table(conn, table.name)
+    if not exists:
+        raise RuntimeError(
+            "The {} table does not exist, run `ckan sitesearch init` to "
+            "create it".format(table.name)
+        )
+    _checked_tables.add(table.name)
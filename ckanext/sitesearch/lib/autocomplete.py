@@ -0,0 +1,391 @@
+"""
+In-process prefix index for the autocomplete action
+
+The names and titles of all organizations, groups, users and pages are
+kept in memory in a sorted list of normalised keys (the full name, the
+full title and each word of the title), so prefix lookups are a binary
+search followed by a scan of the matching keys, without querying the
+search backend.
+
+The prefix index is built from the documents stored in the search backend
+(only fetching the fields it needs) the first time it is used in each
+process, or when the process starts if
+`ckanext.sitesearch.autocomplete.build_on_startup` is enabled. It is
+updated when documents are indexed or deleted in the same process (writes
+with a deferred commit are applied once committed), and rebuilt when the
+index generation changes (see `lib/generation.py`) to include the changes
+committed by other processes. Generations started by the writes of the
+process itself don't need a rebuild.
+
+The generation is read from Redis at most every
+`ckanext.sitesearch.autocomplete.refresh_interval` seconds, and the prefix
+index is rebuilt in a background thread, so lookups keep using the
+previous one meanwhile. If the generation can't be read, the prefix index
+is rebuilt every `ckanext.sitesearch.autocomplete.ttl` seconds instead.
+"""
+import bisect
+import logging
+import re
+import threading
+import time
+import unicodedata
+
+from ckan import model
+from ckan.plugins import plugin_loaded, toolkit
+
+from ckanext.sitesearch.lib.backends import get_backend
+from ckanext.sitesearch.lib.generation import get_generation
+
+
+log = logging.getLogger(__name__)
+
+DEFAULT_TTL = 300
+
+DEFAULT_REFRESH_INTERVAL = 10
+
+DEFAULT_LIMIT = 10
+
+SPLIT_RE = re.compile(r"[\W_]+", re.UNICODE)
+
+
+def normalize(value):
+    """Lowercase the value and remove accents and extra whitespace"""
+    if not value:
+        return ""
+    value = unicodedata.normalize("NFKD", value)
+    value = "".join(c for c in value if not unicodedata.combining(c))
+    return " ".join(value.lower().split())
+
+
+def _keys(entry):
+    keys = set()
+    for value in (entry["name"], entry["title"]):
+        value = normalize(value)
+        if value:
+            keys.add(value)
+            keys.update(word for word in SPLIT_RE.split(value) if word)
+    return keys
+
+
+# Fields fetched from the search backend to build the prefix index
+FIELDS = ("id", "name", "title", "entity_type")
+
+
+def _entry(doc):
+    """Return the fields kept in the prefix index for a document"""
+    title = doc.get("title") or doc.get("display_name") or doc.get("fullname")
+    return {
+        "id": doc["id"],
+        "name": doc.get("name"),
+        "title": title,
+        "entity_type": doc["entity_type"],
+        "permission_labels": doc.get("permission_labels"),
+    }
+
+
+class PrefixIndex(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Sorted list of (key, entity_type, id) tuples
+        self._keys = []
+        # (entity_type, id) -> entry
+        self._entries = {}
+        # (entity_type, name) -> id, to delete entities by name
+        self._names = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def load(self, entries):
+        """Replace all the contents of the prefix index"""
+        keys, by_id, names = [], {}, {}
+        for entry in entries:
+            ref = (entry["entity_type"], entry["id"])
+            by_id[ref] = entry
+            if entry["name"]:
+                names[(entry["entity_type"], entry["name"])] = entry["id"]
+            keys.extend((key,) + ref for key in _keys(entry))
+        keys.sort()
+        with self._lock:
+            self._keys, self._entries, self._names = keys, by_id, names
+
+    def add(self, entry):
+        with self._lock:
+            self._remove(entry["entity_type"], entry["id"])
+            ref = (entry["entity_type"], entry["id"])
+            self._entries[ref] = entry
+            if entry["name"]:
+                self._names[(entry["entity_type"], entry["name"])] = entry["id"]
+            for key in _keys(entry):
+                bisect.insort(self._keys, (key,) + ref)
+
+    def remove(self, entity_type, id_or_name):
+        with self._lock:
+            entity_id = self._names.get((entity_type, id_or_name), id_or_name)
+            self._remove(entity_type, entity_id)
+
+    def _remove(self, entity_type, entity_id):
+        entry = self._entries.pop((entity_type, entity_id), None)
+        if not entry:
+            return
+        self._names.pop((entity_type, entry["name"]), None)
+        for key in _keys(entry):
+            item = (key, entity_type, entity_id)
+            i = bisect.bisect_left(self._keys, item)
+            if i < len(self._keys) and self._keys[i] == item:
+                del self._keys[i]
+
+    def lookup(self, prefix, entity_types=None, permission_labels=None, limit=10):
+        """Return the entries with a name or title word starting with `prefix`
+
+        Entries with permission labels (ie pages) are only returned if they
+        have one of `permission_labels`. Results are sorted by the matching
+        key.
+        """
+        prefix = normalize(prefix)
+        if not prefix or limit < 1:
+            return []
+        labels = set(permission_labels or [])
+        results, seen = [], set()
+        with self._lock:
+            i = bisect.bisect_left(self._keys, (prefix,))
+            while i < len(self._keys) and len(results) < limit:
+                key, entity_type, entity_id = self._keys[i]
+                i += 1
+                if not key.startswith(prefix):
+                    break
+                ref = (entity_type, entity_id)
+                if ref in seen:
+                    continue
+                seen.add(ref)
+                if entity_types and entity_type not in entity_types:
+                    continue
+                entry = self._entries[ref]
+                entry_labels = entry["permission_labels"]
+                if entry_labels is not None and labels.isdisjoint(entry_labels):
+                    continue
+                results.append(entry)
+        return [
+            {k: entry[k] for k in ("id", "name", "title", "entity_type")}
+            for entry in results
+        ]
+
+
+_index = None
+_loaded_at = None
+_loaded_generation = None
+_checked_at = None
+_load_lock = threading.Lock()
+# Writes with a deferred commit, applied when they are committed
+_pending = []
+_pending_lock = threading.Lock()
+# Whether there were deferred writes while there was no prefix index
+_missed_writes = False
+
+
+def _ttl():
+    return toolkit.asint(
+        toolkit.config.get("ckanext.sitesearch.autocomplete.ttl", DEFAULT_TTL)
+    )
+
+
+def _refresh_interval():
+    return toolkit.asint(
+        toolkit.config.get(
+            "ckanext.sitesearch.autocomplete.refresh_interval",
+            DEFAULT_REFRESH_INTERVAL,
+        )
+    )
+
+
+def _page_labels():
+    """Return the permission labels of each page, by id
+
+    Permission labels are not stored in the search index.
+    """
+    # Imported here to avoid a circular import, `index` updates the prefix index
+    from ckanext.pages.db import Page
+    from ckanext.sitesearch.lib.index import page_permission_labels
+
+    return {page.id: page_permission_labels(page) for page in Page.pages()}
+
+
+def build():
+    """Build a new prefix index with all the documents for this site"""
+    page_labels = _page_labels() if plugin_loaded("pages") else {}
+    entries = []
+    for doc in get_backend().iter_documents(
+        toolkit.config.get("ckan.site_id"), fields=FIELDS
+    ):
+        entry = _entry(doc)
+        if entry["entity_type"] == "page":
+            entry["permission_labels"] = page_labels.get(entry["id"], [])
+        entries.append(entry)
+    prefix_index = PrefixIndex()
+    prefix_index.load(entries)
+    log.debug("Built the autocomplete index with {} entities".format(len(entries)))
+    return prefix_index
+
+
+def _is_outdated(generation):
+    if _index is None:
+        return True
+    if generation is not None and generation != _loaded_generation:
+        return True
+    return time.monotonic() - _loaded_at > _ttl()
+
+
+def _load(generation):
+    """Build the prefix index, must be called holding `_load_lock`"""
+    global _index, _loaded_at, _loaded_generation
+
+    # The generation is read before building, so changes committed meanwhile
+    # are picked up by the next rebuild
+    prefix_index = build()
+    _index = prefix_index
+    _loaded_at = time.monotonic()
+    _loaded_generation = generation
+
+
+def _load_in_background(generation):
+    try:
+        _load(generation)
+    except Exception:
+        # Tried again after the refresh interval
+        log.exception("Could not rebuild the autocomplete index")
+    finally:
+        # The thread has its own database session
+        model.Session.remove()
+        _load_lock.release()
+
+
+def get_index():
+    """Return the prefix index, building it if missing or outdated
+
+    Only the first build blocks, outdated prefix indexes are rebuilt in the
+    background and used until the new one is ready.
+    """
+    global _checked_at
+
+    prefix_index = _index
+    if prefix_index is None:
+        with _load_lock:
+            if _index is None:
+                _checked_at = time.monotonic()
+                _load(get_generation())
+        return _index
+
+    now = time.monotonic()
+    if _checked_at is not None and now - _checked_at < _refresh_interval():
+        return prefix_index
+    _checked_at = now
+
+    generation = get_generation()
+    if _is_outdated(generation) and _load_lock.acquire(blocking=False):
+        try:
+            thread = threading.Thread(
+                target=_load_in_background, args=(generation,), daemon=True
+            )
+            thread.start()
+        except Exception:
+            _load_lock.release()
+            raise
+    return prefix_index
+
+
+def build_on_startup():
+    """Build the prefix index when the process starts
+
+    Called by the plugin if `ckanext.sitesearch.autocomplete.build_on_startup`
+    is enabled, so the first autocomplete requests don't wait for it.
+    """
+    try:
+        get_index()
+    except Exception:
+        # Built again when first used
+        log.exception("Could not build the autocomplete index")
+
+
+def reset():
+    """Discard the prefix index, it will be built again when next used"""
+    global _index, _checked_at, _missed_writes
+    _index = None
+    _checked_at = None
+    with _pending_lock:
+        del _pending[:]
+        _missed_writes = False
+
+
+def _apply(write):
+    global _index
+
+    prefix_index = _index
+    if prefix_index is None:
+        return
+    operation, args = write[0], write[1:]
+    if operation == "add":
+        for entry in args[0]:
+            prefix_index.add(entry)
+    elif operation == "remove":
+        prefix_index.remove(*args)
+    else:
+        # Built again when next used
+        _index = None
+
+
+def _write(committed, *write):
+    global _missed_writes
+
+    if committed:
+        _apply(write)
+        return
+    with _pending_lock:
+        if _index is None:
+            # A prefix index built before the commit would miss the changes
+            _missed_writes = True
+        else:
+            _pending.append(write)
+
+
+def update(docs, committed=True):
+    """Add or replace documents prepared by the indexers in `lib/index`"""
+    if _index is None and committed:
+        # Not used in this process yet
+        return
+    _write(committed, "add", [_entry(doc) for doc in docs])
+
+
+def remove(entity_type, id_or_name, committed=True):
+    _write(committed, "remove", entity_type, id_or_name)
+
+
+def clear(committed=True):
+    _write(committed, "clear")
+
+
+def committed(generations):
+    """Apply the pending writes, once changes to the index are committed
+
+    `generations` is the value returned by `bump_generation()` for the
+    commit. If this process started the new generation from the one the
+    prefix index was built from, it is up to date and doesn't need a
+    rebuild.
+    """
+    global _loaded_generation, _missed_writes
+
+    with _pending_lock:
+        pending = list(_pending)
+        missed = _missed_writes
+        del _pending[:]
+        _missed_writes = False
+    for write in pending:
+        _apply(write)
+
+    if generations and _index is not None and not missed:
+        previous, generation = generations
+        if previous == _loaded_generation:
+            _loaded_generation = generation
+
+
+def lookup(prefix, entity_types=None, permission_labels=None, limit=DEFAULT_LIMIT):
+    return get_index().lookup(prefix, entity_types, permission_labels, limit)
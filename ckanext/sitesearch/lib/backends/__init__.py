@@ -0,0 +1,30 @@
+import importlib
+
+from ckan.plugins import toolkit
+
+from ckanext.sitesearch.lib.backends.base import SearchBackend  # noqa
+
+
+DEFAULT_BACKEND = "solr"
+
+backends = {
+    "solr": "ckanext.sitesearch.lib.backends.solr:SolrBackend",
+    "postgres": "ckanext.sitesearch.lib.backends.postgres:PostgresBackend",
+}
+
+_instances = {}
+
+
+def get_backend():
+    """Return the search backend configured in `ckanext.sitesearch.backend`"""
+
+    name = toolkit.config.get("ckanext.sitesearch.backend", DEFAULT_BACKEND)
+    if name not in backends:
+        raise RuntimeError("Unknown sitesearch backend: {}".format(name))
+
+    if name not in _instances:
+        module_name, class_name = backends[name].split(":")
+        module = importlib.import_module(module_name)
+        _instances[name] = getattr(module, class_name)()
+
+    return _instances[name]
@@ -0,0 +1,121 @@
+import abc
+
+
+# Entity types that are indexed with permission labels
+LABELED_ENTITY_TYPES = ("page",)
+
+
+class SearchBackend(abc.ABC):
+    """
+    Storage and query operations for the sitesearch documents
+
+    Backends receive the documents already prepared by the indexers in
+    `lib/index` (ie with `index_id`, `site_id`, `entity_type`,
+    `validated_data_dict` etc) and must return search results with the
+    same structure that the Solr backend does::
+
+        {"count": <int>, "results": [<doc>, ...], "facets": {<field>: {<value>: <count>}}}
+
+    where each doc contains at least the `validated_data_dict` field.
+    Backends can also return the time spent by the search engine running
+    the query (in ms) in a `qtime` key, and set `partial_results` to True if
+    the search engine stopped collecting results before finishing (see
+    `lib/limits`).
+    """
+
+    name = None
+
+    # Whether written changes are visible to searches straight away, even
+    # if `commit` is False
+    commits_on_write = False
+
+    @abc.abstractmethod
+    def add(self, docs, commit=False):
+        """
+        Add or replace the provided documents in the index.
+
+        Documents are identified by their `index_id` field.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def delete(self, entity_type, entity_id, site_id, commit=False):
+        """
+        Remove the entity of the provided type matching `entity_id`, which
+        can be either its id or its name.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def clear(self, site_id, entity_type=None, keep_datasets=True, commit=False):
+        """
+        Remove all entities of a type (or of all types if `entity_type` is
+        None) for this site.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def commit(self):
+        """
+        Make any pending changes visible to searches.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def iter_documents(self, site_id, entity_type=None, batch_size=1000, fields=None):
+        """
+        Iterate over all the stored documents for this site (excluding
+        datasets), or only the ones of `entity_type`, in a stable order.
+
+        Documents should be fetched from the backend `batch_size` at a time.
+        If `fields` is provided, only those fields are fetched.
+        """
+        raise NotImplementedError
+
+    def count(self, query, entity_types, site_id=None, permission_labels=None):
+        """
+        Return the number of results of the query for each entity type, as
+        a dict.
+
+        `permission_labels` only apply to the entity types that are indexed
+        with labels (pages). By default a search with no rows is run for
+        each entity type, backends can do it in a single query.
+        """
+        counts = {}
+        for entity_type in entity_types:
+            type_query = dict(query, rows=0, facet="false")
+            type_query["fq_list"] = list(query.get("fq_list", []))
+            counts[entity_type] = self.search(
+                type_query,
+                entity_type=entity_type,
+                site_id=site_id,
+                permission_labels=(
+                    permission_labels if entity_type in LABELED_ENTITY_TYPES else None
+                ),
+            )["count"]
+        return counts
+
+    def index_info(self):
+        """
+        Return backend specific details about the whole index (eg its size
+        on disk or number of deleted documents) as a dict. Optional.
+        """
+        return {}
+
+    @abc.abstractmethod
+    def search(
+        self, query, entity_type=None, site_id=None, permission_labels=None, decode=None
+    ):
+        """
+        Run a query.
+
+        `query` is a dict of Solr-like parameters (`q`, `fq`, `fq_list`,
+        `sort`, `rows`, `start`, `facet.*`, etc) that has been already
+        validated. The other parameters are filters that must always be
+        applied on top of the ones provided in the query.
+
+        If `decode` is provided, the results are the values it returns for
+        each document. Backends should call it as each document is read, so
+        the raw documents don't need to be kept in memory.
+        """
+        raise NotImplementedError
@@ -0,0 +1,466 @@
+"""
+PostgreSQL full-text search backend
+
+Documents are stored in the `sitesearch_document` table (see
+`ckanext.sitesearch.db`), with a GIN-indexed `tsvector` column for free
+text searches. It supports a subset of the Solr query syntax, enough for
+the searches performed by this extension:
+
+* `q`: free text terms (combined with AND unless `OR` is used), quoted
+  phrases, trailing wildcards (`pea*`) and `field:value` clauses.
+* `fq` / `fq_list`: `field:value`, `field:"value"`, `field:(a OR b)` and
+  `field:prefix*` clauses, optionally prefixed with `+` or `-`.
+* `sort`: any field stored in the document, plus `score`.
+* `rows`, `start`, `fl` and the `facet`, `facet.field`, `facet.limit` and
+  `facet.mincount` parameters. Facet counts are computed with SQL
+  aggregations.
+"""
+import json
+import logging
+import re
+
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+
+from ckan import model
+from ckan.plugins import toolkit
+from ckan.lib.search.common import SearchError, SearchIndexError, SearchQueryError
+from ckan.lib.navl.dictization_functions import MissingNullEncoder
+
+from ckanext.sitesearch import db
+from ckanext.sitesearch.lib.backends.base import SearchBackend
+
+
+log = logging.getLogger(__name__)
+
+DEFAULT_TEXT_SEARCH_CONFIG = "english"
+
+DEFAULT_FACET_LIMIT = 100
+
+# Fields that are stored in their own column rather than in the `data` one
+COLUMN_FIELDS = ("id", "name", "entity_type", "site_id")
+
+# Fields that are added to the search vector
+TEXT_FIELDS = ("name", "title", "notes", "fullname")
+
+CLAUSE_RE = re.compile(r'([+-]?)([\w.]+):(\([^)]*\)|"[^"]*"|\S+)')
+
+SORT_RE = re.compile(r"^\s*([\w.]+)\s+(asc|desc)\s*$", re.IGNORECASE)
+
+
+class _Params(object):
+    """Collects bound parameters with unique names"""
+
+    def __init__(self):
+        self.values = {}
+
+    def add(self, value):
+        key = "p{}".format(len(self.values))
+        self.values[key] = value
+        return ":" + key
+
+
+def _text_search_config():
+    return toolkit.config.get(
+        "ckanext.sitesearch.postgres.text_search_config", DEFAULT_TEXT_SEARCH_CONFIG
+    )
+
+
+def _searchable_text(doc):
+    values = [doc.get(field) or "" for field in TEXT_FIELDS]
+    values.extend(
+        value for key, value in doc.items() if key.startswith("extras_") and value
+    )
+    return " ".join(str(v) for v in values)
+
+
+def _tsquery_term(term):
+    prefix = term.endswith("*")
+    words = re.findall(r"\w+", term)
+    if not words:
+        return None
+    lexemes = ["'{}'".format(w) for w in words]
+    if prefix:
+        lexemes[-1] += ":*"
+    if len(lexemes) == 1:
+        return lexemes[0]
+    return "({})".format(" <-> ".join(lexemes))
+
+
+def _to_tsquery(free_text):
+    """Translate free text terms to the `to_tsquery` syntax"""
+    expr = None
+    operator = "&"
+    for token in re.findall(r'"[^"]*"|\S+', free_text):
+        if token in ("OR", "||"):
+            operator = "|"
+            continue
+        if token in ("AND", "&&"):
+            continue
+        term = _tsquery_term(token)
+        if not term:
+            continue
+        expr = term if expr is None else "({}) {} {}".format(expr, operator, term)
+        operator = "&"
+    return expr
+
+
+def _value_condition(field, value, params):
+    if value == "*":
+        if field in COLUMN_FIELDS:
+            return "{} IS NOT NULL".format(field)
+        return "data ? {}".format(params.add(field))
+
+    prefix = value.endswith("*") and not value.endswith("\\*")
+    if prefix:
+        value = value[:-1]
+    value = value.replace("\\", "")
+
+    if field == "permission_labels":
+        if prefix:
+            raise SearchQueryError("Wildcards are not supported on permission_labels")
+        return "permission_labels @> CAST({} AS text[])".format(params.add([value]))
+
+    if field in COLUMN_FIELDS:
+        column = field
+    else:
+        column = "data->>{}".format(params.add(field))
+
+    if prefix:
+        pattern = (
+            value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        )
+        return "lower({}) LIKE lower({})".format(column, params.add(pattern))
+
+    condition = "lower({}) = lower({})".format(column, params.add(value))
+    if field not in COLUMN_FIELDS:
+        condition = "({} OR data->{} @> jsonb_build_array(CAST({} AS text)))".format(
+            condition, params.add(field), params.add(value)
+        )
+    return condition
+
+
+def _clause_condition(sign, field, value, params):
+    if value.startswith("(") and value.endswith(")"):
+        values = [
+            v.strip('"')
+            for v in re.findall(r'"[^"]*"|\S+', value[1:-1])
+            if v not in ("OR", "||")
+        ]
+        if not values:
+            raise SearchQueryError("Empty value list for field {}".format(field))
+        condition = "({})".format(
+            " OR ".join(_value_condition(field, v, params) for v in values)
+        )
+    else:
+        condition = _value_condition(field, value.strip('"'), params)
+
+    if sign == "-":
+        condition = "NOT ({})".format(condition)
+    return condition
+
+
+def _parse_clauses(query_string):
+    """Split a query string into its `field:value` clauses and the rest"""
+    clauses = CLAUSE_RE.findall(query_string)
+    rest = CLAUSE_RE.sub(" ", query_string)
+    return clauses, rest
+
+
+class PostgresBackend(SearchBackend):
+    """
+    Stores the sitesearch documents in a table in the CKAN database.
+    """
+
+    name = "postgres"
+
+    commits_on_write = True
+
+    def __init__(self):
+        # Created with `ckan sitesearch init`
+        db.check_table(db.document_table)
+
+    def _execute(self, sql, params=None):
+        try:
+            with model.meta.engine.begin() as conn:
+                conn.execute(text(sql), params or {})
+        except SQLAlchemyError as e:
+            log.exception(e)
+            raise SearchIndexError(e)
+
+    def add(self, docs, commit=False):
+
+        config = _text_search_config()
+        rows = [
+            {
+                "index_id": doc["index_id"],
+                "id": doc["id"],
+                "name": doc.get("name"),
+                "entity_type": doc["entity_type"],
+                "site_id": doc["site_id"],
+                "permission_labels": doc.get("permission_labels"),
+                "data": json.dumps(doc, cls=MissingNullEncoder),
+                "config": config,
+                "text": _searchable_text(doc),
+            }
+            for doc in docs
+        ]
+        if not rows:
+            return
+
+        self._execute(
+            """
+            INSERT INTO sitesearch_document
+                (index_id, id, name, entity_type, site_id, permission_labels,
+                 data, search_vector)
+            VALUES
+                (:index_id, :id, :name, :entity_type, :site_id, :permission_labels,
+                 CAST(:data AS jsonb), to_tsvector(CAST(:config AS regconfig), :text))
+            ON CONFLICT (index_id) DO UPDATE SET
+                id = EXCLUDED.id,
+                name = EXCLUDED.name,
+                entity_type = EXCLUDED.entity_type,
+                site_id = EXCLUDED.site_id,
+                permission_labels = EXCLUDED.permission_labels,
+                data = EXCLUDED.data,
+                search_vector = EXCLUDED.search_vector
+            """,
+            rows,
+        )
+
+    def delete(self, entity_type, entity_id, site_id, commit=False):
+        self._execute(
+            """
+            DELETE FROM sitesearch_document
+            WHERE entity_type = :entity_type AND site_id = :site_id
+            AND (id = :entity_id OR name = :entity_id)
+            """,
+            {"entity_type": entity_type, "site_id": site_id, "entity_id": entity_id},
+        )
+
+    def clear(self, site_id, entity_type=None, keep_datasets=True, commit=False):
+        # Datasets are never stored in this backend, so `keep_datasets` is
+        # always honoured
+        sql = "DELETE FROM sitesearch_document WHERE site_id = :site_id"
+        params = {"site_id": site_id}
+        if entity_type:
+            sql += " AND entity_type = :entity_type"
+            params["entity_type"] = entity_type
+        self._execute(sql, params)
+
+    def commit(self):
+        # Changes are committed as soon as they are written
+        pass
+
+    def iter_documents(self, site_id, entity_type=None, batch_size=1000, fields=None):
+
+        data = "data"
+        params = {"site_id": site_id, "limit": batch_size}
+        if fields:
+            # Don't transfer the rest of the document
+            data = (
+                "(SELECT jsonb_object_agg(key, value) FROM jsonb_each(data) "
+                "WHERE key = ANY(:fields)) AS data"
+            )
+            params["fields"] = list(fields)
+        sql = "SELECT index_id, {} FROM sitesearch_document WHERE site_id = :site_id"
+        sql = sql.format(data)
+        if entity_type:
+            sql += " AND entity_type = :entity_type"
+            params["entity_type"] = entity_type
+        sql += " AND index_id > :last ORDER BY index_id LIMIT :limit"
+
+        last = ""
+        while True:
+            try:
+                with model.meta.engine.connect() as conn:
+                    rows = conn.execute(text(sql), dict(params, last=last)).fetchall()
+            except SQLAlchemyError as e:
+                log.exception(e)
+                raise SearchError(e)
+            for row in rows:
+                yield self._doc(row["data"], None)
+            if len(rows) < batch_size:
+                break
+            last = rows[-1]["index_id"]
+
+    def index_info(self):
+        try:
+            with model.meta.engine.connect() as conn:
+                row = conn.execute(
+                    text(
+                        "SELECT count(*), "
+                        "pg_total_relation_size('sitesearch_document') "
+                        "FROM sitesearch_document"
+                    )
+                ).fetchone()
+        except SQLAlchemyError as e:
+            log.exception(e)
+            raise SearchError(e)
+        return {"num_docs": row[0], "size_in_bytes": row[1]}
+
+    def search(
+        self, query, entity_type=None, site_id=None, permission_labels=None, decode=None
+    ):
+
+        params = _Params()
+        where = []
+        tsquery = None
+
+        q = query.get("q") or "*:*"
+        if q != "*:*":
+            clauses, free_text = _parse_clauses(q)
+            for sign, field, value in clauses:
+                where.append(_clause_condition(sign, field, value, params))
+            expr = _to_tsquery(free_text)
+            if expr:
+                tsquery = "to_tsquery(CAST({} AS regconfig), {})".format(
+                    params.add(_text_search_config()), params.add(expr)
+                )
+                where.append("search_vector @@ {}".format(tsquery))
+
+        fq = []
+        if query.get("fq"):
+            fq.append(query["fq"])
+        fq.extend(query.get("fq_list", []))
+        for filter_query in fq:
+            clauses, rest = _parse_clauses(filter_query)
+            if rest.strip() or not clauses:
+                raise SearchQueryError(
+                    "Filter not supported by the postgres backend: {}".format(
+                        filter_query
+                    )
+                )
+            for sign, field, value in clauses:
+                where.append(_clause_condition(sign, field, value, params))
+
+        if entity_type:
+            where.append("entity_type = {}".format(params.add(entity_type)))
+        if site_id:
+            where.append("site_id = {}".format(params.add(site_id)))
+        if permission_labels is not None:
+            where.append(
+                "permission_labels && CAST({} AS text[])".format(
+                    params.add(list(permission_labels))
+                )
+            )
+
+        where_sql = " AND ".join(where) if where else "TRUE"
+
+        order_by = self._order_by(query.get("sort"), tsquery, params)
+
+        rows = int(query.get("rows", 10))
+        start = int(query.get("start", 0))
+
+        try:
+            with model.meta.engine.connect() as conn:
+                count = conn.execute(
+                    text(
+                        "SELECT count(*) FROM sitesearch_document WHERE {}".format(
+                            where_sql
+                        )
+                    ),
+                    params.values,
+                ).scalar()
+
+                results = conn.execute(
+                    text(
+                        "SELECT data FROM sitesearch_document WHERE {} "
+                        "ORDER BY {} LIMIT {} OFFSET {}".format(
+                            where_sql, order_by, rows, start
+                        )
+                    ),
+                    params.values,
+                )
+                docs = [self._doc(r[0], query.get("fl")) for r in results]
+                if decode:
+                    docs = [decode(doc) for doc in docs]
+
+                facets = self._facets(conn, query, where_sql, params)
+        except SQLAlchemyError as e:
+            raise SearchError(
+                "Postgres returned an error running query: %r Error: %r" % (query, e)
+            )
+
+        return {
+            "count": count,
+            "results": docs,
+            "facets": facets,
+        }
+
+    def _order_by(self, sort, tsquery, params):
+        order_by = []
+        for sort_field in (sort or "").split(","):
+            if not sort_field.strip():
+                continue
+            match = SORT_RE.match(sort_field)
+            if not match:
+                raise SearchQueryError("Invalid sort parameter: {}".format(sort))
+            field, direction = match.group(1), match.group(2).upper()
+            if field == "score":
+                if not tsquery:
+                    continue
+                column = "ts_rank(search_vector, {})".format(tsquery)
+            elif field in COLUMN_FIELDS:
+                column = field
+            else:
+                column = "data->>{}".format(params.add(field))
+            order_by.append("{} {} NULLS LAST".format(column, direction))
+
+        order_by.append("index_id ASC")
+        return ", ".join(order_by)
+
+    def _doc(self, data, fl):
+        if isinstance(data, str):
+            data = json.loads(data)
+        if not fl:
+            return data
+        if isinstance(fl, str):
+            fl = re.split(r"[\s,]+", fl)
+        if "*" in fl:
+            return data
+        return {k: v for k, v in data.items() if k in fl}
+
+    def _facets(self, conn, query, where_sql, params):
+        facet_fields = query.get("facet.field") or []
+        if isinstance(facet_fields, str):
+            facet_fields = [facet_fields]
+        if str(query.get("facet", "")).lower() not in ("on", "true", "yes"):
+            return {}
+
+        limit = int(query.get("facet.limit", DEFAULT_FACET_LIMIT))
+        mincount = max(int(query.get("facet.mincount", 1)), 1)
+
+        facets = {}
+        for field in facet_fields:
+            facet_params = _Params()
+            facet_params.values = dict(params.values)
+            if field in COLUMN_FIELDS:
+                values_sql = (
+                    "SELECT {field} AS value FROM sitesearch_document "
+                    "WHERE {where}".format(field=field, where=where_sql)
+                )
+            else:
+                key = facet_params.add(field)
+                values_sql = (
+                    "SELECT v AS value FROM sitesearch_document, "
+                    "LATERAL jsonb_array_elements_text("
+                    "CASE jsonb_typeof(data->{key}) WHEN 'array' THEN data->{key} "
+                    "ELSE jsonb_build_array(data->{key}) END) AS v "
+                    "WHERE {where} AND data ? {key}".format(key=key, where=where_sql)
+                )
+            sql = (
+                "SELECT value, count(*) AS count FROM ({values}) AS facet_values "
+                "WHERE value IS NOT NULL GROUP BY value "
+                "HAVING count(*) >= {mincount} ORDER BY count DESC, value ASC".format(
+                    values=values_sql, mincount=mincount
+                )
+            )
+            if limit >= 0:
+                sql += " LIMIT {}".format(limit)
+
+            facets[field] = {
+                row[0]: row[1] for row in conn.execute(text(sql), facet_params.values)
+            }
+
+        return facets
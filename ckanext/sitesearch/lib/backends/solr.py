@@ -0,0 +1,462 @@
+import gzip
+import logging
+import socket
+
+import pysolr
+import requests
+import urllib3
+from pysolr import SolrError
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+from ckan.lib.search.common import (
+    SearchError,
+    SearchIndexError,
+    SolrSettings,
+)
+from ckan.lib.search.common import make_connection as ckan_make_connection
+from ckan.lib.search.query import solr_literal
+from ckan.plugins import toolkit
+
+from ckanext.sitesearch.lib import limits
+from ckanext.sitesearch.lib.backends.base import LABELED_ENTITY_TYPES, SearchBackend
+
+
+log = logging.getLogger(__name__)
+
+# Timeout in seconds for the requests to the Solr admin APIs
+INFO_TIMEOUT = 30
+
+# Request bodies smaller than this (in bytes) are not worth compressing
+COMPRESS_MIN_SIZE = 1024
+
+# Searches with at least this number of rows are parsed incrementally
+DEFAULT_STREAM_ROWS = 1000
+
+
+class SolrClient(pysolr.Solr):
+    """
+    pysolr client that asks for compressed responses and can optionally
+    compress the request bodies (eg the documents sent to the update
+    handler). Solr only accepts compressed requests if its Jetty server is
+    configured to inflate them, so this is disabled by default.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.compress_requests = kwargs.pop("compress_requests", False)
+        super().__init__(*args, **kwargs)
+
+    def _send_request(self, method, path="", body=None, headers=None, files=None):
+        headers = dict(headers or {})
+        headers.setdefault("Accept-Encoding", "gzip")
+
+        if self.compress_requests and body and not files:
+            if isinstance(body, str):
+                body = body.encode("utf-8")
+            if len(body) >= COMPRESS_MIN_SIZE:
+                body = gzip.compress(body, compresslevel=5)
+                headers["Content-Encoding"] = "gzip"
+
+        return super()._send_request(
+            method, path, body=body, headers=headers, files=files
+        )
+
+    def stream_search(self, q, **kwargs):
+        """
+        Like `search`, but the response is parsed as it is downloaded (if
+        ijson is installed), so the raw body and the full parsed response
+        are never held in memory. Returns a `StreamedResults` object.
+        """
+        if ijson is None:
+            return self.search(q, **kwargs)
+
+        params = {"q": q}
+        params.update(kwargs)
+        params["wt"] = "json"
+        try:
+            response = self.get_session().post(
+                self._create_full_url(self.search_handler),
+                data=params,
+                headers={"Accept-Encoding": "gzip"},
+                timeout=self.timeout,
+                auth=self.auth,
+                verify=self.verify,
+                stream=True,
+            )
+        except requests.RequestException as e:
+            raise SolrError("Failed to connect to server at {}: {}".format(self.url, e))
+
+        if response.status_code != 200:
+            message = self._extract_error(response)
+            response.close()
+            raise SolrError(
+                "Solr responded with an error (HTTP {}): {}".format(
+                    response.status_code, message
+                )
+            )
+        # Let urllib3 decompress the body as it is read
+        response.raw.decode_content = True
+
+        return StreamedResults(response)
+
+
+class StreamedResults(object):
+    """
+    Search results parsed incrementally from a streamed Solr response
+
+    Iterating over the object yields the documents as they are read from
+    the response. The rest of the response (`hits`, `facets`, `qtime` and
+    `nextCursorMark`, like in pysolr's `Results`) is available once all
+    the documents have been consumed.
+    """
+
+    DOCS_PREFIX = "response.docs.item"
+
+    def __init__(self, response):
+        self._response = response
+        self.raw_response = None
+        self.hits = 0
+        self.facets = {}
+        self.qtime = None
+        self.nextCursorMark = None
+
+    def __iter__(self):
+        # The documents are built separately and yielded, the rest of the
+        # response is built in `top`
+        top = ijson.ObjectBuilder()
+        doc = None
+        try:
+            for prefix, event, value in ijson.parse(self._response.raw, use_float=True):
+                if prefix == self.DOCS_PREFIX and event == "start_map":
+                    doc = ijson.ObjectBuilder()
+                if doc is not None:
+                    doc.event(event, value)
+                    if prefix == self.DOCS_PREFIX and event == "end_map":
+                        yield doc.value
+                        doc = None
+                else:
+                    top.event(event, value)
+        except (ijson.JSONError, OSError, urllib3.exceptions.HTTPError) as e:
+            raise SolrError("Error reading the Solr response: {}".format(e))
+        finally:
+            self._response.close()
+
+        self.raw_response = top.value
+        self.hits = self.raw_response.get("response", {}).get("numFound", 0)
+        self.facets = self.raw_response.get("facet_counts", {})
+        self.qtime = self.raw_response.get("responseHeader", {}).get("QTime")
+        self.nextCursorMark = self.raw_response.get("nextCursorMark")
+
+
+def make_connection(decode_dates=True):
+    """
+    Return a `SolrClient` with the same settings as the connections
+    created by CKAN core
+    """
+    conn = ckan_make_connection(decode_dates=decode_dates)
+    return SolrClient(
+        conn.url,
+        decoder=conn.decoder,
+        timeout=conn.timeout,
+        auth=conn.auth,
+        compress_requests=toolkit.asbool(
+            toolkit.config.get("ckanext.sitesearch.solr.compress_requests", False)
+        ),
+    )
+
+
+def _stream_rows():
+    return toolkit.asint(
+        toolkit.config.get("ckanext.sitesearch.solr.stream_rows", DEFAULT_STREAM_ROWS)
+    )
+
+
+def _permission_labels_filter(permission_labels):
+    """Return the filter query for a set of permission labels
+
+    The labels are sorted, so the same set always produces the same
+    filter, and matched with the terms query parser, which is faster than
+    a boolean query for many labels. Filters for users with many labels are
+    rarely reused, so they can be kept out of the filterCache setting
+    `ckanext.sitesearch.permission_labels.cache` to false (optionally with
+    a `ckanext.sitesearch.permission_labels.cost`, see the Solr docs).
+    """
+    local_params = ["!terms", "f=permission_labels"]
+    if not toolkit.asbool(
+        toolkit.config.get("ckanext.sitesearch.permission_labels.cache", True)
+    ):
+        local_params.append("cache=false")
+        cost = toolkit.config.get("ckanext.sitesearch.permission_labels.cost")
+        if cost:
+            local_params.append("cost={}".format(toolkit.asint(cost)))
+
+    return "{{{}}}{}".format(
+        " ".join(local_params), ",".join(sorted(permission_labels))
+    )
+
+
+class SolrBackend(SearchBackend):
+    """
+    Stores the sitesearch documents in the same Solr core used by CKAN
+    for the datasets.
+    """
+
+    name = "solr"
+
+    def add(self, docs, commit=False):
+        conn = None
+        try:
+            conn = make_connection()
+            conn.add(docs=docs, commit=commit)
+        except SolrError as e:
+            msg = "Solr returned an error: {0}".format(
+                e.args[0][:1000]  # limit huge responses
+            )
+            raise SearchIndexError(msg)
+        except socket.error as e:
+            err = "Could not connect to Solr using {0}: {1}".format(
+                conn.url if conn else "", str(e)
+            )
+            log.error(err)
+            raise SearchIndexError(err)
+
+    def delete(self, entity_type, entity_id, site_id, commit=False):
+
+        query = []
+        query.append("+entity_type:{}".format(entity_type))
+
+        query.append(
+            '+(id:"{entity_id}" OR name:"{entity_id}")'.format(entity_id=entity_id)
+        )
+        query.append('+site_id:"{}"'.format(site_id))
+
+        self._delete_by_query(" AND ".join(query), commit)
+
+    def clear(self, site_id, entity_type=None, keep_datasets=True, commit=False):
+
+        query = []
+
+        if entity_type:
+            query.append("+entity_type:{}".format(entity_type))
+
+        if keep_datasets:
+            query.append("-entity_type:package")
+
+        query.append("+site_id:{}".format(site_id))
+
+        self._delete_by_query(" AND ".join(query), commit)
+
+    def _delete_by_query(self, query, commit):
+        try:
+            conn = make_connection()
+            conn.delete(q=query, commit=commit)
+        except SolrError as e:
+            log.exception(e)
+            raise SearchIndexError(e)
+
+    def commit(self):
+        try:
+            conn = make_connection()
+            conn.commit(waitSearcher=False)
+        except SolrError as e:
+            log.exception(e)
+            raise SearchIndexError(e)
+
+    def iter_documents(self, site_id, entity_type=None, batch_size=1000, fields=None):
+
+        fq = ["+site_id:{}".format(solr_literal(site_id))]
+        if entity_type:
+            fq.append("+entity_type:{}".format(entity_type))
+        else:
+            fq.append("-entity_type:package")
+        params = {"fl": ",".join(fields)} if fields else {}
+
+        conn = make_connection(decode_dates=False)
+        # Deep paging with cursors needs a sort on the uniqueKey field
+        cursor_mark = "*"
+        while True:
+            try:
+                response = conn.stream_search(
+                    q="*:*",
+                    fq=fq,
+                    sort="index_id asc",
+                    rows=batch_size,
+                    cursorMark=cursor_mark,
+                    wt="json",
+                    **params
+                )
+                found = 0
+                for doc in response:
+                    found += 1
+                    # Internal field, it can't be sent back when adding documents
+                    doc.pop("_version_", None)
+                    yield doc
+            except SolrError as e:
+                raise SearchError("SOLR returned an error: {}".format(e))
+
+            if not found or response.nextCursorMark == cursor_mark:
+                break
+            cursor_mark = response.nextCursorMark
+
+    def count(self, query, entity_types, site_id=None, permission_labels=None):
+
+        # A single query faceted by entity type
+        fq_list = list(query.get("fq_list", []))
+        fq_list.append("+entity_type:({})".format(" OR ".join(entity_types)))
+        labeled = [t for t in entity_types if t in LABELED_ENTITY_TYPES]
+        if labeled and permission_labels is not None:
+            # Labels only apply to the entity types indexed with them, the
+            # terms filter is nested to combine it with the other types
+            labels_filter = _permission_labels_filter(permission_labels)
+            fq_list.append(
+                '(*:* -entity_type:({})) OR _query_:"{}"'.format(
+                    " OR ".join(labeled),
+                    labels_filter.replace("\\", "\\\\").replace('"', '\\"'),
+                )
+            )
+
+        count_query = dict(query, fq_list=fq_list, rows=0)
+        count_query.update(
+            {
+                "facet": "true",
+                "facet.field": ["entity_type"],
+                "facet.limit": -1,
+                "facet.mincount": 0,
+            }
+        )
+        result = self.search(count_query, site_id=site_id)
+        facet = result["facets"].get("entity_type", {})
+
+        return {entity_type: facet.get(entity_type, 0) for entity_type in entity_types}
+
+    def index_info(self):
+
+        url, user, password = SolrSettings.get()
+        auth = (user, password) if user and password else None
+        info = {}
+
+        # Luke returns the number of documents, including the deleted ones
+        # that are not merged yet
+        try:
+            response = requests.get(
+                url.rstrip("/") + "/admin/luke",
+                params={"numTerms": 0, "show": "index", "wt": "json"},
+                auth=auth,
+                timeout=INFO_TIMEOUT,
+            )
+            response.raise_for_status()
+            index = response.json().get("index", {})
+            info.update(
+                num_docs=index.get("numDocs"),
+                max_doc=index.get("maxDoc"),
+                deleted_docs=index.get("deletedDocs"),
+                segment_count=index.get("segmentCount"),
+            )
+        except (requests.RequestException, ValueError) as e:
+            log.warning("Could not get the Solr index details: {}".format(e))
+
+        # The index size and cache stats are only available in the metrics
+        # API, which is not core specific
+        core = url.rstrip("/").rsplit("/", 1)
+        try:
+            response = requests.get(
+                core[0] + "/admin/metrics",
+                params={
+                    "group": "core",
+                    "prefix": "INDEX.sizeInBytes,CACHE.searcher.filterCache",
+                    "wt": "json",
+                },
+                auth=auth,
+                timeout=INFO_TIMEOUT,
+            )
+            response.raise_for_status()
+            for registry, metrics in response.json().get("metrics", {}).items():
+                if registry.startswith("solr.core.{}".format(core[1])):
+                    info["size_in_bytes"] = metrics.get("INDEX.sizeInBytes")
+                    info["filter_cache"] = metrics.get("CACHE.searcher.filterCache")
+                    break
+        except (requests.RequestException, ValueError) as e:
+            log.warning("Could not get the Solr index size: {}".format(e))
+
+        return info
+
+    def build_params(
+        self, query, entity_type=None, site_id=None, permission_labels=None
+    ):
+        """Return the parameters sent to Solr for a search
+
+        `query` is modified in place.
+        """
+        fq = []
+        if "fq" in query:
+            fq.append(query["fq"])
+        fq.extend(query.pop("fq_list", []))
+
+        # Static filters are sent as separate entries, so each of them is
+        # cached (and reused by all queries) in Solr's filterCache
+        if entity_type:
+            fq.append("+entity_type:{}".format(entity_type))
+
+        # Show only results from this CKAN instance
+        if site_id:
+            fq.append("+site_id:{}".format(solr_literal(site_id)))
+
+        if permission_labels is not None:
+            fq.append(_permission_labels_filter(permission_labels))
+
+        query["fq"] = fq
+
+        query.setdefault("wt", "json")
+
+        query.setdefault("df", "text")
+        query.setdefault("q.op", "AND")
+
+        # Stop collecting results after this time and return the partial ones
+        time_allowed = limits.get_time_allowed(
+            "{}_search".format(entity_type) if entity_type else None
+        )
+        if time_allowed:
+            query.setdefault("timeAllowed", time_allowed)
+
+        return query
+
+    def search(
+        self, query, entity_type=None, site_id=None, permission_labels=None, decode=None
+    ):
+
+        query = self.build_params(query, entity_type, site_id, permission_labels)
+
+        conn = make_connection(decode_dates=False)
+        log.debug("Sent Solr query: {}".format(query))
+        try:
+            if toolkit.asint(query.get("rows") or 0) >= _stream_rows():
+                # Large responses are parsed as they are downloaded, and each
+                # document is decoded before reading the next one
+                solr_response = conn.stream_search(**query)
+                docs = solr_response
+            else:
+                solr_response = conn.search(**query)
+                docs = solr_response.docs
+            docs = [decode(doc) for doc in docs] if decode else list(docs)
+        except SolrError as e:
+            raise SearchError(
+                "SOLR returned an error running query: %r Error: %r" % (query, e)
+            )
+
+        # Covert facets from lists to dicts
+        facets = solr_response.facets.get("facet_fields", {})
+        for field, values in facets.items():
+            facets[field] = dict(zip(values[0::2], values[1::2]))
+
+        header = (solr_response.raw_response or {}).get("responseHeader", {})
+
+        return {
+            "count": solr_response.hits,
+            "results": docs,
+            "facets": facets,
+            "qtime": solr_response.qtime,
+            "partial_results": bool(header.get("partialResults")),
+        }
@@ -0,0 +1,80 @@
+"""
+Checkpoints for the index rebuilds
+
+Checkpoints are small JSON files stored in the folder defined in
+`ckanext.sitesearch.checkpoint_dir` (by default a `sitesearch` folder
+inside `ckan.storage_path`, or the system temporary folder if that is not
+set), one per entity type and site (and shard, for sharded rebuilds).
+"""
+import datetime
+import json
+import logging
+import os
+import tempfile
+
+from ckan.plugins import toolkit
+
+
+log = logging.getLogger(__name__)
+
+
+def get_checkpoint_dir():
+    path = toolkit.config.get("ckanext.sitesearch.checkpoint_dir")
+    if not path:
+        storage_path = toolkit.config.get("ckan.storage_path")
+        if storage_path:
+            path = os.path.join(storage_path, "sitesearch", "checkpoints")
+        else:
+            path = os.path.join(tempfile.gettempdir(), "ckanext-sitesearch")
+    if not os.path.exists(path):
+        os.makedirs(path)
+    return path
+
+
+class Checkpoint(object):
+    """
+    Progress of a rebuild of a particular entity type
+
+    Stores the last entity id that was indexed and committed, and the
+    number of entities processed so far.
+    """
+
+    def __init__(self, entity_name, shard=None):
+        self.entity_name = entity_name
+        name = "{}-{}".format(toolkit.config.get("ckan.site_id"), entity_name)
+        if shard:
+            # Each shard of a sharded rebuild keeps its own progress
+            name += "-shard-{}-of-{}".format(*shard)
+        self.path = os.path.join(get_checkpoint_dir(), name + ".json")
+
+    def load(self):
+        """Return the saved checkpoint data or None if there isn't one"""
+        if not os.path.exists(self.path):
+            return None
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except ValueError:
+            log.warning("Ignoring invalid checkpoint file: {}".format(self.path))
+            return None
+
+    def save(self, last_id, indexed, failed, total):
+        data = {
+            "entity_type": self.entity_name,
+            "last_id": last_id,
+            "indexed": indexed,
+            "failed": failed,
+            "total": total,
+            "updated": datetime.datetime.utcnow().isoformat(),
+        }
+        # Write to a temporary file first so an interrupted write doesn't
+        # leave a corrupted checkpoint
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.path)
+        log.debug("Saved checkpoint for {}: {}".format(self.entity_name, data))
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
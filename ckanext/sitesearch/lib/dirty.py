@@ -0,0 +1,337 @@
+"""
+Coalescing of the index updates triggered by the chained actions
+
+Instead of reindexing entities straight away, the chained actions mark them
+as dirty with `add` or `delete`. The dirty entities are collected in a
+per-thread set while the outermost chained action runs (see `coalesced`),
+so an entity affected several times (eg an organization when a dataset
+changes both its owner and state, or a group when several datasets are
+added to it) is only reindexed once, and all the documents are sent to the
+search backend in a single update.
+
+If the outermost action was called with `defer_commit` in the context, the
+changes are not committed to the database by the action, so the dirty
+entities are kept until the caller commits the session: the documents are
+prepared before the commit (when the changes are visible in the session)
+and sent after it. If the session is rolled back they are discarded.
+Nested actions called with `defer_commit` are committed by the outermost
+one, so they are flushed with it.
+
+If `ckanext.sitesearch.index_mode` is `outbox`, dirty entities are written
+to the outbox table in the same transaction as the action changes instead,
+and indexed later by the relay (see `lib/outbox.py`).
+"""
+import functools
+import logging
+import threading
+
+from sqlalchemy import event
+
+from ckan import model
+from ckan.plugins import toolkit
+
+from ckanext.sitesearch.lib import failures, index, outbox
+
+
+log = logging.getLogger(__name__)
+
+# Action used to get the latest version of each entity, and its id parameter
+show_actions = {
+    "organization": ("organization_show", "id"),
+    "group": ("group_show", "id"),
+    "user": ("user_show", "id"),
+    "page": ("ckanext_pages_show", "page"),
+}
+
+INDEX = "index"
+DELETE = "delete"
+
+DIRECT_MODE = "direct"
+OUTBOX_MODE = "outbox"
+
+_local = threading.local()
+_listeners_lock = threading.Lock()
+_listeners_registered = False
+
+
+class _State(object):
+    def __init__(self):
+        self.depth = 0
+        self.reset()
+
+    def reset(self):
+        # (entity_type, entity_id) -> (operation, data_dict)
+        self.entities = {}
+        self.prepared = None
+        self.wait_for_commit = False
+
+
+def _state():
+    if not hasattr(_local, "state"):
+        _local.state = _State()
+    return _local.state
+
+
+def get_index_mode():
+    mode = toolkit.config.get("ckanext.sitesearch.index_mode", DIRECT_MODE)
+    if mode not in (DIRECT_MODE, OUTBOX_MODE):
+        raise ValueError("Unknown ckanext.sitesearch.index_mode: {}".format(mode))
+    return mode
+
+
+def add(entity_type, entity_id, data_dict=None):
+    """Mark an entity to be reindexed
+
+    If the entity dict is already available it can be passed as
+    `data_dict` to avoid fetching it again. Marking the same entity again
+    without `data_dict` means that the entity changed since, so it will be
+    fetched.
+    """
+    if data_dict is not None:
+        # The indexers modify the dict, don't change the action output
+        data_dict = dict(data_dict)
+    _mark(entity_type, entity_id, INDEX, data_dict)
+
+
+def delete(entity_type, entity_id):
+    """Mark an entity to be removed from the index"""
+    _mark(entity_type, entity_id, DELETE)
+
+
+def _mark(entity_type, entity_id, operation, data_dict=None):
+    state = _state()
+    key = (entity_type, entity_id)
+
+    if get_index_mode() == OUTBOX_MODE:
+        # Only one row per entity and operation is needed in each action
+        if key not in state.entities or state.entities[key][0] != operation:
+            outbox.write(entity_type, entity_id, operation)
+        if state.depth:
+            state.entities[key] = (operation, None)
+        return
+
+    state.entities[key] = (operation, data_dict)
+    _flush_if_not_collecting()
+
+
+def pending():
+    """Return the dirty entities as a dict of `(entity_type, id): operation`"""
+    return {key: op for key, (op, _) in _state().entities.items()}
+
+
+def _flush_if_not_collecting():
+    state = _state()
+    if not state.depth and not state.wait_for_commit:
+        flush()
+
+
+def coalesced(func):
+    """
+    Collect the dirty entities while a chained action runs, and flush
+    them when the outermost one finishes
+    """
+
+    @functools.wraps(func)
+    def wrapper(up_func, context, data_dict):
+        if get_index_mode() == OUTBOX_MODE:
+            return _run_with_outbox(func, up_func, context, data_dict)
+
+        state = _state()
+        outermost = not state.depth
+        # Only the outermost action decides when the changes are committed,
+        # nested actions called with `defer_commit` are committed by it
+        defer_commit = outermost and bool(context.get("defer_commit"))
+        if defer_commit:
+            _wait_for_commit()
+        state.depth += 1
+        try:
+            result = func(up_func, context, data_dict)
+        except Exception:
+            state.depth -= 1
+            if outermost and not defer_commit:
+                # Entities marked by nested actions that succeeded before
+                # the error still need to be reindexed
+                flush(raise_errors=False)
+            raise
+        state.depth -= 1
+        if outermost and not defer_commit:
+            # The action committed the session, including any changes of
+            # previous actions that were waiting for a commit
+            flush()
+        return result
+
+    return wrapper
+
+
+def _run_with_outbox(func, up_func, context, data_dict):
+    """Run a chained action so the outbox rows are committed with its changes
+
+    Unless the caller already deferred the commit, the core action is run
+    with `defer_commit` and the session is committed once the outbox rows
+    are written.
+    """
+    state = _state()
+    owns_commit = not state.depth and not context.get("defer_commit")
+    if owns_commit:
+        context["defer_commit"] = True
+    state.depth += 1
+    try:
+        result = func(up_func, context, data_dict)
+    except Exception:
+        if owns_commit:
+            model.Session.rollback()
+        raise
+    finally:
+        state.depth -= 1
+        if owns_commit:
+            context.pop("defer_commit", None)
+        written = bool(state.entities)
+        if not state.depth:
+            state.reset()
+
+    if owns_commit:
+        model.repo.commit()
+    if written and not state.depth:
+        outbox.enqueue_relay_job()
+
+    return result
+
+
+def _wait_for_commit():
+    _register_listeners()
+    _state().wait_for_commit = True
+
+
+def _register_listeners():
+    global _listeners_registered
+
+    if _listeners_registered:
+        return
+    with _listeners_lock:
+        if _listeners_registered:
+            return
+        event.listen(model.Session, "before_commit", _before_commit)
+        event.listen(model.Session, "after_commit", _after_commit)
+        event.listen(model.Session, "after_rollback", _after_rollback)
+        _listeners_registered = True
+
+
+def _before_commit(session):
+    state = _state()
+    if state.wait_for_commit and state.entities and state.prepared is None:
+        # The show actions need to run while the session can still emit SQL
+        state.prepared = _prepare()
+
+
+def _after_commit(session):
+    state = _state()
+    if not state.wait_for_commit or state.depth:
+        return
+    prepared = state.prepared or _prepare()
+    state.reset()
+    # The database changes are committed already, failures are recorded
+    # to be retried but not raised
+    _send(prepared, raise_errors=False)
+
+
+def _after_rollback(session):
+    state = _state()
+    if state.wait_for_commit and not state.depth:
+        state.reset()
+
+
+def flush(raise_errors=True):
+    """Reindex and delete the dirty entities
+
+    Errors are recorded as failures. If `raise_errors` is True, the first
+    error is raised once all the other entities are processed.
+    """
+    state = _state()
+    if not state.entities:
+        state.reset()
+        return
+    prepared = _prepare()
+    state.reset()
+    _send(prepared, raise_errors=raise_errors)
+
+
+def process(entities, raise_on_send_error=False):
+    """Reindex and delete the provided entities
+
+    `entities` is a dict of `(entity_type, entity_id): (operation, data_dict)`.
+    Errors with particular entities are recorded as failures. If
+    `raise_on_send_error` is True, errors sending the update to the
+    backend are raised.
+    """
+    _send(
+        _prepare(entities),
+        raise_errors=False,
+        raise_on_send_error=raise_on_send_error,
+    )
+
+
+def _prepare(entities=None):
+    """Return the documents to add, entities to delete and errors found
+
+    Entities to index that no longer exist or are deleted are removed from
+    the index instead.
+    """
+    if entities is None:
+        entities = _state().entities
+    docs, deletes, errors = [], [], []
+    context = {"ignore_auth": True}
+    for (entity_type, entity_id), (operation, data_dict) in list(entities.items()):
+        if operation == DELETE:
+            deletes.append((entity_type, entity_id))
+            continue
+        try:
+            if data_dict is None:
+                action_name, id_field = show_actions[entity_type]
+                data_dict = toolkit.get_action(action_name)(
+                    dict(context), {id_field: entity_id}
+                )
+            if not data_dict or data_dict.get("state") == "deleted":
+                deletes.append((entity_type, entity_id))
+                continue
+            doc = index.preparers[entity_type](data_dict)
+            if doc:
+                docs.append((entity_type, entity_id, doc))
+        except toolkit.ObjectNotFound:
+            deletes.append((entity_type, entity_id))
+        except Exception as e:
+            errors.append((entity_type, entity_id, INDEX, e))
+    return docs, deletes, errors
+
+
+def _send(prepared, raise_errors=True, raise_on_send_error=False):
+    docs, deletes, errors = prepared
+
+    for entity_type, entity_id in deletes:
+        try:
+            index.deleters[entity_type](entity_id, defer_commit=True)
+        except Exception as e:
+            if raise_on_send_error:
+                raise
+            errors.append((entity_type, entity_id, DELETE, e))
+
+    try:
+        if docs:
+            index.index_documents([doc for _, _, doc in docs])
+        elif deletes:
+            index.commit_unless_deferred()
+    except Exception as e:
+        if raise_on_send_error:
+            raise
+        for entity_type, entity_id, _ in docs:
+            errors.append((entity_type, entity_id, INDEX, e))
+
+    for entity_type, entity_id, operation, error in errors:
+        log.error(
+            "Error while updating the index for {} {}: {}".format(
+                entity_type, entity_id, repr(error)
+            )
+        )
+        failures.record_failure(entity_type, entity_id, error, operation)
+
+    if errors and raise_errors:
+        raise errors[0][3]
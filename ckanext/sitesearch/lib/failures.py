@@ -0,0 +1,196 @@
+"""
+Dead-letter record of the entities that could not be indexed
+
+Every failure to index or delete an entity is stored as a row in the
+`sitesearch_failure` table, so they can be listed and retried later with the
+`ckan sitesearch failures` commands. Rows are marked as resolved rather than
+deleted once the entity is indexed successfully, to keep the history of
+failures over time until they are purged.
+"""
+import datetime
+import logging
+from contextlib import contextmanager
+
+from sqlalchemy import and_, func, select
+
+from ckan import model
+from ckan.plugins import toolkit
+
+from ckanext.sitesearch import db
+
+
+log = logging.getLogger(__name__)
+
+MAX_MESSAGE_LENGTH = 1000
+
+
+def _site_id():
+    return toolkit.config.get("ckan.site_id")
+
+
+def _entity_filter(table, entity_type, entity_id):
+    return and_(
+        table.c.entity_type == entity_type,
+        table.c.entity_id == entity_id,
+        table.c.site_id == _site_id(),
+    )
+
+
+def record_failure(entity_type, entity_id, error, operation="index", error_class=None):
+    """Store a failure to index (or delete) an entity
+
+    For errors raised in other processes, `error` can be the message and
+    `error_class` the name of the exception class.
+
+    Errors while storing the failure are logged but not raised, so they
+    don't hide the original error.
+    """
+    try:
+        table = db.failure_table
+        db.check_table(table)
+        with model.meta.engine.begin() as conn:
+            previous = conn.execute(
+                select([func.count()]).where(
+                    and_(
+                        _entity_filter(table, entity_type, entity_id),
+                        table.c.resolved.is_(False),
+                    )
+                )
+            ).scalar()
+            conn.execute(
+                table.insert().values(
+                    entity_type=entity_type,
+                    entity_id=entity_id,
+                    site_id=_site_id(),
+                    operation=operation,
+                    error_class=error_class or type(error).__name__,
+                    message=str(error)[:MAX_MESSAGE_LENGTH],
+                    attempt=previous + 1,
+                    created=datetime.datetime.utcnow(),
+                    resolved=False,
+                )
+            )
+    except Exception:
+        log.exception(
+            "Could not record failure for {} {}".format(entity_type, entity_id)
+        )
+
+
+@contextmanager
+def recorded(entity_type, entity_id, operation="index"):
+    """Record any exception raised in the block as a failure, and re-raise it"""
+    try:
+        yield
+    except Exception as e:
+        record_failure(entity_type, entity_id, e, operation)
+        raise
+
+
+def mark_resolved(entity_type, entity_id):
+    table = db.failure_table
+    db.check_table(table)
+    with model.meta.engine.begin() as conn:
+        conn.execute(
+            table.update()
+            .where(
+                and_(
+                    _entity_filter(table, entity_type, entity_id),
+                    table.c.resolved.is_(False),
+                )
+            )
+            .values(resolved=True)
+        )
+
+
+def get_failures(entity_type=None, include_resolved=False):
+    """Return the failed entities, with the details of the latest failure
+
+    Each item is a dict with the `entity_type`, `entity_id`, `operation`,
+    `error_class`, `message`, `attempts`, `first_failed`, `last_failed` and
+    `resolved` keys.
+    """
+    table = db.failure_table
+    db.check_table(table)
+    query = (
+        select([table]).where(table.c.site_id == _site_id()).order_by(table.c.created)
+    )
+    if entity_type:
+        query = query.where(table.c.entity_type == entity_type)
+    if not include_resolved:
+        query = query.where(table.c.resolved.is_(False))
+
+    failures = {}
+    with model.meta.engine.connect() as conn:
+        for row in conn.execute(query):
+            key = (row["entity_type"], row["entity_id"])
+            failure = failures.setdefault(
+                key,
+                {
+                    "entity_type": row["entity_type"],
+                    "entity_id": row["entity_id"],
+                    "attempts": 0,
+                    "first_failed": row["created"],
+                },
+            )
+            failure.update(
+                {
+                    "operation": row["operation"],
+                    "error_class": row["error_class"],
+                    "message": row["message"],
+                    "last_failed": row["created"],
+                    "resolved": row["resolved"],
+                }
+            )
+            failure["attempts"] += 1
+
+    return list(failures.values())
+
+
+def get_failure_stats(days=30, entity_type=None):
+    """Return the number of failures per day and entity type
+
+    Returns a list of `(day, entity_type, failures, resolved)` tuples for
+    the last `days` days, most recent first.
+    """
+    table = db.failure_table
+    db.check_table(table)
+    day = func.date(table.c.created)
+    since = datetime.datetime.utcnow() - datetime.timedelta(days=days)
+    query = (
+        select(
+            [
+                day.label("day"),
+                table.c.entity_type,
+                func.count().label("failures"),
+                func.count().filter(table.c.resolved.is_(True)).label("resolved"),
+            ]
+        )
+        .where(and_(table.c.site_id == _site_id(), table.c.created >= since))
+        .group_by(day, table.c.entity_type)
+        .order_by(day.desc(), table.c.entity_type)
+    )
+    if entity_type:
+        query = query.where(table.c.entity_type == entity_type)
+    with model.meta.engine.connect() as conn:
+        return [tuple(row) for row in conn.execute(query)]
+
+
+def purge(entity_type=None, resolved_only=False, older_than=None):
+    """Delete failure records, returns the number of records deleted
+
+    `older_than` is a number of days.
+    """
+    table = db.failure_table
+    db.check_table(table)
+    conditions = [table.c.site_id == _site_id()]
+    if entity_type:
+        conditions.append(table.c.entity_type == entity_type)
+    if resolved_only:
+        conditions.append(table.c.resolved.is_(True))
+    if older_than is not None:
+        conditions.append(
+            table.c.created
+            < datetime.datetime.utcnow() - datetime.timedelta(days=older_than)
+        )
+    with model.meta.engine.begin() as conn:
+        return conn.execute(table.delete().where(and_(*conditions))).rowcount
@@ -0,0 +1,68 @@
+"""
+Index generation marker
+
+A token stored in Redis that changes every time changes to the sitesearch
+documents are committed by `lib/index`, in any process. Deferred writes
+only change it when they are committed, as they are not visible before,
+except when `ckan.search.solr_commit` is disabled: Solr's autoCommit
+commits them, so it changes when they are sent (and the ETags are not
+used, see `views.py`).
+Requests that arrive with the same generation and parameters get the same
+search results, so it is used to build the ETags of the search API
+responses without querying the search backend.
+
+The token is random rather than a counter, so a Redis that was flushed or
+replaced never reuses the generation of ETags issued before.
+"""
+import logging
+import uuid
+
+from redis.exceptions import RedisError
+
+from ckan.lib.redis import connect_to_redis
+from ckan.plugins import toolkit
+
+
+log = logging.getLogger(__name__)
+
+
+def _key():
+    return "ckanext-sitesearch:generation:{}".format(
+        toolkit.config.get("ckan.site_id")
+    )
+
+
+def get_generation():
+    """Return the current generation, or None if it can't be read"""
+    try:
+        conn = connect_to_redis()
+        value = conn.get(_key())
+        if value is None:
+            # Another process might be setting it at the same time
+            conn.set(_key(), uuid.uuid4().hex, nx=True)
+            value = conn.get(_key())
+    except RedisError as e:
+        log.warning("Could not read the index generation: {}".format(e))
+        return None
+
+    if isinstance(value, bytes):
+        value = value.decode("utf-8")
+    return value
+
+
+def bump_generation():
+    """Start a new generation, called after every commit to the index
+
+    Returns the previous and the new generation, or None if it can't be
+    updated.
+    """
+    generation = uuid.uuid4().hex
+    try:
+        previous = connect_to_redis().getset(_key(), generation)
+    except RedisError as e:
+        log.error("Could not update the index generation: {}".format(e))
+        return None
+
+    if isinstance(previous, bytes):
+        previous = previous.decode("utf-8")
+    return previous, generation
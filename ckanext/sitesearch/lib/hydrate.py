@@ -0,0 +1,254 @@
+"""
+Hydration of thin documents
+
+When `ckanext.sitesearch.thin_documents` is enabled, the indexed documents
+don't include the full entity dict (`validated_data_dict`), only the
+searchable fields. The search results are then built from the database,
+with one query per entity type for each page of results (plus one for the
+dataset counts), using the same dictization functions used by the core
+`*_list` actions with `all_fields`.
+
+The dicts are not exactly the same as the ones stored in full documents
+(the `*_show` output, plus some fields added by the indexers): they don't
+go through the `*_show` schemas and plugins, and don't include the fields
+in `MISSING_FIELDS`, which would need extra queries for each entity.
+
+Dicts are cached in a per-process LRU cache keyed by the entity id and its
+`metadata_modified` value in the index, which changes every time the
+entity is reindexed, so outdated entries are never returned.
+"""
+import copy
+import logging
+import threading
+from collections import OrderedDict
+
+from sqlalchemy import func, orm
+
+from ckan import model
+from ckan.lib import dictization, munge
+from ckan.lib.dictization import model_dictize
+from ckan.plugins import toolkit
+
+from ckanext.sitesearch.lib import metrics
+
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CACHE_SIZE = 1000
+
+# Fields added by the indexers before storing the full dict
+INDEX_FIELDS = ("index_id", "site_id", "entity_type")
+
+# Fields of the dicts stored in full documents not included in the hydrated
+# ones, for each entity type
+MISSING_FIELDS = {
+    "organization": INDEX_FIELDS + ("tags", "num_followers"),
+    "group": INDEX_FIELDS + ("tags", "num_followers"),
+    "user": INDEX_FIELDS + ("notes",),
+    "page": INDEX_FIELDS,
+}
+
+
+class LRUCache(object):
+    """A simple thread-safe least recently used cache"""
+
+    def __init__(self, size=DEFAULT_CACHE_SIZE):
+        self.size = size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return None
+            self._data[key] = value
+            return value
+
+    def set(self, key, value):
+        if self.size <= 0:
+            return
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = LRUCache(
+                    toolkit.asint(
+                        toolkit.config.get(
+                            "ckanext.sitesearch.thin_documents.cache_size",
+                            DEFAULT_CACHE_SIZE,
+                        )
+                    )
+                )
+    return _cache
+
+
+def _context():
+    return {"model": model, "session": model.Session, "ignore_auth": True}
+
+
+def _fetch_groups(ids, is_org):
+    from ckan.lib.search import get_group_dataset_counts
+
+    groups = (
+        model.Session.query(model.Group)
+        .options(orm.subqueryload(model.Group._extras))
+        .filter(model.Group.id.in_(ids))
+        .filter(model.Group.is_organization == is_org)
+        .filter(model.Group.state != "deleted")
+        .all()
+    )
+    context = _context()
+    # One facet query for the dataset counts of all groups, as in `group_list`
+    context["dataset_counts"] = get_group_dataset_counts()
+    return {
+        group.id: model_dictize.group_dictize(
+            group,
+            context,
+            include_groups=False,
+            include_tags=False,
+            include_users=False,
+            packages_field="dataset_count",
+        )
+        for group in groups
+    }
+
+
+def _fetch_organizations(ids):
+    return _fetch_groups(ids, True)
+
+
+def _fetch_group_entities(ids):
+    return _fetch_groups(ids, False)
+
+
+def _created_dataset_counts(user_ids):
+    """Return the number of public datasets created by each user
+
+    Same as `User.number_created_packages`, in a single query.
+    """
+    query = (
+        model.Session.query(model.Package.creator_user_id, func.count(model.Package.id))
+        .filter(model.Package.creator_user_id.in_(user_ids))
+        .filter(model.Package.state == "active")
+        .filter(model.Package.private == False)  # noqa: E712
+        .group_by(model.Package.creator_user_id)
+    )
+    return dict(query.all())
+
+
+def _user_dictize(user, context, dataset_counts):
+    """Same as the core `user_dictize` for anonymous users (as `user_show`
+    is called when indexing), with the dataset counts of all users
+    computed at once
+    """
+    user_dict = dictization.table_dictize(user, context)
+    for key in ("password", "reset_key", "apikey", "email", "plugin_extras"):
+        user_dict.pop(key, None)
+
+    user_dict["display_name"] = user.display_name
+    user_dict["email_hash"] = user.email_hash
+    user_dict["number_created_packages"] = dataset_counts.get(user.id, 0)
+
+    image_url = user_dict.get("image_url")
+    user_dict["image_display_url"] = image_url
+    if image_url and not image_url.startswith("http"):
+        image_url = munge.munge_filename_legacy(image_url)
+        user_dict["image_display_url"] = toolkit.h.url_for_static(
+            "uploads/user/{}".format(image_url), qualified=True
+        )
+    return user_dict
+
+
+def _fetch_users(ids):
+    users = (
+        model.Session.query(model.User)
+        .filter(model.User.id.in_(ids))
+        .filter(model.User.state != "deleted")
+        .all()
+    )
+    context = _context()
+    dataset_counts = _created_dataset_counts([user.id for user in users])
+    return {user.id: _user_dictize(user, context, dataset_counts) for user in users}
+
+
+def _fetch_pages(ids):
+    from ckanext.pages.db import Page
+
+    pages = model.Session.query(Page).filter(Page.id.in_(ids)).all()
+    context = _context()
+    return {page.id: dictization.table_dictize(page, context) for page in pages}
+
+
+fetchers = {
+    "organization": _fetch_organizations,
+    "group": _fetch_group_entities,
+    "user": _fetch_users,
+    "page": _fetch_pages,
+}
+
+
+def _cache_key(doc):
+    return (doc["entity_type"], doc["id"], doc.get("metadata_modified"))
+
+
+def hydrate(docs):
+    """Return the entity dicts for a list of thin documents
+
+    Documents need the `id`, `entity_type` and `metadata_modified` fields.
+    Results are returned in the same order, entities that are no longer in
+    the database are skipped.
+    """
+    cache = get_cache()
+    found = {}
+    missing = OrderedDict()
+    for doc in docs:
+        key = _cache_key(doc)
+        cached = cache.get(key)
+        if cached is not None:
+            found[key] = cached
+        else:
+            missing.setdefault(doc["entity_type"], []).append(key)
+
+    metrics.incr("sitesearch.hydrate.cache_hits", len(found))
+    for entity_type, keys in missing.items():
+        with metrics.timer("sitesearch.hydrate", entity_type=entity_type):
+            dicts = fetchers[entity_type]([key[1] for key in keys])
+        for key in keys:
+            data_dict = dicts.get(key[1])
+            if data_dict is None:
+                log.debug(
+                    "{} {} is in the index but not in the database".format(
+                        entity_type, key[1]
+                    )
+                )
+                continue
+            cache.set(key, data_dict)
+            found[key] = data_dict
+
+    # Callers (eg the `after_*_search` hooks) can modify the returned dicts
+    return [
+        copy.deepcopy(found[_cache_key(doc)])
+        for doc in docs
+        if _cache_key(doc) in found
+    ]
@@ -1,21 +1,53 @@
+import datetime
 import logging
 import hashlib
-from html import unescape
 import json
-import socket
-
-from pysolr import SolrError
 
 from ckan.plugins import toolkit, plugin_loaded
 
-from ckan.lib.search.common import SearchIndexError, make_connection
 from ckan.lib.search.index import RESERVED_FIELDS, KEY_CHARS
 from ckan.lib.navl.dictization_functions import MissingNullEncoder
 
-from ckanext.sitesearch.lib.utils import strip_html_tags
+from ckanext.sitesearch.lib import autocomplete, metrics, wildcards
+from ckanext.sitesearch.lib.generation import bump_generation
+from ckanext.sitesearch.lib.backends import get_backend
+from ckanext.sitesearch.lib.utils import sanitize_html_text
+
+
+def _get_defer_commit(defer_commit):
+    """Return the `defer_commit` value to use if none was passed explicitly
+
+    Read from the config at call time, so it is not needed on import.
+    """
+    if defer_commit is None:
+        return not toolkit.asbool(toolkit.config.get("ckan.search.solr_commit", True))
+    return defer_commit
+
+
+def generation_tracks_commits():
+    """Whether the index generation changes when written changes are visible
+
+    That is not the case when `ckan.search.solr_commit` is disabled and the
+    changes are committed by Solr's autoCommit, which happens at a time we
+    don't know about.
+    """
+    return get_backend().commits_on_write or not _get_defer_commit(None)
+
+
+def _changes_visible(defer_commit):
+    """Whether the changes of a write become visible without calling `commit()`
+
+    Writes deferred explicitly are made visible by a later call to
+    `commit()`, which starts a new generation itself. Writes deferred
+    because `ckan.search.solr_commit` is disabled are committed by Solr's
+    autoCommit, so the generation changes when they are sent.
+    """
+    return defer_commit is not True or get_backend().commits_on_write
 
 
-DEFAULT_DEFER_COMMIT_VALUE = not toolkit.config.get("ckan.search.solr_commit", True)
+def _start_generation():
+    """Start a new index generation once changes are visible"""
+    autocomplete.committed(bump_generation())
 
 
 log = logging.getLogger(__name__)
@@ -35,6 +67,28 @@ def _check_mandatory_fields(data_dict):
     return data_dict
 
 
+def thin_documents_enabled():
+    """Whether documents are indexed without the full entity dict
+
+    See `lib/hydrate.py`.
+    """
+    return toolkit.asbool(
+        toolkit.config.get("ckanext.sitesearch.thin_documents", False)
+    )
+
+
+def _store_data_dict(data_dict):
+    if thin_documents_enabled():
+        # Results are built from the database, the time of indexing is used
+        # to know if a cached version of the entity is outdated (pages
+        # override it with their own modification date)
+        data_dict["metadata_modified"] = _format_date(
+            datetime.datetime.utcnow().isoformat()
+        )
+        return
+    data_dict["validated_data_dict"] = json.dumps(data_dict, cls=MissingNullEncoder)
+
+
 def _format_date(value):
     # Solr 6 is picky with dates, wants a Z character at the end of ISO dates
     if not value[:-1] == "Z":
@@ -42,27 +96,38 @@ def _format_date(value):
     return value
 
 
-def index_group(data_dict, defer_commit=DEFAULT_DEFER_COMMIT_VALUE):
+def prepare_group(data_dict):
+    """Return the document to index for the group (modifies `data_dict`)"""
 
     if not data_dict:
         return
 
     data_dict["entity_type"] = "group"
 
-    return _index_group_or_org(data_dict, defer_commit)
+    return _prepare_group_or_org(data_dict)
 
 
-def index_organization(data_dict, defer_commit=DEFAULT_DEFER_COMMIT_VALUE):
+def index_group(data_dict, defer_commit=None):
+    return _send_to_solr(prepare_group(data_dict), defer_commit)
+
+
+def prepare_organization(data_dict):
+    """Return the document to index for the organization (modifies `data_dict`)"""
 
     if not data_dict:
         return
 
     data_dict["entity_type"] = "organization"
 
-    return _index_group_or_org(data_dict, defer_commit)
+    return _prepare_group_or_org(data_dict)
+
 
+def index_organization(data_dict, defer_commit=None):
+    return _send_to_solr(prepare_organization(data_dict), defer_commit)
 
-def index_user(data_dict, defer_commit=DEFAULT_DEFER_COMMIT_VALUE):
+
+def prepare_user(data_dict):
+    """Return the document to index for the user (modifies `data_dict`)"""
 
     if not data_dict:
         return
@@ -84,34 +149,32 @@ def index_user(data_dict, defer_commit=DEFAULT_DEFER_COMMIT_VALUE):
     )
 
     # Store full dict
-    data_dict["validated_data_dict"] = json.dumps(data_dict, cls=MissingNullEncoder)
+    _store_data_dict(data_dict)
 
-    # Created date
-    data_dict["metadata_created"] = _format_date(data_dict["created"])
+    # Stored title, so the autocomplete index doesn't need the full dict
+    data_dict["title"] = data_dict.get("display_name") or data_dict.get("fullname")
 
-    return _send_to_solr(data_dict, defer_commit)
+    wildcards.add_reversed_field(data_dict, "name", "fullname")
 
+    # Created date
+    data_dict["metadata_created"] = _format_date(data_dict["created"])
 
-def _sanitize_text_for_search(text):
+    return data_dict
 
-    # Remove HTML tags
-    text = strip_html_tags(text)
 
-    # Decode HTML entities
-    text = unescape(text)
+def index_user(data_dict, defer_commit=None):
+    return _send_to_solr(prepare_user(data_dict), defer_commit)
 
-    # Replace line breaks
-    for char in ("\r", "\n"):
-        text = text.replace(char, "")
 
-    # Replace tabs and spaces
-    for char in ("\xa0", "\t"):
-        text = text.replace(char, " ")
+def _sanitize_text_for_search(text):
 
-    return text
+    # Remove HTML tags, decode HTML entities and replace line breaks, tabs
+    # and non-breaking spaces
+    return sanitize_html_text(text)
 
 
-def index_page(data_dict, defer_commit=DEFAULT_DEFER_COMMIT_VALUE):
+def prepare_page(data_dict):
+    """Return the document to index for the page (modifies `data_dict`)"""
 
     if not data_dict:
         return
@@ -124,7 +187,7 @@ def index_page(data_dict, defer_commit=DEFAULT_DEFER_COMMIT_VALUE):
     data_dict["entity_type"] = "page"
 
     # Store full dict
-    data_dict["validated_data_dict"] = json.dumps(data_dict, cls=MissingNullEncoder)
+    _store_data_dict(data_dict)
 
     # Created and modified dates
     # Note that publish_date will also be indexed as date
@@ -144,6 +207,8 @@ def index_page(data_dict, defer_commit=DEFAULT_DEFER_COMMIT_VALUE):
     # Add string title field for sorting
     data_dict["title_string"] = data_dict.get("title")
 
+    wildcards.add_reversed_field(data_dict, "name", "title")
+
     # Permissions
     # The intent is to mimic ckanext-pages behaviour:
     # * If not org_id and private=True -> sysadmins only
@@ -152,10 +217,18 @@ def index_page(data_dict, defer_commit=DEFAULT_DEFER_COMMIT_VALUE):
     # See ckanext-pages auth.py module
     from ckanext.pages.db import Page
 
-    labels = []
     page = Page.get(name=data_dict["name"], group_id=data_dict.get("group_id"))
     if not page:
         raise toolkit.ObjectNotFound("Page not found: {}".format(data_dict["name"]))
+
+    data_dict["permission_labels"] = page_permission_labels(page)
+
+    return data_dict
+
+
+def page_permission_labels(page):
+    """Return the permission labels for a ckanext-pages `Page` object"""
+    labels = []
     if page.private:
         labels.append("sysadmin")
         if page.group_id:
@@ -163,12 +236,14 @@ def index_page(data_dict, defer_commit=DEFAULT_DEFER_COMMIT_VALUE):
     else:
         labels.append("public")
 
-    data_dict["permission_labels"] = labels
+    return labels
 
-    return _send_to_solr(data_dict, defer_commit)
 
+def index_page(data_dict, defer_commit=None):
+    return _send_to_solr(prepare_page(data_dict), defer_commit)
 
-def _index_group_or_org(data_dict, defer_commit):
+
+def _prepare_group_or_org(data_dict):
 
     data_dict = _check_mandatory_fields(data_dict)
 
@@ -178,7 +253,7 @@ def _index_group_or_org(data_dict, defer_commit):
     data_dict.pop("groups", None)
 
     # Store full dict
-    data_dict["validated_data_dict"] = json.dumps(data_dict, cls=MissingNullEncoder)
+    _store_data_dict(data_dict)
 
     # Store description in the notes field so it gets added to the default field
     data_dict["notes"] = data_dict["description"]
@@ -186,6 +261,8 @@ def _index_group_or_org(data_dict, defer_commit):
     # Add string title field for sorting
     data_dict["title_string"] = data_dict.get("title")
 
+    wildcards.add_reversed_field(data_dict, "name", "title")
+
     # Handle extras for each extra, add an `extra_{name}` text field
     # and a string `{name}` field (if not already in the schema)
 
@@ -208,114 +285,139 @@ def _index_group_or_org(data_dict, defer_commit):
 
     # No permission labels, all group and org metadata is public
 
-    return _send_to_solr(data_dict, defer_commit)
+    return data_dict
+
+
+preparers = {
+    "organization": prepare_organization,
+    "group": prepare_group,
+    "user": prepare_user,
+    "page": prepare_page,
+}
 
 
 def _send_to_solr(data_dict, defer_commit):
 
-    commit = not defer_commit
-    try:
-        conn = make_connection()
-        conn.add(docs=[data_dict], commit=commit)
-    except SolrError as e:
-        msg = "Solr returned an error: {0}".format(
-            e.args[0][:1000]  # limit huge responses
+    if not data_dict:
+        return
+
+    index_documents([data_dict], defer_commit)
+
+
+def index_documents(docs, defer_commit=None):
+    """Send documents returned by the `prepare_*` functions in one update"""
+
+    if not docs:
+        return
+
+    commit = not _get_defer_commit(defer_commit)
+    with metrics.timer("sitesearch.index", operation="add"):
+        get_backend().add(docs, commit=commit)
+
+    visible = _changes_visible(defer_commit)
+    autocomplete.update(docs, committed=visible)
+    if visible:
+        _start_generation()
+
+    commit_debug_msg = "Committed" if commit else "Not committed yet"
+    for doc in docs:
+        metrics.incr("sitesearch.index.docs", entity_type=doc.get("entity_type"))
+        log.debug(
+            "Updated index for {} [{}]".format(doc.get("name"), commit_debug_msg)
         )
-        raise SearchIndexError(msg)
-    except socket.error as e:
-        err = "Could not connect to Solr using {0}: {1}".format(conn.url, str(e))
-        log.error(err)
-        raise SearchIndexError(err)
-
-    commit_debug_msg = "Not committed yet" if defer_commit else "Committed"
-    log.debug(
-        "Updated index for {} [{}]".format(data_dict.get("name"), commit_debug_msg)
-    )
 
 
 def commit():
-    try:
-        conn = make_connection()
-        conn.commit(waitSearcher=False)
-        log.debug("Commited changes on the Solr index")
-    except SolrError as e:
-        log.exception(e)
-        raise SearchIndexError(e)
+    with metrics.timer("sitesearch.index", operation="commit"):
+        get_backend().commit()
+    # Deferred changes are only visible now
+    _start_generation()
+    log.debug("Commited changes on the search index")
+
 
+def commit_unless_deferred():
+    """Commit the pending changes, unless `ckan.search.solr_commit` is disabled
+
+    In that case they are committed by Solr's autoCommit.
+    """
+    if _get_defer_commit(None):
+        _start_generation()
+    else:
+        commit()
 
-def delete_group(id, defer_commit=DEFAULT_DEFER_COMMIT_VALUE):
+
+def delete_group(id, defer_commit=None):
     return _delete("group", id, defer_commit)
 
 
-def delete_organization(id, defer_commit=DEFAULT_DEFER_COMMIT_VALUE):
+def delete_organization(id, defer_commit=None):
     return _delete("organization", id, defer_commit)
 
 
-def delete_user(id, defer_commit=DEFAULT_DEFER_COMMIT_VALUE):
+def delete_user(id, defer_commit=None):
     return _delete("user", id, defer_commit)
 
 
-def _delete(entity_type, entity_id, defer_commit):
+def delete_page(id, defer_commit=None):
+    return _delete("page", id, defer_commit)
 
-    commit = not defer_commit
 
-    query = []
-    query.append("+entity_type:{}".format(entity_type))
+deleters = {
+    "organization": delete_organization,
+    "group": delete_group,
+    "user": delete_user,
+    "page": delete_page,
+}
 
-    query.append(
-        '+(id:"{entity_id}" OR name:"{entity_id}")'.format(entity_id=entity_id)
-    )
-    query.append('+site_id:"{}"'.format(toolkit.config.get("ckan.site_id")))
 
-    query = " AND ".join(query)
-    try:
-        conn = make_connection()
-        conn.delete(q=query, commit=commit)
-        log.debug("Deleted {} {} the Solr index".format(entity_type, entity_id))
-    except SolrError as e:
-        log.exception(e)
-        raise SearchIndexError(e)
+def _delete(entity_type, entity_id, defer_commit):
+
+    commit = not _get_defer_commit(defer_commit)
+
+    with metrics.timer("sitesearch.index", operation="delete"):
+        get_backend().delete(
+            entity_type, entity_id, toolkit.config.get("ckan.site_id"), commit=commit
+        )
+    visible = _changes_visible(defer_commit)
+    autocomplete.remove(entity_type, entity_id, committed=visible)
+    if visible:
+        _start_generation()
+    log.debug("Deleted {} {} from the search index".format(entity_type, entity_id))
 
 
-def clear_organizations(defer_commit=DEFAULT_DEFER_COMMIT_VALUE):
+def clear_organizations(defer_commit=None):
     _clear(entity_type="organization", defer_commit=defer_commit)
-    log.debug("Deleted all organizations from the Solr index")
+    log.debug("Deleted all organizations from the search index")
 
 
-def clear_groups(defer_commit=DEFAULT_DEFER_COMMIT_VALUE):
+def clear_groups(defer_commit=None):
     _clear(entity_type="group", defer_commit=defer_commit)
-    log.debug("Deleted all groups from the Solr index")
+    log.debug("Deleted all groups from the search index")
 
 
-def clear_users(defer_commit=DEFAULT_DEFER_COMMIT_VALUE):
+def clear_users(defer_commit=None):
     _clear(entity_type="user", defer_commit=defer_commit)
-    log.debug("Deleted all users from the Solr index")
+    log.debug("Deleted all users from the search index")
 
 
-def clear_all(defer_commit=DEFAULT_DEFER_COMMIT_VALUE):
+def clear_all(defer_commit=None):
     _clear(keep_datasets=False, defer_commit=defer_commit)
-    log.debug("Deleted all entities from the Solr index")
+    log.debug("Deleted all entities from the search index")
 
 
 def _clear(
-    entity_type=None, keep_datasets=True, defer_commit=DEFAULT_DEFER_COMMIT_VALUE
+    entity_type=None, keep_datasets=True, defer_commit=None
 ):
-    commit = not defer_commit
-
-    query = []
-
-    if entity_type:
-        query.append("+entity_type:{}".format(entity_type))
-
-    if keep_datasets:
-        query.append("-entity_type:package")
-
-    query.append("+site_id:{}".format(toolkit.config.get("ckan.site_id")))
-
-    query = " AND ".join(query)
-    try:
-        conn = make_connection()
-        conn.delete(q=query, commit=commit)
-    except SolrError as e:
-        log.exception(e)
-        raise SearchIndexError(e)
+    commit = not _get_defer_commit(defer_commit)
+
+    with metrics.timer("sitesearch.index", operation="clear"):
+        get_backend().clear(
+            toolkit.config.get("ckan.site_id"),
+            entity_type=entity_type,
+            keep_datasets=keep_datasets,
+            commit=commit,
+        )
+    visible = _changes_visible(defer_commit)
+    autocomplete.clear(committed=visible)
+    if visible:
+        _start_generation()
@@ -0,0 +1,53 @@
+import importlib
+
+
+class LazyFunction(object):
+    # Proxy for a function that is only imported when first used. Calls,
+    # the docstring (eg for `help_show`) and any other attribute not set on
+    # the proxy itself are read from the real function, so the attributes
+    # that CKAN inspects when registering actions and auth functions (eg
+    # `side_effect_free` or `chained_action`) are the ones set by their
+    # decorators.
+
+    def __init__(self, path):
+        module_name, function_name = path.split(":")
+        self._module_name = module_name
+        self._function = None
+        self.__name__ = function_name
+        self.__qualname__ = function_name
+        self.__module__ = module_name
+
+    def _resolve(self):
+        if self._function is None:
+            module = importlib.import_module(self._module_name)
+            function = getattr(module, self.__name__)
+            # CKAN copies the `__dict__` of chained actions to the partial
+            # functions it creates
+            for key, value in function.__dict__.items():
+                self.__dict__.setdefault(key, value)
+            self._function = function
+        return self._function
+
+    def __call__(self, *args, **kwargs):
+        return self._resolve()(*args, **kwargs)
+
+    def __getattr__(self, name):
+        # Only called for the attributes not found in the proxy
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self._resolve(), name)
+
+    @property
+    def __doc__(self):
+        return self._resolve().__doc__
+
+    def __repr__(self):
+        return "<lazy function {}:{}>".format(self._module_name, self.__name__)
+
+
+def lazy_function(path):
+    """Return a proxy for a function that is only imported when first used
+
+    `path` is in the form `module.name:function_name`.
+    """
+    return LazyFunction(path)
@@ -0,0 +1,137 @@
+"""
+Limits on the search parameters that make queries expensive
+
+`rows` is capped by the core `ckan.search.rows_max` setting, but the
+number of facet fields, `facet.limit` and `start` are not, and a single
+query with several unbounded facets or a deep page can keep a Solr core
+busy for seconds. `check_query` returns validation errors for the queries
+that go over these limits, which can be set for all search actions and
+overridden for each one of them:
+
+    ckanext.sitesearch.limits.max_start = 10000
+    ckanext.sitesearch.limits.user_search.max_start = 1000
+
+The limits are disabled by default (and with a value of -1), so existing
+clients don't start getting errors on upgrade. Recommended values are 10
+for `max_facet_fields`, 1000 for `max_facet_limit` (which also rejects the
+unbounded -1) and 10000 for `max_start`. `get_time_allowed` returns the
+time (in ms) after which Solr stops collecting results and returns the
+ones found so far, flagged as partial.
+
+Queries that are still expensive (see `querylog.query_flags`) can also be
+limited to a number of concurrent ones in each CKAN process with
+`admission`. Queries that can't start within the configured wait fail with
+a `QueryRejected` error instead of queueing up in Solr.
+"""
+import contextlib
+import threading
+
+from ckan.lib.search.common import SearchError
+from ckan.plugins import toolkit
+
+from ckanext.sitesearch.lib import metrics, querylog
+
+
+DEFAULT_LIMITS = {
+    "max_facet_fields": None,
+    "max_facet_limit": None,
+    "max_start": None,
+    "time_allowed": None,
+}
+
+DEFAULT_EXPENSIVE_WAIT = 1.0
+
+_semaphores = {}
+_semaphores_lock = threading.Lock()
+
+
+class QueryRejected(SearchError):
+    """The query is too expensive to run right now"""
+
+
+def get_limit(name, action_name=None):
+    """Return the value of a limit for an action, or None if disabled"""
+    keys = ["ckanext.sitesearch.limits.{}".format(name)]
+    if action_name:
+        keys.insert(0, "ckanext.sitesearch.limits.{}.{}".format(action_name, name))
+
+    value = DEFAULT_LIMITS[name]
+    for key in keys:
+        if toolkit.config.get(key) not in (None, ""):
+            value = toolkit.asint(toolkit.config.get(key))
+            break
+
+    return None if value is None or value < 0 else value
+
+
+def get_time_allowed(action_name=None):
+    return get_limit("time_allowed", action_name)
+
+
+def check_query(action_name, data_dict):
+    """Return a dict of errors for the parameters that go over the limits"""
+    errors = {}
+
+    max_facet_fields = get_limit("max_facet_fields", action_name)
+    facet_fields = data_dict.get("facet.field") or []
+    if max_facet_fields is not None and len(facet_fields) > max_facet_fields:
+        errors["facet.field"] = [
+            "Too many facet fields, the maximum is {}".format(max_facet_fields)
+        ]
+
+    max_facet_limit = get_limit("max_facet_limit", action_name)
+    facet_limit = data_dict.get("facet.limit")
+    if (
+        max_facet_limit is not None
+        and facet_limit is not None
+        and not 0 <= int(facet_limit) <= max_facet_limit
+    ):
+        errors["facet.limit"] = ["Must be between 0 and {}".format(max_facet_limit)]
+
+    max_start = get_limit("max_start", action_name)
+    if max_start is not None and int(data_dict.get("start") or 0) > max_start:
+        errors["start"] = ["Must be lower or equal to {}".format(max_start)]
+
+    return errors
+
+
+def _get_semaphore():
+    value = toolkit.config.get("ckanext.sitesearch.limits.expensive_queries")
+    max_queries = toolkit.asint(value) if value not in (None, "") else 0
+    if max_queries <= 0:
+        return None
+
+    with _semaphores_lock:
+        if max_queries not in _semaphores:
+            _semaphores[max_queries] = threading.BoundedSemaphore(max_queries)
+        return _semaphores[max_queries]
+
+
+@contextlib.contextmanager
+def admission(query, entity_type=None):
+    """
+    Run the block only if less than `ckanext.sitesearch.limits.expensive_queries`
+    expensive queries are running in this process, waiting up to
+    `ckanext.sitesearch.limits.expensive_queries_wait` seconds for one of
+    them to finish. Other queries are never limited.
+    """
+    semaphore = _get_semaphore()
+    if semaphore is None or not querylog.query_flags(query):
+        yield
+        return
+
+    wait = float(
+        toolkit.config.get(
+            "ckanext.sitesearch.limits.expensive_queries_wait", DEFAULT_EXPENSIVE_WAIT
+        )
+    )
+    if not semaphore.acquire(timeout=wait):
+        metrics.incr("sitesearch.query.rejected", entity_type=entity_type or "all")
+        raise QueryRejected(
+            "Too many expensive searches running at the same time (deep paging, "
+            "large facets or leading wildcards), please try again later"
+        )
+    try:
+        yield
+    finally:
+        semaphore.release()
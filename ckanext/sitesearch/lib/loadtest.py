@@ -0,0 +1,228 @@
+"""
+Load tests for the search actions
+
+Replays a mix of `site_search`, `organization_search`, `group_search`,
+`user_search` and `page_search` calls against the action layer (so
+including validation, auth checks and decoding of the results, but not
+the HTTP layer) from a number of concurrent threads, and reports the
+throughput, the latency percentiles and the error rate.
+
+The calls can be generated (`synthetic_calls`, with a fixed seed so the
+same calls are made each time) or taken from the sampled query log
+(`calls_from_query_log`, see `lib/querylog`). Run it against the same
+index and backend (eg a local Solr loaded with a snapshot) to compare
+the numbers across commits or config changes.
+"""
+import collections
+import contextlib
+import itertools
+import logging
+import random
+import threading
+import time
+
+from flask import current_app
+
+from ckan import model
+from ckan.plugins import plugin_loaded, toolkit
+
+from ckanext.sitesearch.lib.stats import percentile
+from ckanext.sitesearch.lib.warmup import read_query_log
+
+
+log = logging.getLogger(__name__)
+
+DEFAULT_REQUESTS = 1000
+
+DEFAULT_CONCURRENCY = 4
+
+# Relative weight of each action in the synthetic mix
+DEFAULT_MIX = {
+    "site_search": 1,
+    "organization_search": 3,
+    "group_search": 2,
+    "user_search": 1,
+    "page_search": 1,
+}
+
+TERMS = [
+    "*:*",
+    "*:*",
+    "data",
+    "open",
+    "water",
+    "health",
+    "transport",
+    "report",
+    "city council",
+    "stat*",
+]
+
+SORTS = {
+    "organization_search": ["title asc", "name asc"],
+    "group_search": ["title asc", "name asc"],
+    "user_search": ["fullname asc, name asc", "name asc"],
+    "page_search": ["publish_date desc, metadata_modified desc", "title asc"],
+}
+
+ENTITY_ACTIONS = {
+    "organization": "organization_search",
+    "group": "group_search",
+    "user": "user_search",
+    "page": "page_search",
+}
+
+
+def parse_mix(value):
+    """Parse a mix definition like `site_search=1,user_search=2`"""
+    mix = {}
+    for item in value.split(","):
+        action, _, weight = item.partition("=")
+        action = action.strip()
+        if action not in DEFAULT_MIX:
+            raise ValueError("Unknown search action: {}".format(action))
+        try:
+            mix[action] = float(weight) if weight else 1.0
+        except ValueError:
+            raise ValueError("Invalid weight for {}: {}".format(action, weight))
+    return mix
+
+
+def synthetic_calls(count=DEFAULT_REQUESTS, mix=None, seed=0):
+    """Return a list of `(action_name, data_dict)` search calls"""
+    mix = dict(mix or DEFAULT_MIX)
+    if not plugin_loaded("pages"):
+        mix.pop("page_search", None)
+    actions = sorted(mix)
+    weights = [mix[action] for action in actions]
+
+    rnd = random.Random(seed)
+    calls = []
+    for _ in range(count):
+        action = rnd.choices(actions, weights)[0]
+        data_dict = {"q": rnd.choice(TERMS), "rows": rnd.choice([10, 20, 20, 50])}
+        if rnd.random() < 0.2:
+            data_dict["start"] = rnd.choice([20, 100])
+        if action in SORTS and rnd.random() < 0.3:
+            data_dict["sort"] = rnd.choice(SORTS[action])
+        calls.append((action, data_dict))
+    return calls
+
+
+def calls_from_query_log(path, count=DEFAULT_REQUESTS):
+    """Return a list of `(action_name, data_dict)` search calls
+
+    The queries in the log are replayed in the same order, repeating them
+    if there are less than `count`.
+    """
+    calls = []
+    for entry in read_query_log(path):
+        action = ENTITY_ACTIONS.get(entry.get("entity_type"))
+        if not action:
+            continue
+        data_dict = dict(entry["params"])
+        # Normalised queries have all filters in a list
+        fq = data_dict.pop("fq", [])
+        if len(fq) == 1:
+            data_dict["fq"] = fq[0]
+        elif fq:
+            data_dict["fq"] = " AND ".join("({})".format(f) for f in fq)
+        calls.append((action, data_dict))
+
+    if not calls:
+        raise ValueError("No queries found in {}".format(path))
+
+    return list(itertools.islice(itertools.cycle(calls), count))
+
+
+def _latency_stats(latencies):
+    return {
+        "mean": sum(latencies) / len(latencies) if latencies else 0,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "max": max(latencies) if latencies else 0,
+    }
+
+
+def run(calls, concurrency=DEFAULT_CONCURRENCY, user=None):
+    """Make the search calls from `concurrency` threads
+
+    Calls are made as `user` (by default the site user, which is allowed
+    to run all searches). Returns a dict with the throughput (calls per
+    second), latencies (in ms) and errors, overall and for each action.
+    """
+    if user is None:
+        user = toolkit.get_action("get_site_user")({"ignore_auth": True}, {})["name"]
+
+    try:
+        app = current_app._get_current_object()
+    except RuntimeError:
+        app = None
+
+    pending = iter(calls)
+    lock = threading.Lock()
+    results = []
+
+    def worker():
+        request_context = app.test_request_context() if app else contextlib.ExitStack()
+        with request_context:
+            try:
+                while True:
+                    with lock:
+                        call = next(pending, None)
+                    if call is None:
+                        return
+                    action_name, data_dict = call
+                    error = None
+                    start = time.perf_counter()
+                    try:
+                        toolkit.get_action(action_name)({"user": user}, dict(data_dict))
+                    except Exception as e:
+                        # Any failure counts as an error, the run goes on
+                        error = type(e).__name__
+                    latency = (time.perf_counter() - start) * 1000
+                    results.append((action_name, latency, error))
+            finally:
+                model.Session.remove()
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.perf_counter() - start
+
+    by_action = collections.defaultdict(list)
+    for action_name, latency, error in results:
+        by_action[action_name].append((latency, error))
+
+    errors = collections.Counter(error for _, _, error in results if error)
+    total = len(results)
+    report = {
+        "requests": total,
+        "concurrency": concurrency,
+        "duration": duration,
+        "throughput": total / duration if duration else 0,
+        "errors": sum(errors.values()),
+        "error_rate": sum(errors.values()) / float(total) if total else 0,
+        "error_types": dict(errors),
+        "latency": _latency_stats([latency for _, latency, _ in results]),
+        "actions": {},
+    }
+    for action_name, items in sorted(by_action.items()):
+        action_errors = len([error for _, error in items if error])
+        report["actions"][action_name] = {
+            "requests": len(items),
+            "errors": action_errors,
+            "error_rate": action_errors / float(len(items)),
+            "latency": _latency_stats([latency for latency, _ in items]),
+        }
+
+    log.info(
+        "{} requests in {:.2f}s ({:.1f}/s), {} errors".format(
+            total, duration, report["throughput"], report["errors"]
+        )
+    )
+    return report
@@ -0,0 +1,408 @@
+"""
+Timers and counters for the search actions and index operations
+
+Metrics are sent to the sink configured in `ckanext.sitesearch.metrics.sink`:
+
+* `none` (default): metrics are discarded.
+* `memory`: metrics are kept in memory as lists of raw values. Useful for
+  tests.
+* `statsd`: metrics are sent via UDP to a statsd server
+  (`ckanext.sitesearch.metrics.statsd_host`,
+  `ckanext.sitesearch.metrics.statsd_port` and
+  `ckanext.sitesearch.metrics.statsd_prefix`).
+* `prometheus`: metrics are aggregated in memory as histograms and counters
+  and exposed in the Prometheus text format at `/sitesearch/metrics`. Each
+  process only exposes its own metrics, so when CKAN runs several worker
+  processes, install `prometheus_client` and set the
+  `PROMETHEUS_MULTIPROC_DIR` environment variable to use its multiprocess
+  mode, which aggregates the metrics of all the processes (see
+  `MultiprocessPrometheusSink`), or use `statsd`.
+
+Metric names are dotted strings (eg `sitesearch.query.latency`), with
+optional tags (eg `entity_type=organization`). Timings are in milliseconds.
+The following metrics are reported:
+
+* `sitesearch.action.latency`, `sitesearch.action.errors` (`action`): search
+  actions.
+* `sitesearch.query.latency`, `sitesearch.query.errors` (`entity_type`):
+  queries sent to the backend.
+* `sitesearch.query.qtime` (`entity_type`): query time reported by Solr.
+* `sitesearch.query.results` (`entity_type`): number of results returned.
+* `sitesearch.query.rejected` (`entity_type`): expensive queries rejected
+  by the concurrency limit (see `lib/limits`).
+* `sitesearch.decode.latency` (`entity_type`): time spent decoding the
+  stored `validated_data_dict` of the results.
+* `sitesearch.hydrate.latency` (`entity_type`): database queries used to
+  build the results when using thin documents.
+* `sitesearch.hydrate.cache_hits`: results of thin documents found in the
+  hydration cache.
+* `sitesearch.index.latency`, `sitesearch.index.errors` (`operation`): add,
+  delete, clear and commit operations.
+* `sitesearch.index.docs` (`entity_type`): number of documents indexed.
+* `sitesearch.hook.latency`, `sitesearch.hook.errors` (`action`): time spent
+  updating the index in the chained actions, excluding the core action.
+"""
+import functools
+import logging
+import os
+import socket
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from ckan.plugins import toolkit
+
+try:
+    import prometheus_client
+    from prometheus_client import multiprocess as prometheus_multiprocess
+except ImportError:
+    prometheus_client = prometheus_multiprocess = None
+
+
+log = logging.getLogger(__name__)
+
+
+DEFAULT_SINK = "none"
+
+LATENCY_BUCKETS = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+SIZE_BUCKETS = (0, 1, 5, 10, 20, 50, 100, 250, 500, 1000, 5000)
+
+
+class NullSink(object):
+    """Discards all metrics"""
+
+    def timing(self, name, value, tags):
+        pass
+
+    def incr(self, name, value, tags):
+        pass
+
+    def observe(self, name, value, tags):
+        pass
+
+
+class MemorySink(NullSink):
+    """Keeps all the reported values in memory"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.timings = defaultdict(list)
+        self.counters = defaultdict(int)
+        self.observations = defaultdict(list)
+
+    def timing(self, name, value, tags):
+        with self._lock:
+            self.timings[_key(name, tags)].append(value)
+
+    def incr(self, name, value, tags):
+        with self._lock:
+            self.counters[_key(name, tags)] += value
+
+    def observe(self, name, value, tags):
+        with self._lock:
+            self.observations[_key(name, tags)].append(value)
+
+
+class StatsdSink(NullSink):
+    """Sends metrics to a statsd server, tag values are added to the name"""
+
+    def __init__(self):
+        self.host = toolkit.config.get(
+            "ckanext.sitesearch.metrics.statsd_host", "localhost"
+        )
+        self.port = toolkit.asint(
+            toolkit.config.get("ckanext.sitesearch.metrics.statsd_port", 8125)
+        )
+        self.prefix = toolkit.config.get("ckanext.sitesearch.metrics.statsd_prefix")
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _send(self, name, value, metric_type, tags):
+        parts = [self.prefix] if self.prefix else []
+        parts.append(name)
+        parts.extend(str(v).replace(".", "_") for _, v in sorted(tags.items()))
+        message = "{}:{}|{}".format(".".join(parts), value, metric_type)
+        try:
+            self._socket.sendto(message.encode("utf-8"), (self.host, self.port))
+        except socket.error as e:
+            log.debug("Could not send metric to statsd: {}".format(e))
+
+    def timing(self, name, value, tags):
+        self._send(name, "{:.3f}".format(value), "ms", tags)
+
+    def incr(self, name, value, tags):
+        self._send(name, value, "c", tags)
+
+    def observe(self, name, value, tags):
+        self._send(name, value, "h", tags)
+
+
+class PrometheusSink(NullSink):
+    """Aggregates metrics as Prometheus histograms and counters"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        # {name: {tags: [bucket_counts, sum, count]}}
+        self.histograms = defaultdict(dict)
+        self.buckets = {}
+        # {name: {tags: value}}
+        self.counters = defaultdict(lambda: defaultdict(int))
+
+    def _observe(self, name, value, tags, buckets):
+        labels = tuple(sorted(tags.items()))
+        with self._lock:
+            self.buckets.setdefault(name, buckets)
+            series = self.histograms[name].setdefault(
+                labels, [[0] * len(buckets), 0, 0]
+            )
+            for i, upper in enumerate(buckets):
+                if value <= upper:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def timing(self, name, value, tags):
+        self._observe(name + ".ms", value, tags, LATENCY_BUCKETS)
+
+    def observe(self, name, value, tags):
+        self._observe(name, value, tags, SIZE_BUCKETS)
+
+    def incr(self, name, value, tags):
+        with self._lock:
+            self.counters[name + ".total"][tuple(sorted(tags.items()))] += value
+
+    def render(self):
+        """Return all metrics in the Prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            for name, series in sorted(self.histograms.items()):
+                metric = _prometheus_name(name)
+                lines.append("# TYPE {} histogram".format(metric))
+                for labels, (bucket_counts, total, count) in sorted(series.items()):
+                    for upper, bucket_count in zip(self.buckets[name], bucket_counts):
+                        lines.append(
+                            "{}_bucket{} {}".format(
+                                metric,
+                                _prometheus_labels(labels + (("le", upper),)),
+                                bucket_count,
+                            )
+                        )
+                    lines.append(
+                        "{}_bucket{} {}".format(
+                            metric, _prometheus_labels(labels + (("le", "+Inf"),)), count
+                        )
+                    )
+                    lines.append(
+                        "{}_sum{} {}".format(metric, _prometheus_labels(labels), total)
+                    )
+                    lines.append(
+                        "{}_count{} {}".format(metric, _prometheus_labels(labels), count)
+                    )
+            for name, series in sorted(self.counters.items()):
+                metric = _prometheus_name(name)
+                lines.append("# TYPE {} counter".format(metric))
+                for labels, value in sorted(series.items()):
+                    lines.append(
+                        "{}{} {}".format(metric, _prometheus_labels(labels), value)
+                    )
+        return "\n".join(lines) + "\n"
+
+
+class MultiprocessPrometheusSink(NullSink):
+    """
+    Stores metrics with the multiprocess mode of `prometheus_client`
+
+    Each process writes its values to files in the `PROMETHEUS_MULTIPROC_DIR`
+    folder, and `render` aggregates the ones of all processes. The folder
+    should be emptied when CKAN starts, and processes that exit marked as
+    dead (eg with `prometheus_client.multiprocess.mark_process_dead` in the
+    gunicorn `child_exit` hook), see the `prometheus_client` docs.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # {(type, name, label names): metric}
+        self._metrics = {}
+
+    def _metric(self, metric_class, name, tags, **kwargs):
+        labelnames = tuple(sorted(tags))
+        key = (metric_class, name, labelnames)
+        with self._lock:
+            if key not in self._metrics:
+                # Not registered, values are collected from the files
+                self._metrics[key] = metric_class(
+                    _prometheus_name(name),
+                    name,
+                    labelnames=labelnames,
+                    registry=None,
+                    **kwargs
+                )
+        metric = self._metrics[key]
+        return metric.labels(**{k: str(v) for k, v in tags.items()}) if tags else metric
+
+    def timing(self, name, value, tags):
+        self._metric(
+            prometheus_client.Histogram, name + ".ms", tags, buckets=LATENCY_BUCKETS
+        ).observe(value)
+
+    def observe(self, name, value, tags):
+        self._metric(
+            prometheus_client.Histogram, name, tags, buckets=SIZE_BUCKETS
+        ).observe(value)
+
+    def incr(self, name, value, tags):
+        # The `_total` suffix is added by the counter
+        self._metric(prometheus_client.Counter, name, tags).inc(value)
+
+    def render(self):
+        registry = prometheus_client.CollectorRegistry()
+        prometheus_multiprocess.MultiProcessCollector(registry)
+        return prometheus_client.generate_latest(registry).decode("utf-8")
+
+
+def _prometheus_multiproc_dir():
+    return os.environ.get("PROMETHEUS_MULTIPROC_DIR") or os.environ.get(
+        "prometheus_multiproc_dir"
+    )
+
+
+def _prometheus_sink():
+    """Use the multiprocess mode of `prometheus_client` if it is set up"""
+    if not _prometheus_multiproc_dir():
+        return PrometheusSink()
+    if prometheus_client is None:
+        log.warning(
+            "PROMETHEUS_MULTIPROC_DIR is set but prometheus_client is not "
+            "installed, metrics will only include the ones of each process"
+        )
+        return PrometheusSink()
+    return MultiprocessPrometheusSink()
+
+
+sinks = {
+    "none": NullSink,
+    "memory": MemorySink,
+    "statsd": StatsdSink,
+    "prometheus": _prometheus_sink,
+}
+
+_instances = {}
+
+
+def _key(name, tags):
+    if not tags:
+        return name
+    return "{}[{}]".format(
+        name, ",".join("{}={}".format(k, v) for k, v in sorted(tags.items()))
+    )
+
+
+def _prometheus_name(name):
+    return name.replace(".", "_").replace("-", "_")
+
+
+def _prometheus_labels(labels):
+    if not labels:
+        return ""
+    return "{{{}}}".format(
+        ",".join(
+            '{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+            for k, v in labels
+        )
+    )
+
+
+def get_sink():
+    """Return the sink configured in `ckanext.sitesearch.metrics.sink`"""
+    name = toolkit.config.get("ckanext.sitesearch.metrics.sink", DEFAULT_SINK)
+    if name not in sinks:
+        raise RuntimeError("Unknown sitesearch metrics sink: {}".format(name))
+    if name not in _instances:
+        _instances[name] = sinks[name]()
+    return _instances[name]
+
+
+def timing(name, value, **tags):
+    get_sink().timing(name, value, tags)
+
+
+def incr(name, value=1, **tags):
+    get_sink().incr(name, value, tags)
+
+
+def observe(name, value, **tags):
+    get_sink().observe(name, value, tags)
+
+
+@contextmanager
+def timer(name, **tags):
+    """
+    Report the time spent in the block as `<name>.latency`, and count
+    exceptions raised as `<name>.errors`
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        incr(name + ".errors", error=type(e).__name__, **tags)
+        raise
+    finally:
+        timing(name + ".latency", (time.perf_counter() - start) * 1000, **tags)
+
+
+def timed_action(func):
+    """Time a search action, using its name as tag"""
+
+    @functools.wraps(func)
+    def wrapper(context, data_dict):
+        with timer("sitesearch.action", action=func.__name__):
+            return func(context, data_dict)
+
+    return wrapper
+
+
+def timed_hook(func):
+    """
+    Time a chained action, excluding the time spent in the action it wraps
+
+    The result is the time spent updating the index after the core action.
+    """
+
+    @functools.wraps(func)
+    def wrapper(up_func, context, data_dict):
+        core = {"time": 0, "failed": False}
+
+        def timed_up_func(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return up_func(*args, **kwargs)
+            except Exception:
+                core["failed"] = True
+                raise
+            finally:
+                core["time"] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        try:
+            return func(timed_up_func, context, data_dict)
+        except Exception as e:
+            # Errors in the core action are not index errors
+            if not core["failed"]:
+                incr(
+                    "sitesearch.hook.errors",
+                    action=func.__name__,
+                    error=type(e).__name__,
+                )
+            raise
+        finally:
+            elapsed = time.perf_counter() - start - core["time"]
+            timing("sitesearch.hook.latency", elapsed * 1000, action=func.__name__)
+
+    return wrapper
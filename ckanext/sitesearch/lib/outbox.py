@@ -0,0 +1,187 @@
+"""
+Transactional outbox for the index updates
+
+When `ckanext.sitesearch.index_mode` is set to `outbox`, the chained
+actions don't update the search index directly. Instead they store a row
+for each affected entity in the `sitesearch_outbox` table, in the same
+database transaction as the change to the entity itself (see
+`lib/dirty.py`). The relay (`ckan sitesearch outbox relay`, or the
+background job enqueued after each action if
+`ckanext.sitesearch.outbox.relay_job` is enabled) reads the rows in
+batches, reindexes or deletes each entity once, sends the documents in a
+single update and deletes the rows it processed.
+
+Each batch is claimed in a short transaction, marking its rows with the
+time they were claimed, so no locks are held while the search backend is
+updated. Rows claimed by a relay that didn't finish (eg because the
+process was killed) are claimed again after
+`ckanext.sitesearch.outbox.claim_timeout` seconds.
+
+If the relay fails to send the update, the rows are kept and processed
+again later, so every change is indexed at least once.
+"""
+import datetime
+import logging
+import time
+from collections import OrderedDict
+
+from sqlalchemy import func, or_, select
+
+from ckan import model
+from ckan.plugins import toolkit
+
+from ckanext.sitesearch import db
+
+
+log = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 500
+
+DEFAULT_RELAY_INTERVAL = 5
+
+DEFAULT_CLAIM_TIMEOUT = 300
+
+
+def _site_id():
+    return toolkit.config.get("ckan.site_id")
+
+
+def write(entity_type, entity_id, operation="index"):
+    """Add a row to the outbox using the current database session
+
+    The row is only stored when the session is committed, so it is part
+    of the same transaction as the changes done by the action.
+    """
+    db.check_table(db.outbox_table)
+    model.Session.execute(
+        db.outbox_table.insert().values(
+            entity_type=entity_type,
+            entity_id=entity_id,
+            site_id=_site_id(),
+            operation=operation,
+        )
+    )
+
+
+def pending_count():
+    table = db.outbox_table
+    db.check_table(table)
+    with model.meta.engine.connect() as conn:
+        return conn.execute(
+            select([func.count()]).where(table.c.site_id == _site_id())
+        ).scalar()
+
+
+def relay_batch(batch_size=DEFAULT_BATCH_SIZE):
+    """Process the oldest `batch_size` rows in the outbox
+
+    Rows claimed by another relay running at the same time are skipped.
+    Returns the number of rows processed.
+    """
+    # Imported here to avoid a circular import, `dirty` writes to the outbox
+    from ckanext.sitesearch.lib import dirty
+
+    table = db.outbox_table
+    db.check_table(table)
+
+    rows = _claim_batch(batch_size)
+    if not rows:
+        return 0
+    ids = [row["id"] for row in rows]
+
+    # The last operation for each entity wins
+    entities = OrderedDict()
+    for row in rows:
+        key = (row["entity_type"], row["entity_id"])
+        entities.pop(key, None)
+        entities[key] = (row["operation"], None)
+
+    try:
+        # Errors with particular entities are recorded as failures, but if
+        # the update can't be sent at all the rows are kept for next time
+        dirty.process(entities, raise_on_send_error=True)
+    except Exception:
+        with model.meta.engine.begin() as conn:
+            conn.execute(table.update().where(table.c.id.in_(ids)).values(claimed=None))
+        raise
+
+    with model.meta.engine.begin() as conn:
+        conn.execute(table.delete().where(table.c.id.in_(ids)))
+
+    log.debug("Relayed {} outbox rows ({} entities)".format(len(rows), len(entities)))
+    return len(rows)
+
+
+def _claim_batch(batch_size):
+    """Mark the oldest `batch_size` unclaimed rows as claimed and return them
+
+    Rows locked by another relay claiming them at the same time are skipped.
+    """
+    table = db.outbox_table
+    now = datetime.datetime.utcnow()
+    expired = now - datetime.timedelta(
+        seconds=toolkit.asint(
+            toolkit.config.get(
+                "ckanext.sitesearch.outbox.claim_timeout", DEFAULT_CLAIM_TIMEOUT
+            )
+        )
+    )
+    with model.meta.engine.begin() as conn:
+        rows = conn.execute(
+            select([table])
+            .where(table.c.site_id == _site_id())
+            .where(or_(table.c.claimed.is_(None), table.c.claimed < expired))
+            .order_by(table.c.id)
+            .limit(batch_size)
+            .with_for_update(skip_locked=True)
+        ).fetchall()
+        if rows:
+            conn.execute(
+                table.update()
+                .where(table.c.id.in_([row["id"] for row in rows]))
+                .values(claimed=now)
+            )
+    return rows
+
+
+def relay(batch_size=DEFAULT_BATCH_SIZE, max_batches=None):
+    """Process the outbox until it is empty (or `max_batches` are processed)
+
+    Returns the number of rows processed.
+    """
+    processed = batches = 0
+    while max_batches is None or batches < max_batches:
+        count = relay_batch(batch_size)
+        if not count:
+            break
+        processed += count
+        batches += 1
+    return processed
+
+
+def relay_forever(batch_size=DEFAULT_BATCH_SIZE, interval=DEFAULT_RELAY_INTERVAL):
+    """Keep relaying the outbox, waiting `interval` seconds when it is empty"""
+    while True:
+        try:
+            relay(batch_size)
+        except Exception:
+            log.exception("Error while relaying the outbox")
+        time.sleep(interval)
+
+
+def relay_job():
+    """Background job that processes the outbox"""
+    relay()
+
+
+def enqueue_relay_job():
+    """Enqueue the relay background job, if enabled in the config"""
+    if not toolkit.asbool(
+        toolkit.config.get("ckanext.sitesearch.outbox.relay_job", False)
+    ):
+        return
+    kwargs = {"title": "sitesearch outbox relay"}
+    queue = toolkit.config.get("ckanext.sitesearch.outbox.queue")
+    if queue:
+        kwargs["queue"] = queue
+    toolkit.enqueue_job(relay_job, **kwargs)
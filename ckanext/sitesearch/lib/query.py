@@ -1,55 +1,48 @@
 import logging
-
-from pysolr import SolrError
+import time
 
 from ckan.plugins import toolkit
-from ckan.lib.search.common import SearchError, SearchQueryError, make_connection
-from ckan.lib.search.query import VALID_SOLR_PARAMETERS, solr_literal
-
-
-log = logging.getLogger(__name__)
-
+from ckan.lib.search.common import SearchError, SearchQueryError
+from ckan.lib.search.query import VALID_SOLR_PARAMETERS
 
-def query_organizations(query):
+from ckanext.sitesearch.lib import limits, metrics, querylog, wildcards
+from ckanext.sitesearch.lib.backends import get_backend
 
-    if not query.get("fq_list"):
-        query["fq_list"] = []
-    query["fq_list"].append("entity_type:organization")
 
-    return _run_query(query)
+log = logging.getLogger(__name__)
 
 
-def query_groups(query):
+def query_organizations(query, decode=None):
 
-    if not query.get("fq_list"):
-        query["fq_list"] = []
-    query["fq_list"].append("entity_type:group")
+    return _run_query(query, entity_type="organization", decode=decode)
 
-    return _run_query(query)
 
+def query_groups(query, decode=None):
 
-def query_users(query):
+    return _run_query(query, entity_type="group", decode=decode)
 
-    if not query.get("fq_list"):
-        query["fq_list"] = []
-    query["fq_list"].append("entity_type:user")
 
-    return _run_query(query)
+def query_users(query, decode=None):
 
+    return _run_query(query, entity_type="user", decode=decode)
 
-def query_pages(query, permission_labels=None):
 
-    if not query.get("fq_list"):
-        query["fq_list"] = []
-    query["fq_list"].append("entity_type:page")
+def query_pages(query, permission_labels=None, decode=None):
 
     if not permission_labels:
         permission_labels = ["public"]
 
-    return _run_query(query, permission_labels=permission_labels)
+    return _run_query(
+        query, entity_type="page", permission_labels=permission_labels, decode=decode
+    )
+
 
+def check_query(query):
+    """Validate the query and rewrite it for the backend (modifies `query`)
 
-def _run_query(query, permission_labels=None):
+    Returns a copy of the query before the wildcard terms are rewritten,
+    ie as sent by the user, for the query logs.
+    """
 
     # Check that query keys are valid
     if not set(query.keys()) <= VALID_SOLR_PARAMETERS:
@@ -63,43 +56,69 @@ def _run_query(query, permission_labels=None):
     if query["q"].startswith("{!"):
         raise SearchError("Local parameters are not supported.")
 
-    fq = []
-    if "fq" in query:
-        fq.append(query["fq"])
-    fq.extend(query.get("fq_list", []))
+    if not query.get("fq_list"):
+        query["fq_list"] = []
 
-    # Show only results from this CKAN instance
-    fq.append("+site_id:{}".format(solr_literal(toolkit.config.get("ckan.site_id"))))
+    user_query = dict(query)
 
-    if permission_labels is not None:
-        fq.append(
-            "+permission_labels:(%s)"
-            % " OR ".join(solr_literal(p) for p in permission_labels)
-        )
+    # Rewrite or reject the terms with leading wildcards, if configured
+    query["q"] = wildcards.rewrite_query(query["q"])
 
-    query["fq"] = fq
+    return user_query
 
-    query.setdefault("wt", "json")
 
-    query.setdefault("df", "text")
-    query.setdefault("q.op", "AND")
+def count_entity_types(query, entity_types, permission_labels=None):
+    """Return the number of results for each entity type, without fetching them
 
-    conn = make_connection(decode_dates=False)
-    log.debug("Sent Solr query: {}".format(query))
-    try:
-        solr_response = conn.search(**query)
-    except SolrError as e:
-        raise SearchError(
-            "SOLR returned an error running query: %r Error: %r" % (query, e)
+    `permission_labels` only apply to pages (and default to public ones).
+    """
+    check_query(query)
+
+    if "page" in entity_types and not permission_labels:
+        permission_labels = ["public"]
+
+    with limits.admission(query, "counts"), metrics.timer(
+        "sitesearch.query", entity_type="counts"
+    ):
+        return get_backend().count(
+            query,
+            entity_types,
+            site_id=toolkit.config.get("ckan.site_id"),
+            permission_labels=permission_labels,
         )
 
-    # Covert facets from lists to dicts
-    facets = solr_response.facets.get("facet_fields", {})
-    for field, values in facets.items():
-        facets[field] = dict(zip(values[0::2], values[1::2]))
 
-    return {
-        "count": solr_response.hits,
-        "results": solr_response.docs,
-        "facets": facets,
-    }
+def _run_query(query, entity_type=None, permission_labels=None, decode=None):
+
+    # Backends can modify the query too, keep the original for the logs
+    original_query = check_query(query)
+
+    tags = {"entity_type": entity_type or "all"}
+    start = time.perf_counter()
+    with limits.admission(dict(query), entity_type), metrics.timer(
+        "sitesearch.query", **tags
+    ):
+        result = get_backend().search(
+            query,
+            entity_type=entity_type,
+            # Show only results from this CKAN instance
+            site_id=toolkit.config.get("ckan.site_id"),
+            permission_labels=permission_labels,
+            decode=decode,
+        )
+    wall_time = (time.perf_counter() - start) * 1000
+
+    querylog.log_slow_query(
+        original_query,
+        entity_type,
+        permission_labels,
+        wall_time,
+        qtime=result.get("qtime"),
+    )
+    querylog.log_sampled_query(original_query, entity_type, permission_labels)
+
+    if result.get("qtime") is not None:
+        metrics.timing("sitesearch.query.qtime", result["qtime"], **tags)
+    metrics.observe("sitesearch.query.results", len(result["results"]), **tags)
+
+    return result
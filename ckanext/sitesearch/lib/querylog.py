@@ -0,0 +1,188 @@
+"""
+Logging of the queries sent to the search backend
+
+Queries that take longer than `ckanext.sitesearch.slow_query.threshold`
+milliseconds are logged to the `ckanext.sitesearch.slow_queries` logger, and
+optionally to a rotating file (`ckanext.sitesearch.slow_query.file`). Each
+entry is a JSON object with the normalised query parameters and the
+features that usually make a query expensive (deep paging, unbounded
+facets, leading wildcards).
+
+A sample of all queries (`ckanext.sitesearch.query_log.sample_rate`, from 0
+to 1) can also be logged to the `ckanext.sitesearch.queries` logger and
+file (`ckanext.sitesearch.query_log.file`), with the parameters needed to
+replay them when warming up the search caches (see `lib/warmup`).
+"""
+import json
+import logging
+import random
+import re
+import threading
+from logging.handlers import RotatingFileHandler
+
+from ckan.plugins import toolkit
+
+slow_query_log = logging.getLogger("ckanext.sitesearch.slow_queries")
+
+sampled_query_log = logging.getLogger("ckanext.sitesearch.queries")
+
+DEFAULT_MAX_BYTES = 10 * 1024 * 1024
+
+DEFAULT_BACKUP_COUNT = 5
+
+DEEP_PAGING_START = 1000
+
+MAX_BOUNDED_FACET_LIMIT = 1000
+
+LEADING_WILDCARD_RE = re.compile(r"(^|[\s:(])[*?]\w")
+
+# Parameters that are not relevant for the shape of the query
+IGNORED_PARAMS = ("wt", "df", "q.op")
+
+_file_handlers = {}
+_file_handler_lock = threading.Lock()
+
+
+def normalize_query(query):
+    """
+    Return a copy of the query parameters that doesn't depend on the order
+    of the keys or list items, so equivalent queries compare equal
+    """
+    normalized = {}
+    for key, value in query.items():
+        if key in IGNORED_PARAMS or value in (None, "", []):
+            continue
+        if key in ("fq", "fq_list"):
+            value = [value] if isinstance(value, str) else value
+            normalized["fq"] = sorted(set(normalized.get("fq", []) + list(value)))
+            continue
+        if isinstance(value, (list, tuple)):
+            value = sorted(str(v) for v in value)
+        elif isinstance(value, str):
+            value = " ".join(value.split())
+        normalized[key] = value
+    return dict(sorted(normalized.items()))
+
+
+def query_flags(query):
+    """Return a list of features that make a query expensive"""
+    flags = []
+
+    try:
+        start = int(query.get("start") or 0)
+    except (TypeError, ValueError):
+        start = 0
+    if start >= DEEP_PAGING_START:
+        flags.append("deep_paging")
+
+    facet_fields = query.get("facet.field") or []
+    if facet_fields:
+        try:
+            facet_limit = int(query.get("facet.limit", 0))
+        except (TypeError, ValueError):
+            facet_limit = 0
+        if facet_limit < 0 or facet_limit > MAX_BOUNDED_FACET_LIMIT:
+            flags.append("unbounded_facets")
+
+    if LEADING_WILDCARD_RE.search(query.get("q") or ""):
+        flags.append("leading_wildcard")
+
+    return flags
+
+
+def _setup_file_handler(logger, prefix, level=logging.WARNING):
+    """Add a rotating file handler to `logger`, if `{prefix}.file` is set
+
+    The handler gets the records of `level` and above. If the logging
+    config does not set a level for `logger` itself, it is lowered to
+    `level` so the records reach the handler.
+    """
+    path = toolkit.config.get(prefix + ".file")
+    if not path or logger.name in _file_handlers:
+        return
+
+    with _file_handler_lock:
+        if logger.name in _file_handlers:
+            return
+        handler = RotatingFileHandler(
+            path,
+            maxBytes=toolkit.asint(
+                toolkit.config.get(prefix + ".max_bytes", DEFAULT_MAX_BYTES)
+            ),
+            backupCount=toolkit.asint(
+                toolkit.config.get(prefix + ".backup_count", DEFAULT_BACKUP_COUNT)
+            ),
+        )
+        handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+        handler.setLevel(level)
+        logger.addHandler(handler)
+        if logger.level == logging.NOTSET and logger.getEffectiveLevel() > level:
+            logger.setLevel(level)
+        _file_handlers[logger.name] = handler
+
+
+def get_slow_query_threshold():
+    """Return the slow query threshold in ms, or None if disabled"""
+    threshold = toolkit.config.get("ckanext.sitesearch.slow_query.threshold")
+    if threshold in (None, ""):
+        return None
+    return toolkit.asint(threshold)
+
+
+def log_slow_query(query, entity_type, permission_labels, wall_time, qtime=None):
+    """
+    Log the query if it took longer than the configured threshold
+
+    `query` should be the query parameters as received by `_run_query`,
+    and `wall_time` and `qtime` are in ms.
+    """
+    threshold = get_slow_query_threshold()
+    if threshold is None or wall_time < threshold:
+        return
+
+    _setup_file_handler(slow_query_log, "ckanext.sitesearch.slow_query")
+
+    facet_fields = query.get("facet.field") or []
+    if isinstance(facet_fields, str):
+        facet_fields = [facet_fields]
+    entry = {
+        "entity_type": entity_type,
+        "wall_time": round(wall_time, 2),
+        "qtime": qtime,
+        "permission_labels": len(permission_labels or []),
+        "rows": query.get("rows"),
+        "start": query.get("start"),
+        "facet_fields": sorted(facet_fields),
+        "facet_limit": query.get("facet.limit"),
+        "flags": query_flags(query),
+        "params": normalize_query(query),
+    }
+    slow_query_log.warning(json.dumps(entry, default=str))
+
+
+def get_sample_rate():
+    return float(toolkit.config.get("ckanext.sitesearch.query_log.sample_rate") or 0)
+
+
+def log_sampled_query(query, entity_type, permission_labels):
+    """
+    Log a sample of the queries, to be replayed by `lib/warmup`
+
+    `query` should be the query parameters as received by `_run_query`.
+    """
+    sample_rate = get_sample_rate()
+    if sample_rate <= 0 or random.random() >= sample_rate:
+        return
+
+    _setup_file_handler(
+        sampled_query_log, "ckanext.sitesearch.query_log", level=logging.INFO
+    )
+
+    entry = {
+        "entity_type": entity_type,
+        "permission_labels": (
+            sorted(permission_labels) if permission_labels is not None else None
+        ),
+        "params": normalize_query(query),
+    }
+    sampled_query_log.info(json.dumps(entry, default=str))
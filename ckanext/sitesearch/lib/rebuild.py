@@ -1,12 +1,23 @@
+import hashlib
 import logging
+import multiprocessing
 import sys
 import traceback
+from contextlib import contextmanager
 
 from ckan import model
+from ckan.lib.search import commit as core_commit
+from ckan.lib.search import index as core_search_index
+from ckan.lib.search import index_for
 from ckan.lib.search import rebuild as core_index_datasets
 from ckan.plugins import plugin_loaded, toolkit
+from ckanext.sitesearch.lib import failures
+from ckanext.sitesearch.lib.backends import get_backend
+from ckanext.sitesearch.lib.backends.solr import SolrBackend
+from ckanext.sitesearch.lib.checkpoint import Checkpoint
 from ckanext.sitesearch.lib.index import (
     commit,
+    deleters,
     index_group,
     index_organization,
     index_page,
@@ -16,8 +27,68 @@ from sqlalchemy.sql.expression import false, true
 
 log = logging.getLogger(__name__)
 
+DEFAULT_CHECKPOINT_EVERY = 1000
 
-def rebuild_orgs(defer_commit=False, force=False, quiet=True, entity_id=None):
+# Number of datasets sent to each worker at a time in parallel rebuilds
+DEFAULT_WORKER_CHUNK_SIZE = 100
+
+
+def parse_shard(value):
+    """Parse a shard definition like `2/4` into a `(2, 4)` tuple
+
+    Shards are numbered from 1 to the total number of shards.
+    """
+    try:
+        index, total = [int(part) for part in value.split("/")]
+    except ValueError:
+        raise ValueError(
+            "Shards must be defined as `i/n`, eg `2/4`: {}".format(value)
+        )
+    if total < 1 or not 1 <= index <= total:
+        raise ValueError(
+            "Invalid shard {}, it must be between 1/n and n/n".format(value)
+        )
+    return index, total
+
+
+def in_shard(entity_id, shard):
+    """Whether the entity belongs to the `(i, n)` shard
+
+    Entities are assigned to shards hashing their id, so all hosts running
+    a sharded rebuild get the same disjoint slices without coordination.
+    """
+    index, total = shard
+    digest = hashlib.md5(entity_id.encode("utf-8")).hexdigest()
+    return int(digest, 16) % total == index - 1
+
+
+def _filter_shard(entity_ids, shard):
+    if not shard:
+        return entity_ids
+    return [entity_id for entity_id in entity_ids if in_shard(entity_id, shard)]
+
+
+def commit_all():
+    """Commit the changes for all entities, including the datasets
+
+    Used to make the changes visible once all the shards of a sharded
+    rebuild finished.
+    """
+    commit()
+    if get_backend().name != "solr":
+        # Datasets are always indexed in Solr
+        core_commit()
+
+
+def rebuild_orgs(
+    defer_commit=False,
+    force=False,
+    quiet=True,
+    entity_id=None,
+    resume=False,
+    checkpoint_every=DEFAULT_CHECKPOINT_EVERY,
+    shard=None,
+):
     if entity_id:
         org = model.Group.get(entity_id)
         if not org:
@@ -33,11 +104,28 @@ def rebuild_orgs(defer_commit=False, force=False, quiet=True, entity_id=None):
         ]
 
     _rebuild_entities(
-        org_ids, "organization", "organization_show", defer_commit, force, quiet
+        org_ids,
+        "organization",
+        "organization_show",
+        defer_commit,
+        force,
+        quiet,
+        checkpoint=not entity_id,
+        resume=resume,
+        checkpoint_every=checkpoint_every,
+        shard=shard,
     )
 
 
-def rebuild_groups(defer_commit=False, force=False, quiet=True, entity_id=None):
+def rebuild_groups(
+    defer_commit=False,
+    force=False,
+    quiet=True,
+    entity_id=None,
+    resume=False,
+    checkpoint_every=DEFAULT_CHECKPOINT_EVERY,
+    shard=None,
+):
 
     if entity_id:
         group = model.Group.get(entity_id)
@@ -53,10 +141,29 @@ def rebuild_groups(defer_commit=False, force=False, quiet=True, entity_id=None):
             .all()
         ]
 
-    _rebuild_entities(group_ids, "group", "group_show", defer_commit, force, quiet)
+    _rebuild_entities(
+        group_ids,
+        "group",
+        "group_show",
+        defer_commit,
+        force,
+        quiet,
+        checkpoint=not entity_id,
+        resume=resume,
+        checkpoint_every=checkpoint_every,
+        shard=shard,
+    )
 
 
-def rebuild_users(defer_commit=False, force=False, quiet=True, entity_id=None):
+def rebuild_users(
+    defer_commit=False,
+    force=False,
+    quiet=True,
+    entity_id=None,
+    resume=False,
+    checkpoint_every=DEFAULT_CHECKPOINT_EVERY,
+    shard=None,
+):
 
     if entity_id:
         user = model.User.get(entity_id)
@@ -71,10 +178,29 @@ def rebuild_users(defer_commit=False, force=False, quiet=True, entity_id=None):
             .all()
         ]
 
-    _rebuild_entities(user_ids, "user", "user_show", defer_commit, force, quiet)
+    _rebuild_entities(
+        user_ids,
+        "user",
+        "user_show",
+        defer_commit,
+        force,
+        quiet,
+        checkpoint=not entity_id,
+        resume=resume,
+        checkpoint_every=checkpoint_every,
+        shard=shard,
+    )
 
 
-def rebuild_pages(defer_commit=False, force=False, quiet=True, entity_id=None):
+def rebuild_pages(
+    defer_commit=False,
+    force=False,
+    quiet=True,
+    entity_id=None,
+    resume=False,
+    checkpoint_every=DEFAULT_CHECKPOINT_EVERY,
+    shard=None,
+):
 
     if plugin_loaded("pages"):
         from ckanext.pages.db import Page
@@ -98,10 +224,35 @@ def rebuild_pages(defer_commit=False, force=False, quiet=True, entity_id=None):
         force,
         quiet,
         id_field="page",
+        checkpoint=not entity_id,
+        resume=resume,
+        checkpoint_every=checkpoint_every,
+        shard=shard,
     )
 
 
-def rebuild_datasets(defer_commit=False, force=False, quiet=True, entity_id=None):
+def rebuild_datasets(
+    defer_commit=False,
+    force=False,
+    quiet=True,
+    entity_id=None,
+    workers=1,
+    chunk_size=DEFAULT_WORKER_CHUNK_SIZE,
+    shard=None,
+    resume=False,
+    checkpoint_every=DEFAULT_CHECKPOINT_EVERY,
+):
+
+    if (workers > 1 or shard or resume) and not entity_id:
+        return _rebuild_datasets_parallel(
+            workers,
+            force,
+            quiet,
+            chunk_size,
+            shard,
+            resume=resume,
+            checkpoint_every=checkpoint_every,
+        )
 
     if toolkit.check_ckan_version(min_version="2.10"):
         # CKAN >= 2.10 does not clear the index by default
@@ -121,6 +272,209 @@ def rebuild_datasets(defer_commit=False, force=False, quiet=True, entity_id=None
         )
 
 
+def _rebuild_datasets_parallel(
+    workers,
+    force,
+    quiet,
+    chunk_size,
+    shard=None,
+    resume=False,
+    checkpoint_every=DEFAULT_CHECKPOINT_EVERY,
+):
+    """Index all datasets (or the ones in `shard`) using `workers` processes
+
+    Dataset ids are split in chunks of `chunk_size` that are indexed by
+    the workers, sending the documents of each chunk to Solr in a single
+    request (see `_index_datasets_chunk`), and the changes are committed
+    once at the end (except for sharded rebuilds, see `commit_all`).
+    Unlike core's rebuild, the index is never cleared, so the other entity
+    types are kept.
+
+    As in `_rebuild_entities`, every `checkpoint_every` datasets the changes
+    are committed and a checkpoint (of the shard, if any) is stored, which
+    can be resumed passing `resume`.
+    """
+    package_ids = _filter_shard(
+        sorted(
+            r[0]
+            for r in model.Session.query(model.Package.id)
+            .filter(model.Package.state != "deleted")
+            .all()
+        ),
+        shard,
+    )
+    total = len(package_ids)
+    indexed = failed = 0
+
+    checkpoint = Checkpoint("dataset", shard)
+    if resume:
+        data = checkpoint.load()
+        if data:
+            package_ids = [i for i in package_ids if i > data["last_id"]]
+            indexed, failed = data["indexed"], data["failed"]
+            log.info(
+                "Resuming dataset rebuild after {} ({} indexed, {} failed)".format(
+                    data["last_id"], indexed, failed
+                )
+            )
+
+    chunks = [
+        package_ids[i : i + chunk_size] for i in range(0, len(package_ids), chunk_size)
+    ]
+    args = [(chunk, force) for chunk in chunks]
+
+    pool = None
+    if workers > 1:
+        # Don't share the database connections with the worker processes
+        model.Session.remove()
+        model.meta.engine.dispose()
+        pool = multiprocessing.get_context("fork").Pool(workers)
+
+    since_checkpoint = 0
+    try:
+        # Results are returned in order, so all the datasets up to the last
+        # one of each chunk are processed when storing a checkpoint
+        results = (
+            pool.imap(_index_datasets_chunk, args)
+            if pool
+            else map(_index_datasets_chunk, args)
+        )
+        for chunk, (chunk_indexed, chunk_failed) in zip(chunks, results):
+            indexed += chunk_indexed
+            failed += len(chunk_failed)
+            for package_id, error_class, message in chunk_failed:
+                log.error(
+                    "Error while indexing dataset {}: {}: {}".format(
+                        package_id, error_class, message
+                    )
+                )
+                # Recorded here, as the workers share the connections of the
+                # parent process
+                failures.record_failure(
+                    "dataset", package_id, message, error_class=error_class
+                )
+            if not quiet:
+                sys.stdout.write(
+                    "\rIndexing dataset {}/{}".format(indexed + failed, total)
+                )
+                sys.stdout.flush()
+            since_checkpoint += len(chunk)
+            if since_checkpoint >= checkpoint_every:
+                # Only store the checkpoint once the changes are committed
+                core_commit()
+                checkpoint.save(chunk[-1], indexed, failed, total)
+                since_checkpoint = 0
+        if pool:
+            pool.close()
+    except BaseException:
+        if pool:
+            pool.terminate()
+        raise
+    finally:
+        if pool:
+            pool.join()
+
+    if not shard:
+        core_commit()
+
+    # The rebuild completed, next one will start from scratch
+    checkpoint.clear()
+
+    log.info("Indexed {} datasets ({} failed)".format(indexed, failed))
+
+    return indexed, failed
+
+
+class _DocumentCollector(object):
+    """Stands in for the Solr connection of CKAN core's `index_package`,
+    keeping the documents instead of sending them"""
+
+    url = "(collecting documents)"
+
+    def __init__(self):
+        self.docs = []
+
+    def add(self, docs, commit=False):
+        self.docs.extend(docs)
+
+
+@contextmanager
+def _collect_dataset_documents():
+    """Collect the documents built by CKAN core's `index_package`
+
+    Core builds the document of a dataset (calling the plugins'
+    `before_dataset_index` hooks) and sends it to Solr in the same method,
+    so the connection it uses is replaced while this is active. Only meant
+    to be used in the rebuild processes.
+    """
+    collector = _DocumentCollector()
+    make_connection = core_search_index.make_connection
+    core_search_index.make_connection = lambda *args, **kwargs: collector
+    try:
+        yield collector
+    finally:
+        core_search_index.make_connection = make_connection
+
+
+def _index_datasets_chunk(args):
+    """Index a list of datasets in a worker process
+
+    The documents are built with CKAN core's `index_package` and sent to
+    Solr in a single request, without committing. If that request fails
+    they are sent one at a time, so only the datasets that Solr rejects
+    are reported as failed.
+
+    Returns the number of datasets indexed and a list of `(id, error class,
+    message)` tuples for the ones that failed (if `force` is True,
+    otherwise the first error is raised), so they can be recorded by the
+    parent process.
+    """
+    package_ids, force = args
+    package_index = index_for(model.Package)
+    context = {
+        "model": model,
+        "ignore_auth": True,
+        "validate": False,
+        "use_cache": False,
+    }
+    # Datasets are always indexed in Solr, whatever the sitesearch backend
+    solr = SolrBackend()
+    failed = []
+    try:
+        with _collect_dataset_documents() as collector:
+            for package_id in package_ids:
+                try:
+                    pkg_dict = toolkit.get_action("package_show")(
+                        dict(context), {"id": package_id}
+                    )
+                    package_index.index_package(pkg_dict, defer_commit=True)
+                except Exception as e:
+                    if not force:
+                        raise
+                    failed.append((package_id, type(e).__name__, str(e)))
+    finally:
+        model.Session.remove()
+
+    docs = collector.docs
+    if not docs:
+        return 0, failed
+    try:
+        solr.add(docs, commit=False)
+    except Exception:
+        if not force:
+            raise
+        docs_sent = []
+        for doc in docs:
+            try:
+                solr.add([doc], commit=False)
+                docs_sent.append(doc)
+            except Exception as e:
+                failed.append((doc["id"], type(e).__name__, str(e)))
+        docs = docs_sent
+
+    return len(docs), failed
+
+
 indexers = {
     "organization": index_organization,
     "group": index_group,
@@ -130,29 +484,134 @@ indexers = {
 
 
 def _rebuild_entities(
-    entity_ids, entity_name, action_name, defer_commit, force, quiet, id_field="id"
+    entity_ids,
+    entity_name,
+    action_name,
+    defer_commit,
+    force,
+    quiet,
+    id_field="id",
+    checkpoint=False,
+    resume=False,
+    checkpoint_every=DEFAULT_CHECKPOINT_EVERY,
+    shard=None,
 ):
+    """Index the provided entities
+
+    Entities are processed in a stable order (sorted by id). If `checkpoint`
+    is True, every `checkpoint_every` entities the changes are committed
+    and the last id processed is stored in a checkpoint. If `resume` is
+    True, the entities up to the one stored in an existing checkpoint are
+    skipped.
+
+    If a `(i, n)` `shard` is provided, only the entities in that shard are
+    indexed, with their own checkpoint, and the last changes are not
+    committed (see `commit_all`).
+    """
 
+    entity_ids = _filter_shard(sorted(entity_ids), shard)
     total_entities = len(entity_ids)
+    indexed = failed = 0
+
+    checkpoint = Checkpoint(entity_name, shard) if checkpoint else None
+    if checkpoint and resume:
+        data = checkpoint.load()
+        if data:
+            entity_ids = [i for i in entity_ids if i > data["last_id"]]
+            indexed, failed = data["indexed"], data["failed"]
+            log.info(
+                "Resuming {} rebuild after {} ({} indexed, {} failed)".format(
+                    entity_name, data["last_id"], indexed, failed
+                )
+            )
+    skipped = total_entities - len(entity_ids)
+
     context = {"ignore_auth": True}
     for counter, entity_id in enumerate(entity_ids):
         if not quiet:
             sys.stdout.write(
-                "\rIndexing {} {}/{}".format(entity_name, counter + 1, total_entities)
+                "\rIndexing {} {}/{}".format(
+                    entity_name, skipped + counter + 1, total_entities
+                )
             )
             sys.stdout.flush()
         try:
             data_dict = toolkit.get_action(action_name)(context, {id_field: entity_id})
             indexers[entity_name](data_dict, defer_commit)
+            indexed += 1
         except Exception as e:
             log.error(
                 "Error while indexing {} {}: {}".format(entity_name, entity_id, repr(e))
             )
+            failures.record_failure(entity_name, entity_id, e)
             if force:
                 log.exception(traceback.format_exc())
-                continue
+                failed += 1
             else:
                 raise
 
-    if defer_commit:
+        if checkpoint and (counter + 1) % checkpoint_every == 0:
+            # Only store the checkpoint once the changes are committed
+            if defer_commit:
+                commit()
+            checkpoint.save(entity_id, indexed, failed, total_entities)
+
+    if defer_commit and not shard:
         commit()
+
+    if checkpoint:
+        # The rebuild completed, next one will start from scratch
+        checkpoint.clear()
+
+
+rebuilders = {
+    "organization": rebuild_orgs,
+    "group": rebuild_groups,
+    "user": rebuild_users,
+    "page": rebuild_pages,
+    "dataset": rebuild_datasets,
+}
+
+
+def retry_failures(entity_type=None, quiet=True):
+    """Try again to index (or delete) the entities recorded as failed
+
+    Entities that are indexed successfully are marked as resolved, the
+    ones that fail again get a new failure recorded. If an entity that
+    failed to be indexed no longer exists, it is removed from the index.
+
+    Returns a tuple with the number of entities succeeded and failed.
+    """
+    pending = failures.get_failures(entity_type)
+    succeeded = failed = 0
+
+    for counter, failure in enumerate(pending):
+        if not quiet:
+            sys.stdout.write("\rRetrying {}/{}".format(counter + 1, len(pending)))
+            sys.stdout.flush()
+
+        entity_type, entity_id = failure["entity_type"], failure["entity_id"]
+        try:
+            if failure["operation"] == "delete":
+                with failures.recorded(entity_type, entity_id, "delete"):
+                    deleters[entity_type](entity_id, defer_commit=True)
+            else:
+                try:
+                    rebuilders[entity_type](defer_commit=True, entity_id=entity_id)
+                except toolkit.ObjectNotFound:
+                    # The entity was deleted since it failed
+                    with failures.recorded(entity_type, entity_id, "delete"):
+                        deleters[entity_type](entity_id, defer_commit=True)
+        except Exception as e:
+            log.error(
+                "Error while retrying {} {}: {}".format(entity_type, entity_id, repr(e))
+            )
+            failed += 1
+        else:
+            failures.mark_resolved(entity_type, entity_id)
+            succeeded += 1
+
+    if pending:
+        commit_all()
+
+    return succeeded, failed
@@ -0,0 +1,106 @@
+"""
+Snapshots of the sitesearch documents
+
+`snapshot` writes all the organization, group, user and page documents
+stored in the search backend to a gzip-compressed file with one JSON
+document per line. `restore` loads them back in batches.
+
+Some fields of the documents are indexed but not stored by Solr (eg the
+catch-all dynamic fields, `title_string` or `permission_labels`), so when
+restoring, documents are built again from their stored
+`validated_data_dict` with the same functions used when indexing. This
+doesn't involve calling the `*_show` actions (only pages need a database
+query, to get their permission labels), so restoring is much faster than a
+rebuild from the database. Snapshots taken with
+`ckanext.sitesearch.thin_documents` enabled can't be restored, as the
+documents don't include the full entity dict.
+"""
+import gzip
+import json
+import logging
+import sys
+
+from ckan.plugins import toolkit
+
+from ckanext.sitesearch.lib import index
+from ckanext.sitesearch.lib.backends import get_backend
+
+
+log = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 1000
+
+
+def snapshot(path, entity_type=None, batch_size=DEFAULT_BATCH_SIZE, quiet=True):
+    """Write the documents to a gzipped NDJSON file
+
+    Returns the number of documents written.
+    """
+    count = 0
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        for doc in get_backend().iter_documents(
+            toolkit.config.get("ckan.site_id"),
+            entity_type=entity_type,
+            batch_size=batch_size,
+        ):
+            f.write(json.dumps(doc, sort_keys=True))
+            f.write("\n")
+            count += 1
+            if not quiet and count % batch_size == 0:
+                sys.stdout.write("\rWritten {} documents".format(count))
+                sys.stdout.flush()
+
+    log.info("Written {} documents to {}".format(count, path))
+    return count
+
+
+def _rebuild_document(doc):
+    if "validated_data_dict" not in doc:
+        raise ValueError(
+            "Thin documents can't be restored, rebuild the index from the "
+            "database instead"
+        )
+    data_dict = json.loads(doc["validated_data_dict"])
+    return index.preparers[doc["entity_type"]](data_dict)
+
+
+def restore(path, batch_size=DEFAULT_BATCH_SIZE, quiet=True):
+    """Load the documents from a file written by `snapshot`
+
+    Changes are committed once all documents are sent. Returns a tuple
+    with the number of documents restored and failed.
+    """
+    restored = failed = 0
+    batch = []
+
+    def send():
+        index.index_documents(batch, defer_commit=True)
+        if not quiet:
+            sys.stdout.write("\rRestored {} documents".format(restored))
+            sys.stdout.flush()
+        del batch[:]
+
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                batch.append(_rebuild_document(json.loads(line)))
+            except Exception as e:
+                log.error(
+                    "Error restoring document in line {}: {}".format(
+                        line_number, repr(e)
+                    )
+                )
+                failed += 1
+                continue
+            restored += 1
+            if len(batch) >= batch_size:
+                send()
+
+    if batch:
+        send()
+    index.commit()
+
+    log.info("Restored {} documents from {} ({} failed)".format(restored, path, failed))
+    return restored, failed
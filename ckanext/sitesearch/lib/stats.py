@@ -0,0 +1,157 @@
+"""
+Statistics about the search index
+
+Reports the number of documents of each entity type (and of each site, as
+the Solr core can be shared with other CKAN instances), how they compare
+with the number of entities in the database, the size of the stored
+documents and backend specific details like the size of the index on disk.
+"""
+import heapq
+import json
+
+from sqlalchemy.sql.expression import false, true
+
+from ckan import model
+from ckan.plugins import plugin_loaded, toolkit
+
+from ckanext.sitesearch.lib.backends import get_backend
+
+DEFAULT_LARGEST = 10
+
+# Entity types stored by the sitesearch backends (datasets are always in Solr)
+ENTITY_TYPES = ("organization", "group", "user", "page")
+
+
+def _facet_counts(backend, field, site_id=None):
+    result = backend.search(
+        {
+            "q": "*:*",
+            "rows": 0,
+            "facet": "true",
+            "facet.field": [field],
+            "facet.limit": -1,
+            "facet.mincount": 1,
+        },
+        site_id=site_id,
+    )
+    return result["facets"].get(field, {})
+
+
+def get_db_counts():
+    """Return the number of entities of each type that should be indexed"""
+
+    counts = {
+        "package": model.Session.query(model.Package.id)
+        .filter(model.Package.state != "deleted")
+        .count(),
+        "organization": model.Session.query(model.Group.id)
+        .filter(model.Group.is_organization == true())
+        .filter(model.Group.state != "deleted")
+        .count(),
+        "group": model.Session.query(model.Group.id)
+        .filter(model.Group.is_organization == false())
+        .filter(model.Group.state != "deleted")
+        .count(),
+        "user": model.Session.query(model.User.id)
+        .filter(model.User.state != "deleted")
+        .count(),
+    }
+    if plugin_loaded("pages"):
+        from ckanext.pages.db import Page
+
+        counts["page"] = len(Page.pages())
+
+    return counts
+
+
+def percentile(values, pct):
+    """Return the `pct` percentile of `values` (nearest rank), or 0 if empty"""
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))]
+
+
+def get_document_sizes(entity_type, largest=DEFAULT_LARGEST, batch_size=1000):
+    """Return the size stats of the stored documents of a type, in bytes
+
+    Sizes are the length of the documents as returned by the backend,
+    serialized as JSON.
+    """
+    sizes, data_dict_sizes, top = [], [], []
+    for doc in get_backend().iter_documents(
+        toolkit.config.get("ckan.site_id"),
+        entity_type=entity_type,
+        batch_size=batch_size,
+    ):
+        size = len(json.dumps(doc).encode("utf-8"))
+        sizes.append(size)
+        data_dict = doc.get("validated_data_dict") or ""
+        data_dict_sizes.append(len(data_dict.encode("utf-8")))
+
+        item = (size, doc.get("id"), doc.get("name"))
+        if len(top) < largest:
+            heapq.heappush(top, item)
+        elif largest:
+            heapq.heappushpop(top, item)
+
+    return {
+        "avg_size": sum(sizes) / len(sizes) if sizes else 0,
+        "p95_size": percentile(sizes, 95),
+        "avg_data_dict_size": (
+            sum(data_dict_sizes) / len(data_dict_sizes) if data_dict_sizes else 0
+        ),
+        "largest": [
+            {"entity_type": entity_type, "id": id_, "name": name, "size": size}
+            for size, id_, name in sorted(top, reverse=True)
+        ],
+    }
+
+
+def get_stats(sizes=True, largest=DEFAULT_LARGEST):
+    """Return all the index statistics as a dict
+
+    Computing the document sizes requires reading all stored documents, it
+    can be skipped passing `sizes=False`.
+    """
+    backend = get_backend()
+    site_id = toolkit.config.get("ckan.site_id")
+
+    indexed = _facet_counts(backend, "entity_type", site_id=site_id)
+    db_counts = get_db_counts()
+
+    entity_types = list(ENTITY_TYPES)
+    if backend.name == "solr":
+        # Datasets share the same core
+        entity_types.insert(0, "package")
+    if not plugin_loaded("pages"):
+        entity_types.remove("page")
+
+    out = {
+        "site_id": site_id,
+        "backend": backend.name,
+        "entity_types": {},
+        "largest": [],
+        "sites": _facet_counts(backend, "site_id"),
+        "index": backend.index_info(),
+    }
+
+    for entity_type in entity_types:
+        count = indexed.get(entity_type, 0)
+        db_count = db_counts.get(entity_type)
+        stats = {
+            "indexed": count,
+            "db": db_count,
+            "diff": count - db_count if db_count is not None else None,
+        }
+        if sizes and entity_type != "package":
+            type_sizes = get_document_sizes(entity_type, largest)
+            out["largest"].extend(type_sizes.pop("largest"))
+            stats.update(type_sizes)
+        out["entity_types"][entity_type] = stats
+
+    out["largest"] = sorted(out["largest"], key=lambda d: d["size"], reverse=True)[
+        :largest
+    ]
+
+    return out
@@ -1,10 +1,18 @@
 """
-This code is re-used from Django's django.utils.html module.
+`strip_html_tags` is re-used from Django's django.utils.html module.
 
 See LICENSE.django for details.
 """
+import re
+from html import unescape
 from html.parser import HTMLParser
 
+try:
+    from lxml import etree
+    from lxml import html as lxml_html
+except ImportError:
+    etree = lxml_html = None
+
 
 class MLStripper(HTMLParser):
     def __init__(self):
@@ -47,3 +55,98 @@ def strip_html_tags(value):
             break
         value = new_value
     return value
+
+
+# Attributes of a start tag, where only quoted values can contain `>`
+_TAG_ATTRS = r"""(?:[^>=]|=\s*(?:"[^"]*"|'[^']*')|=)*"""
+
+# Tags, comments, declarations and processing instructions, removed as the
+# `HTMLParser` used by `strip_html_tags` does, including malformed markup:
+# * The contents of <script> and <style> elements are kept (captured in the
+#   `keep` group), but if they are not closed the rest of the text is
+#   dropped.
+# * Comments that are not closed are kept up to the next `>`, and the text
+#   after it is parsed again.
+# * End tags are removed up to the next `>`, whatever they contain.
+HTML_TAG_RE = re.compile(
+    rf"<(?P<raw_tag>script|style)(?=[\s/>]){_TAG_ATTRS}(?<!/)>"
+    r"(?P<keep>.*?)</(?P=raw_tag)\s*>"
+    rf"|<(?:script|style)(?=[\s/>]){_TAG_ATTRS}(?<!/)>.*"
+    r"|<!--.*?--\s*>"
+    r"|(?P<unclosed_comment><!--[^>]*>)"
+    r"|<![^>]*>"
+    r"|<\?[^>]*>"
+    r"|</[^>]*>"
+    rf"|<[a-zA-Z]{_TAG_ATTRS}>",
+    re.DOTALL | re.IGNORECASE,
+)
+
+# Line breaks are removed and other whitespace replaced with plain spaces
+WHITESPACE_REPLACEMENTS = (("\r", ""), ("\n", ""), ("\xa0", " "), ("\t", " "))
+
+
+def _replace_tag(match):
+    return match.group("keep") or match.group("unclosed_comment") or ""
+
+
+def _strip_tags_re(value):
+    while "<" in value and ">" in value:
+        new_value = HTML_TAG_RE.sub(_replace_tag, value)
+        if value.count("<") == new_value.count("<"):
+            break
+        value = new_value
+    return value
+
+
+def _text_content_lxml(value):
+    try:
+        return lxml_html.document_fromstring(value).text_content()
+    except (ValueError, etree.ParserError):
+        # Eg strings with an encoding declaration, fall back to the
+        # regular expression
+        return None
+
+
+def sanitize_html_text(value, use_lxml=None):
+    """Return the text of the given HTML, ready to be indexed
+
+    Tags are stripped, HTML entities decoded, line breaks removed and tabs
+    and non-breaking spaces replaced with spaces, as running
+    `strip_html_tags`, `html.unescape` and the whitespace replacements
+    does, but tags are removed in a single regular expression pass
+    (repeated only if removing tags leaves new ones, as `strip_html_tags`
+    does) instead of parsing the whole document in Python. The output is
+    the same for well-formed markup and for the malformed markup covered by
+    the tests (stray end tags, unclosed comments and <script> elements...),
+    but can still differ on pathological markup, like stray quotes inside
+    tags. The output of `strip_html_tags` itself varies on such markup
+    between Python versions.
+
+    If lxml is installed its HTML parser is used instead (unless
+    `use_lxml` is False), which is faster still for large documents but
+    differs more on malformed markup. For example, text after a comment or a <script>
+    element that is not closed is dropped or kept respectively (the
+    opposite of the above), and comments can also be closed with `--!>`.
+    """
+    value = str(value)
+
+    if use_lxml is None:
+        use_lxml = lxml_html is not None
+
+    text = None
+    if "<" in value and ">" in value:
+        if use_lxml and value.strip():
+            text = _text_content_lxml(value)
+        if text is None:
+            text = unescape(_strip_tags_re(value))
+    elif "&" in value:
+        text = unescape(value)
+    else:
+        text = value
+
+    # str.replace is faster than str.translate or a regular expression here
+    for char, replacement in WHITESPACE_REPLACEMENTS:
+        if char in text:
+            text = text.replace(char, replacement)
+
+    return text
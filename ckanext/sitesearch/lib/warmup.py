@@ -0,0 +1,167 @@
+"""
+Search cache warm-up from the sampled query log
+
+Solr caches (filterCache, queryResultCache and the field caches used for
+sorting and faceting) are discarded each time a new searcher is opened,
+ie after every commit. `warmup` replays the most frequent queries found
+in the sampled query log (see `lib/querylog`) so the first user queries
+after a commit or a rebuild don't hit cold caches.
+
+`solr_warming_config` generates a `newSearcher` listener for the
+`solrconfig.xml` of the core with the same queries, so Solr warms each new
+searcher itself before it starts serving requests.
+"""
+import collections
+import glob
+import json
+import logging
+import sys
+import time
+from xml.sax.saxutils import escape, quoteattr
+
+from ckan.lib.search.common import SearchError, SearchQueryError
+from ckan.plugins import toolkit
+
+from ckanext.sitesearch.lib import query as lib_query
+from ckanext.sitesearch.lib.backends import get_backend
+
+
+log = logging.getLogger(__name__)
+
+DEFAULT_LIMIT = 50
+
+
+def get_query_log_path():
+    return toolkit.config.get("ckanext.sitesearch.query_log.file")
+
+
+def read_query_log(path):
+    """Yield the entries in the sampled query log, including rotated files"""
+    for file_path in sorted(glob.glob(glob.escape(path) + "*")):
+        if file_path != path and not file_path[len(path) + 1 :].isdigit():
+            continue
+        with open(file_path, encoding="utf-8") as f:
+            for line in f:
+                # Lines start with the timestamp added by the log formatter
+                start = line.find("{")
+                if start == -1:
+                    continue
+                try:
+                    yield json.loads(line[start:])
+                except ValueError:
+                    log.warning("Invalid query log entry: {}".format(line.strip()))
+
+
+def top_queries(path, limit=DEFAULT_LIMIT):
+    """Return the most frequent queries in the log, with their count
+
+    Queries are compared after normalising their parameters, so the same
+    query with its parameters in a different order counts as one.
+    """
+    counter = collections.Counter()
+    entries = {}
+    for entry in read_query_log(path):
+        key = json.dumps(entry, sort_keys=True)
+        counter[key] += 1
+        entries.setdefault(key, entry)
+
+    return [(count, entries[key]) for key, count in counter.most_common(limit)]
+
+
+def _to_query(entry):
+    """Return the `_run_query` parameters of a log entry"""
+    query = dict(entry["params"])
+    # Normalised queries have all filters in `fq`
+    query["fq_list"] = query.pop("fq", [])
+    return query
+
+
+def warmup(limit=DEFAULT_LIMIT, path=None, quiet=True):
+    """Replay the most frequent queries in the sampled query log
+
+    The queries are sent straight to the search backend, so they are not
+    included in the metrics or the query logs. Returns the number of
+    queries replayed and failed.
+    """
+    path = path or get_query_log_path()
+    if not path:
+        raise ValueError(
+            "No query log file, set ckanext.sitesearch.query_log.file and "
+            "ckanext.sitesearch.query_log.sample_rate"
+        )
+
+    backend = get_backend()
+    site_id = toolkit.config.get("ckan.site_id")
+    replayed = failed = 0
+    start = time.perf_counter()
+    for count, entry in top_queries(path, limit):
+        query = _to_query(entry)
+        try:
+            lib_query.check_query(query)
+            backend.search(
+                query,
+                entity_type=entry.get("entity_type"),
+                site_id=site_id,
+                permission_labels=entry.get("permission_labels"),
+            )
+            replayed += 1
+        except (SearchError, SearchQueryError) as e:
+            log.warning("Could not replay query {}: {}".format(entry, e))
+            failed += 1
+        if not quiet:
+            sys.stdout.write(
+                "{:>6} {}\n".format(count, json.dumps(entry, sort_keys=True))
+            )
+
+    log.info(
+        "Replayed {} queries ({} failed) in {:.2f}s".format(
+            replayed, failed, time.perf_counter() - start
+        )
+    )
+    return replayed, failed
+
+
+def solr_warming_config(limit=DEFAULT_LIMIT, path=None):
+    """Return a `newSearcher` listener for solrconfig.xml
+
+    It includes the most frequent queries in the sampled query log, with
+    the same parameters (including the filters added by the backend) that
+    are sent to Solr when running them.
+    """
+    path = path or get_query_log_path()
+    if not path:
+        raise ValueError("No query log file, set ckanext.sitesearch.query_log.file")
+
+    backend = get_backend()
+    if not hasattr(backend, "build_params"):
+        raise ValueError("Warming queries can only be generated for Solr")
+
+    site_id = toolkit.config.get("ckan.site_id")
+    lines = [
+        '<listener event="newSearcher" class="solr.QuerySenderListener">',
+        '  <arr name="queries">',
+    ]
+    for count, entry in top_queries(path, limit):
+        query = _to_query(entry)
+        lib_query.check_query(query)
+        params = backend.build_params(
+            query,
+            entity_type=entry.get("entity_type"),
+            site_id=site_id,
+            permission_labels=entry.get("permission_labels"),
+        )
+        params.pop("wt", None)
+
+        lines.append("    <!-- Sampled {} times -->".format(count))
+        lines.append("    <lst>")
+        for key, value in sorted(params.items()):
+            for item in value if isinstance(value, (list, tuple)) else [value]:
+                lines.append(
+                    "      <str name={}>{}</str>".format(
+                        quoteattr(key), escape(str(item))
+                    )
+                )
+        lines.append("    </lst>")
+    lines.extend(["  </arr>", "</listener>"])
+
+    return "\n".join(lines)
@@ -0,0 +1,122 @@
+"""
+Handling of expensive wildcard searches
+
+Terms with a leading wildcard (eg `*son`) can't use the term dictionary of
+the default `text` field, so Solr scans all of its terms, and terms with a
+very short prefix (eg `a*`) expand to a large number of them. What to do
+with them is set in `ckanext.sitesearch.wildcards`:
+
+* `allow` (default): queries are sent as they are.
+* `reject`: these terms fail with a `SearchQueryError`.
+* `reversed`: the words in the names and titles (and user full names) are
+  also indexed reversed in the `text_reversed` field, and free text terms
+  with a leading wildcard are rewritten to a prefix query on it (eg `*son`
+  becomes `text_reversed:nos*`). Other leading wildcards and short prefixes
+  are rejected as above. The Solr schema needs a `text_reversed` field with
+  a whitespace tokenizer, see the README.
+
+The minimum number of characters (other than wildcards) in a wildcard term
+is set in `ckanext.sitesearch.wildcards.min_chars`.
+"""
+import re
+
+from ckan.lib.search.common import SearchQueryError
+from ckan.plugins import toolkit
+
+from ckanext.sitesearch.lib.querylog import LEADING_WILDCARD_RE
+
+
+MODES = ("allow", "reject", "reversed")
+
+DEFAULT_MIN_CHARS = 2
+
+REVERSED_FIELD = "text_reversed"
+
+# Characters of a term (not fielded, quoted, escaped or a range)
+TERM_CHARS = r'[^\s()\[\]{}":\\]'
+
+# Terms with a wildcard, optionally with a `+` or `-` operator
+WILDCARD_TERM_RE = re.compile(
+    r"(^|[\s(])([+-]?)(" + TERM_CHARS + r"*[*?]" + TERM_CHARS + r"*)(?=$|[\s)])"
+)
+
+WILDCARD_RE = re.compile(r"[*?]")
+
+
+def get_mode():
+    mode = toolkit.config.get("ckanext.sitesearch.wildcards", "allow")
+    if mode not in MODES:
+        raise ValueError(
+            "Unknown ckanext.sitesearch.wildcards value: {}, it should be one of "
+            "{}".format(mode, ", ".join(MODES))
+        )
+    return mode
+
+
+def _min_chars():
+    return toolkit.asint(
+        toolkit.config.get("ckanext.sitesearch.wildcards.min_chars", DEFAULT_MIN_CHARS)
+    )
+
+
+def reversed_words(*values):
+    """Return the reversed lowercase words of `values` separated by spaces"""
+    words = []
+    for value in values:
+        for word in re.findall(r"\w+", (value or "").lower()):
+            if word[::-1] not in words:
+                words.append(word[::-1])
+    return " ".join(words)
+
+
+def add_reversed_field(data_dict, *fields):
+    """Index the words in `fields` reversed, if enabled (modifies `data_dict`)"""
+    if get_mode() == "reversed":
+        data_dict[REVERSED_FIELD] = reversed_words(
+            *[data_dict.get(field) for field in fields]
+        )
+    return data_dict
+
+
+def rewrite_query(q):
+    """Return `q` with the expensive wildcard terms rewritten or rejected
+
+    Raises `SearchQueryError` for the ones that can't be rewritten.
+    """
+    mode = get_mode()
+    if mode == "allow" or not q:
+        return q
+
+    min_chars = _min_chars()
+
+    def rewrite_term(match):
+        before, operator, term = match.groups()
+        chars = WILDCARD_RE.sub("", term)
+        if not chars:
+            # A lone `*` or `?`
+            return match.group(0)
+        if len(chars) < min_chars:
+            raise SearchQueryError(
+                "Wildcard searches need at least {} characters: {}".format(
+                    min_chars, term
+                )
+            )
+        if not WILDCARD_RE.match(term):
+            return match.group(0)
+
+        reversed_term = term.lower()[::-1]
+        if mode == "reject" or WILDCARD_RE.match(reversed_term):
+            raise SearchQueryError(
+                "Searches starting with a wildcard are not supported: {}".format(term)
+            )
+        return "{}{}{}:{}".format(before, operator, REVERSED_FIELD, reversed_term)
+
+    q = WILDCARD_TERM_RE.sub(rewrite_term, q)
+
+    # Leading wildcards in fielded terms
+    if LEADING_WILDCARD_RE.search(q):
+        raise SearchQueryError(
+            "Searches starting with a wildcard are not supported: {}".format(q)
+        )
+
+    return q
@@ -1,11 +1,22 @@
 import json
+import time
 
 from ckan import model
 from ckan import plugins as p
 from ckan.plugins import toolkit, plugin_loaded
 
-from ckanext.sitesearch.logic.schema import default_search_schema
-from ckanext.sitesearch.lib import rebuild, query
+from ckanext.sitesearch.logic.schema import (
+    default_autocomplete_schema,
+    default_search_schema,
+)
+from ckanext.sitesearch.lib import (
+    autocomplete,
+    hydrate,
+    limits,
+    metrics,
+    rebuild,
+    query,
+)
 from ckanext.sitesearch.interfaces import ISiteSearch
 
 
@@ -18,6 +29,7 @@ queriers = {
 
 
 @toolkit.side_effect_free
+@metrics.timed_action
 def organization_search(context, data_dict):
 
     toolkit.check_access("organization_search", context, data_dict)
@@ -25,7 +37,8 @@ def organization_search(context, data_dict):
     for item in p.PluginImplementations(ISiteSearch):
         data_dict = item.before_organization_search(data_dict)
 
-    search_results = _group_or_org_search("organization", context, data_dict)
+    raw = _raw_json(context, "after_organization_search")
+    search_results = _group_or_org_search("organization", context, data_dict, raw=raw)
 
     for item in p.PluginImplementations(ISiteSearch):
         search_results = item.after_organization_search(search_results, data_dict)
@@ -34,6 +47,7 @@ def organization_search(context, data_dict):
 
 
 @toolkit.side_effect_free
+@metrics.timed_action
 def group_search(context, data_dict):
 
     toolkit.check_access("group_search", context, data_dict)
@@ -41,7 +55,8 @@ def group_search(context, data_dict):
     for item in p.PluginImplementations(ISiteSearch):
         data_dict = item.before_group_search(data_dict)
 
-    search_results = _group_or_org_search("group", context, data_dict)
+    raw = _raw_json(context, "after_group_search")
+    search_results = _group_or_org_search("group", context, data_dict, raw=raw)
 
     for item in p.PluginImplementations(ISiteSearch):
         search_results = item.after_group_search(search_results, data_dict)
@@ -49,7 +64,7 @@ def group_search(context, data_dict):
     return search_results
 
 
-def _group_or_org_search(entity_name, context, data_dict):
+def _group_or_org_search(entity_name, context, data_dict, raw=False):
     schema = context.get("schema") or default_search_schema()
 
     data_dict, errors = toolkit.navl_validate(data_dict, schema, context)
@@ -60,10 +75,11 @@ def _group_or_org_search(entity_name, context, data_dict):
     if not data_dict.get("sort"):
         data_dict["sort"] = "title asc"
 
-    return _perform_search(entity_name, context, data_dict)
+    return _perform_search(entity_name, context, data_dict, raw=raw)
 
 
 @toolkit.side_effect_free
+@metrics.timed_action
 def user_search(context, data_dict):
 
     toolkit.check_access("user_search", context, data_dict)
@@ -80,7 +96,8 @@ def user_search(context, data_dict):
     if not data_dict.get("sort"):
         data_dict["sort"] = "fullname asc, name asc"
 
-    search_results = _perform_search("user", context, data_dict)
+    raw = _raw_json(context, "after_user_search")
+    search_results = _perform_search("user", context, data_dict, raw=raw)
 
     for item in p.PluginImplementations(ISiteSearch):
         search_results = item.after_user_search(search_results, data_dict)
@@ -89,6 +106,7 @@ def user_search(context, data_dict):
 
 
 @toolkit.side_effect_free
+@metrics.timed_action
 def page_search(context, data_dict):
 
     toolkit.check_access("page_search", context, data_dict)
@@ -107,8 +125,9 @@ def page_search(context, data_dict):
 
     permission_labels = _get_user_page_labels(context["user"])
 
+    raw = _raw_json(context, "after_page_search")
     search_results = _perform_search(
-        "page", context, data_dict, permission_labels=permission_labels
+        "page", context, data_dict, permission_labels=permission_labels, raw=raw
     )
 
     for item in p.PluginImplementations(ISiteSearch):
@@ -186,6 +205,7 @@ def parse_search_params(
 
 
 @toolkit.side_effect_free
+@metrics.timed_action
 def site_search(context, data_dict):
 
     toolkit.check_access("site_search", context, data_dict)
@@ -204,35 +224,233 @@ def site_search(context, data_dict):
     if plugin_loaded("pages"):
         searches.append(("pages", "page_search"))
 
+    counts_only = toolkit.asbool(data_dict.pop("counts_only", False))
+
     search_params = parse_search_params(data_dict, searches=[s[0] for s in searches])
 
-    for search in searches:
-        name, action_name = search
+    if counts_only:
+        out = _site_search_counts(context, searches, search_params)
+    else:
+        for search in searches:
+            name, action_name = search
+            try:
+                toolkit.check_access(action_name, context, search_params[name])
+                out[name] = toolkit.get_action(action_name)(
+                    context, search_params[name]
+                )
+            except toolkit.NotAuthorized:
+                pass
+
+    for item in p.PluginImplementations(ISiteSearch):
+        out = item.after_site_search(out, data_dict)
+
+    return out
+
+
+# Parameters that don't change the number of results
+NON_COUNT_PARAMS = ("rows", "start", "sort", "fl", "facet", "facet.field")
+
+
+def _site_search_counts(context, searches, search_params):
+    """Return only the number of results of each search in `site_search`
+
+    Datasets are counted with a `package_search` with no rows. All the
+    other entity types are counted in a single query faceted by entity
+    type, unless they have different parameters or there are `ISiteSearch`
+    plugins that could modify each search (in which case each search
+    action is called with no rows).
+    """
+    out = {}
+    allowed = []
+    for name, action_name in searches:
         try:
             toolkit.check_access(action_name, context, search_params[name])
-            out[name] = toolkit.get_action(action_name)(context, search_params[name])
+        except toolkit.NotAuthorized:
+            continue
+        allowed.append((name, action_name))
+
+    def empty_result(count):
+        return {"count": count, "results": [], "search_facets": {}}
+
+    def count_params(name):
+        return {
+            key: value
+            for key, value in search_params[name].items()
+            if key not in NON_COUNT_PARAMS and not key.startswith("facet.")
+        }
+
+    entity_searches = [
+        (name, action_name) for name, action_name in allowed if name != "datasets"
+    ]
+    single_query = entity_searches and not list(
+        p.PluginImplementations(ISiteSearch)
+    )
+    if single_query:
+        params = [count_params(name) for name, _ in entity_searches]
+        single_query = all(item == params[0] for item in params)
+
+    for name, action_name in allowed:
+        if name == "datasets" or not single_query:
+            params = dict(count_params(name), rows=0)
+            out[name] = empty_result(
+                toolkit.get_action(action_name)(context, params)["count"]
+            )
+
+    if single_query:
+        schema = context.get("schema") or default_search_schema()
+        query_dict, errors = toolkit.navl_validate(
+            count_params(entity_searches[0][0]), schema, context
+        )
+        if errors:
+            raise toolkit.ValidationError(errors)
+        query_dict.update(query_dict.pop("__extras", {}))
+        query_dict.pop("rows", None)
+
+        entity_types = {
+            name: action_name[: -len("_search")]
+            for name, action_name in entity_searches
+        }
+        permission_labels = None
+        if "page" in entity_types.values():
+            permission_labels = _get_user_page_labels(context["user"])
+        counts = query.count_entity_types(
+            query_dict, list(entity_types.values()), permission_labels
+        )
+        for name, entity_type in entity_types.items():
+            out[name] = empty_result(counts[entity_type])
+
+    # Keep the same order as in the full search
+    return {name: out[name] for name, _ in allowed}
+
+
+@toolkit.side_effect_free
+@metrics.timed_action
+def sitesearch_autocomplete(context, data_dict):
+    """Return the entities with a name or title word starting with `q`
+
+    Lookups use an in-memory prefix index rather than the search backend,
+    so they are fast enough to run on each keystroke. Each result only
+    includes the `id`, `name`, `title` and `entity_type` fields.
+
+    :param q: the prefix to look for
+    :type q: string
+    :param entity_types: only return these entity types (`organization`,
+        `group`, `user` or `page`). Types that the user is not allowed to
+        search are always excluded
+    :type entity_types: list of strings
+    :param limit: maximum number of results (optional, default: 10)
+    :type limit: int
+    """
+
+    toolkit.check_access("sitesearch_autocomplete", context, data_dict)
+
+    schema = context.get("schema") or default_autocomplete_schema()
+
+    data_dict, errors = toolkit.navl_validate(data_dict, schema, context)
+    if errors:
+        raise toolkit.ValidationError(errors)
+
+    available = [
+        entity_type
+        for entity_type in queriers
+        if entity_type != "page" or plugin_loaded("pages")
+    ]
+    unknown = set(data_dict.get("entity_types") or []) - set(available)
+    if unknown:
+        raise toolkit.ValidationError(
+            {"entity_types": ["Unknown entity types: {}".format(sorted(unknown))]}
+        )
+
+    entity_types = []
+    for entity_type in data_dict.get("entity_types") or available:
+        try:
+            toolkit.check_access("{}_search".format(entity_type), context, {})
+            entity_types.append(entity_type)
         except toolkit.NotAuthorized:
             pass
+    if not entity_types:
+        return []
 
-    for item in p.PluginImplementations(ISiteSearch):
-        out = item.after_site_search(out, data_dict)
+    permission_labels = None
+    if "page" in entity_types:
+        permission_labels = _get_user_page_labels(context.get("user"))
 
-    return out
+    return autocomplete.lookup(
+        data_dict["q"], entity_types, permission_labels, data_dict["limit"]
+    )
+
+
+class RawJSON(str):
+    """Search results already serialised as JSON, see `_raw_json`"""
+
+
+def _raw_json(context, hook_name):
+    """Return True if the search results should be returned as a `RawJSON`
+
+    Only if asked for with `raw_json` in the context, and no `ISiteSearch`
+    plugin implements the `after_*_search` hook (which need the results as
+    a dict).
+    """
+    if not context.get("raw_json"):
+        return False
+    default = getattr(ISiteSearch, hook_name)
+    return not any(
+        getattr(type(item), hook_name, default) is not default
+        for item in p.PluginImplementations(ISiteSearch)
+    )
+
+
+class _Decoder(object):
+    """Decodes the stored dicts as the search backend reads each document
+
+    Only the stored dict of each document is kept, so the rest of the
+    document can be freed before reading the next one. With `raw`, the
+    stored dicts are kept as strings, to be spliced into the output as they
+    are.
+    """
+
+    def __init__(self, raw=False):
+        self.raw = raw
+        # Total time spent decoding, in ms
+        self.elapsed = 0.0
 
+    def __call__(self, doc):
+        data = doc.get("validated_data_dict")
+        if data is None:
+            # Thin documents, the results are built from the database
+            return doc
+        if not self.raw:
+            start = time.perf_counter()
+            data = json.loads(data)
+            self.elapsed += (time.perf_counter() - start) * 1000
+        return {"validated_data_dict": data}
 
-def _perform_search(entity_name, context, data_dict, permission_labels=None):
+
+def _perform_search(entity_name, context, data_dict, permission_labels=None, raw=False):
 
     data_dict.update(data_dict.get("__extras", {}))
     data_dict.pop("__extras", None)
 
+    errors = limits.check_query("{}_search".format(entity_name), data_dict)
+    if errors:
+        raise toolkit.ValidationError(errors)
+
+    decode = _Decoder(raw)
     if permission_labels:
-        result = queriers[entity_name](data_dict, permission_labels)
+        result = queriers[entity_name](data_dict, permission_labels, decode=decode)
     else:
-        result = queriers[entity_name](data_dict)
+        result = queriers[entity_name](data_dict, decode=decode)
 
-    validated_results = []
-    for doc in result["results"]:
-        validated_results.append(json.loads(doc["validated_data_dict"]))
+    docs = result["results"]
+    if docs and "validated_data_dict" not in docs[0]:
+        # Thin documents, build the results from the database
+        validated_results = hydrate.hydrate(docs)
+    else:
+        validated_results = [doc["validated_data_dict"] for doc in docs]
+        if not raw:
+            metrics.timing(
+                "sitesearch.decode.latency", decode.elapsed, entity_type=entity_name
+            )
 
     restructured_facets = {}
     for key, value in result["facets"].items():
@@ -242,11 +460,30 @@ def _perform_search(entity_name, context, data_dict, permission_labels=None):
                 {"name": k, "display_name": k, "count": v}
             )
 
-    return {
+    # Only included when the backend stopped before collecting all results
+    partial = result.get("partial_results", False)
+
+    if raw:
+        if docs and "validated_data_dict" not in docs[0]:
+            validated_results = [json.dumps(item) for item in validated_results]
+        return RawJSON(
+            '{{"count": {}, "results": [{}], "search_facets": {}{}}}'.format(
+                result["count"],
+                ", ".join(validated_results),
+                json.dumps(restructured_facets),
+                ', "partial_results": true' if partial else "",
+            )
+        )
+
+    out = {
         "count": result["count"],
         "results": validated_results,
         "search_facets": restructured_facets,
     }
+    if partial:
+        out["partial_results"] = True
+
+    return out
 
 
 def _get_user_page_labels(user_id):
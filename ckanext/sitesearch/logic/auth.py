@@ -35,3 +35,18 @@ def site_search(context, data_dict):
     if the user is not allowed to search users, they won't get any users results
     """
     return {"success": True}
+
+
+@toolkit.auth_allow_anonymous_access
+def sitesearch_autocomplete(context, data_dict):
+    """All users can use the autocomplete
+
+    Note that each entity type is only included if the user is allowed to
+    search it
+    """
+    return {"success": True}
+
+
+def sitesearch_metrics(context, data_dict):
+    """Only sysadmins can see the search metrics"""
+    return {"success": False}
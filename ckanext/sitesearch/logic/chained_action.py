@@ -1,10 +1,12 @@
 from ckan import model
 from ckan.plugins import toolkit
 
-from ckanext.sitesearch.lib import index, rebuild
+from ckanext.sitesearch.lib import dirty, metrics
 
 
 @toolkit.chained_action
+@metrics.timed_hook
+@dirty.coalesced
 def package_create(up_func, context, data_dict):
 
     data_dict = up_func(context, data_dict)
@@ -12,31 +14,32 @@ def package_create(up_func, context, data_dict):
     if context.get('return_id_only', False) is False:
         owner_org = data_dict.get("owner_org", None)
         if owner_org:
-            rebuild.rebuild_orgs(entity_id=owner_org)
+            dirty.add("organization", owner_org)
 
     return data_dict
 
 
 @toolkit.chained_action
+@metrics.timed_hook
+@dirty.coalesced
 def package_delete(up_func, context, data_dict):
     package_id = toolkit.get_or_bust(data_dict, "id")
     pkg = model.Package.get(package_id)
     if not pkg:
         raise toolkit.ObjectNotFound
-    groups = pkg.get_groups()
+    # Marked before the core action runs, so in outbox mode the rows are
+    # committed with the deletion
+    for group in pkg.get_groups():
+        _add_group_or_org(group)
 
     up_func(context, data_dict)
 
-    for group in groups:
-        if group.is_organization:
-            rebuild.rebuild_orgs(entity_id=group.id)
-        else:
-            rebuild.rebuild_groups(entity_id=group.id)
-
     return data_dict
 
 
 @toolkit.chained_action
+@metrics.timed_hook
+@dirty.coalesced
 def package_update(up_func, context, data_dict):
     """Adds index rebuild logic to the package_update action.
 
@@ -58,15 +61,19 @@ def package_update(up_func, context, data_dict):
     return data_dict
 
 
+def _add_group_or_org(group):
+    dirty.add("organization" if group.is_organization else "group", group.id)
+
+
 def _rebuild_org_if_org_changed(data_dict, organization):
     """Rebuild both old and new organizations if they change."""
     new_org = data_dict.get("owner_org", None)
 
     if organization != new_org:
         if organization:
-            rebuild.rebuild_orgs(entity_id=organization)
+            dirty.add("organization", organization)
         if new_org:
-            rebuild.rebuild_orgs(entity_id=new_org)
+            dirty.add("organization", new_org)
 
 
 def _rebuild_org_if_pkg_state_changed(data_dict, state):
@@ -82,121 +89,215 @@ def _rebuild_org_if_pkg_state_changed(data_dict, state):
 
     new_state = data_dict.get("state")
     if state == "draft" and new_state == "active":
-        rebuild.rebuild_orgs(entity_id=new_org)
+        dirty.add("organization", new_org)
 
 
 @toolkit.chained_action
+@metrics.timed_hook
+@dirty.coalesced
 def organization_create(up_func, context, data_dict):
 
     data_dict = up_func(context, data_dict)
 
-    index.index_organization(data_dict)
+    dirty.add("organization", data_dict["id"], data_dict)
 
     return data_dict
 
 
 @toolkit.chained_action
+@metrics.timed_hook
+@dirty.coalesced
 def organization_update(up_func, context, data_dict):
 
     data_dict = up_func(context, data_dict)
 
-    index.index_organization(data_dict)
+    dirty.add("organization", data_dict["id"], data_dict)
 
     return data_dict
 
 
 @toolkit.chained_action
+@metrics.timed_hook
+@dirty.coalesced
 def organization_delete(up_func, context, data_dict):
 
-    up_func(context, data_dict)
+    # Deleted entities are removed from the index when reindexed
+    dirty.add("organization", data_dict["id"])
 
-    index.delete_organization(data_dict["id"])
+    up_func(context, data_dict)
 
     return data_dict
 
 
 @toolkit.chained_action
+@metrics.timed_hook
+@dirty.coalesced
 def group_create(up_func, context, data_dict):
 
     data_dict = up_func(context, data_dict)
 
-    index.index_group(data_dict)
+    dirty.add("group", data_dict["id"], data_dict)
 
     return data_dict
 
 
 @toolkit.chained_action
+@metrics.timed_hook
+@dirty.coalesced
 def group_update(up_func, context, data_dict):
 
     data_dict = up_func(context, data_dict)
 
-    index.index_group(data_dict)
+    dirty.add("group", data_dict["id"], data_dict)
 
     return data_dict
 
 
 @toolkit.chained_action
+@metrics.timed_hook
+@dirty.coalesced
 def group_delete(up_func, context, data_dict):
 
-    up_func(context, data_dict)
+    # Deleted entities are removed from the index when reindexed
+    dirty.add("group", data_dict["id"])
 
-    index.delete_group(data_dict["id"])
+    up_func(context, data_dict)
 
     return data_dict
 
 
 @toolkit.chained_action
+@metrics.timed_hook
+@dirty.coalesced
 def user_create(up_func, context, data_dict):
 
     data_dict = up_func(context, data_dict)
 
-    index.index_user(data_dict)
+    dirty.add("user", data_dict["id"], data_dict)
 
     return data_dict
 
 
 @toolkit.chained_action
+@metrics.timed_hook
+@dirty.coalesced
 def user_update(up_func, context, data_dict):
 
     data_dict = up_func(context, data_dict)
 
-    index.index_user(data_dict)
+    dirty.add("user", data_dict["id"], data_dict)
 
     return data_dict
 
 
 @toolkit.chained_action
+@metrics.timed_hook
+@dirty.coalesced
 def user_delete(up_func, context, data_dict):
 
-    up_func(context, data_dict)
+    # Deleted entities are removed from the index when reindexed
+    dirty.add("user", data_dict["id"])
 
-    index.delete_user(data_dict["id"])
+    up_func(context, data_dict)
 
 
 @toolkit.chained_action
+@metrics.timed_hook
+@dirty.coalesced
 def pages_update(up_func, context, data_dict):
 
-    up_func(context, data_dict)
+    # ckanext-pages commits the session itself (it doesn't support
+    # `defer_commit`), so the page is marked before, for the outbox row to
+    # be part of the same transaction
     name = data_dict.get("page") or data_dict.get("name")
-    page = toolkit.get_action("ckanext_pages_show")(context, {"page": name})
-    index.index_page(page)
+    dirty.add("page", name)
+
+    up_func(context, data_dict)
 
 
 @toolkit.chained_action
+@metrics.timed_hook
+@dirty.coalesced
 def pages_delete(up_func, context, data_dict):
 
-    up_func(context, data_dict)
+    # Deleted pages are removed from the index when reindexed
+    dirty.add("page", data_dict["id"])
 
-    index.delete_page(data_dict["id"])
+    up_func(context, data_dict)
 
 
 @toolkit.chained_action
+@metrics.timed_hook
+@dirty.coalesced
 def member_create(up_func, context, data_dict):
 
-    result = up_func(context, data_dict)
     object_type = data_dict.get("object_type", None)
 
     if object_type and object_type == "package":
-        rebuild.rebuild_groups(entity_id=data_dict["id"])
+        group = model.Group.get(data_dict["id"])
+        if not group:
+            raise toolkit.ObjectNotFound("Group not found: {}".format(data_dict["id"]))
+        _add_group_or_org(group)
+
+    return up_func(context, data_dict)
+
+
+def _bulk_update_affected_groups(data_dict, include_groups=False):
+    """Return the organization (and optionally the groups) of the datasets
+    changed by a bulk update action"""
+    groups = []
+
+    org = model.Group.get(data_dict.get("org_id"))
+    if org:
+        groups.append(org)
+
+    datasets = data_dict.get("datasets") or []
+    if include_groups and datasets:
+        group_ids = [
+            r[0]
+            for r in model.Session.query(model.Member.group_id)
+            .filter(model.Member.table_name == "package")
+            .filter(model.Member.table_id.in_(datasets))
+            .filter(model.Member.state == "active")
+            .distinct()
+        ]
+        for group_id in group_ids:
+            group = model.Group.get(group_id)
+            if group and group not in groups:
+                groups.append(group)
+
+    return groups
+
+
+@toolkit.chained_action
+@metrics.timed_hook
+@dirty.coalesced
+def bulk_update_private(up_func, context, data_dict):
+
+    for group in _bulk_update_affected_groups(data_dict):
+        _add_group_or_org(group)
+
+    return up_func(context, data_dict)
+
+
+@toolkit.chained_action
+@metrics.timed_hook
+@dirty.coalesced
+def bulk_update_public(up_func, context, data_dict):
+
+    for group in _bulk_update_affected_groups(data_dict):
+        _add_group_or_org(group)
+
+    return up_func(context, data_dict)
+
+
+@toolkit.chained_action
+@metrics.timed_hook
+@dirty.coalesced
+def bulk_update_delete(up_func, context, data_dict):
+
+    # Deleted datasets also change the dataset count of their groups
+    for group in _bulk_update_affected_groups(data_dict, include_groups=True):
+        _add_group_or_org(group)
 
-    return result
+    return up_func(context, data_dict)
@@ -30,3 +30,27 @@ def default_search_schema(
         "facet.limit": [ignore_missing, int_validator],
         "facet.field": [ignore_missing, convert_to_json_if_string, list_of_strings],
     }
+
+
+@validator_args
+def default_autocomplete_schema(
+    not_empty,
+    ignore_missing,
+    unicode_safe,
+    convert_to_list_if_string,
+    list_of_strings,
+    natural_number_validator,
+    limit_to_configured_maximum,
+    default,
+):
+    return {
+        "q": [not_empty, unicode_safe],
+        "entity_types": [ignore_missing, convert_to_list_if_string, list_of_strings],
+        "limit": [
+            default(10),
+            natural_number_validator,
+            limit_to_configured_maximum(
+                "ckanext.sitesearch.autocomplete.limit_max", 50
+            ),
+        ],
+    }
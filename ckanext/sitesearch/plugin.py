@@ -1,11 +1,27 @@
 import ckan.plugins as plugins
 import ckan.plugins.toolkit as toolkit
 
+from ckanext.sitesearch.lib.lazy import lazy_function
 
-from ckanext.sitesearch.cli import get_commands
-import ckanext.sitesearch.logic.action as action
-import ckanext.sitesearch.logic.chained_action as chained_action
-import ckanext.sitesearch.logic.auth as auth
+
+# Actions, auth functions and CLI commands are only imported when first
+# used, to keep the plugin import time low. See `test_plugin.py`.
+
+ACTION = "ckanext.sitesearch.logic.action:{}"
+CHAINED_ACTION = "ckanext.sitesearch.logic.chained_action:{}"
+AUTH = "ckanext.sitesearch.logic.auth:{}"
+
+
+def _search_action(name):
+    return lazy_function(ACTION.format(name))
+
+
+def _chained_action(name):
+    return lazy_function(CHAINED_ACTION.format(name))
+
+
+def _auth_function(name):
+    return lazy_function(AUTH.format(name))
 
 
 class SitesearchPlugin(plugins.SingletonPlugin):
@@ -13,7 +29,9 @@ class SitesearchPlugin(plugins.SingletonPlugin):
     plugins.implements(plugins.IActions)
     plugins.implements(plugins.IAuthFunctions)
     plugins.implements(plugins.IConfigurer)
+    plugins.implements(plugins.IConfigurable)
     plugins.implements(plugins.IClick)
+    plugins.implements(plugins.IBlueprint)
     plugins.implements(plugins.IPackageController, inherit=True)
 
     # IConfigurer
@@ -22,32 +40,46 @@ class SitesearchPlugin(plugins.SingletonPlugin):
         if not toolkit.check_ckan_version(min_version="2.9.0"):
             raise RuntimeError("This extension requires at least CKAN 2.9")
 
+    # IConfigurable
+
+    def configure(self, config_):
+        if toolkit.asbool(
+            config_.get("ckanext.sitesearch.autocomplete.build_on_startup", False)
+        ):
+            from ckanext.sitesearch.lib import autocomplete
+
+            autocomplete.build_on_startup()
+
     # IActions
 
     def get_actions(self):
         actions = {
-            "organization_search": action.organization_search,
-            "group_search": action.group_search,
-            "user_search": action.user_search,
-            "site_search": action.site_search,
-            "organization_create": chained_action.organization_create,
-            "organization_update": chained_action.organization_update,
-            "organization_delete": chained_action.organization_delete,
-            "group_create": chained_action.group_create,
-            "group_update": chained_action.group_update,
-            "group_delete": chained_action.group_delete,
-            "user_create": chained_action.user_create,
-            "user_update": chained_action.user_update,
-            "user_delete": chained_action.user_delete,
-            "package_create": chained_action.package_create,
-            "package_delete": chained_action.package_delete,
-            "package_update": chained_action.package_update,
-            "member_create": chained_action.member_create,
+            "organization_search": _search_action("organization_search"),
+            "group_search": _search_action("group_search"),
+            "user_search": _search_action("user_search"),
+            "site_search": _search_action("site_search"),
+            "sitesearch_autocomplete": _search_action("sitesearch_autocomplete"),
+            "organization_create": _chained_action("organization_create"),
+            "organization_update": _chained_action("organization_update"),
+            "organization_delete": _chained_action("organization_delete"),
+            "group_create": _chained_action("group_create"),
+            "group_update": _chained_action("group_update"),
+            "group_delete": _chained_action("group_delete"),
+            "user_create": _chained_action("user_create"),
+            "user_update": _chained_action("user_update"),
+            "user_delete": _chained_action("user_delete"),
+            "package_create": _chained_action("package_create"),
+            "package_delete": _chained_action("package_delete"),
+            "package_update": _chained_action("package_update"),
+            "member_create": _chained_action("member_create"),
+            "bulk_update_private": _chained_action("bulk_update_private"),
+            "bulk_update_public": _chained_action("bulk_update_public"),
+            "bulk_update_delete": _chained_action("bulk_update_delete"),
         }
         if plugins.plugin_loaded("pages"):
-            actions["page_search"] = action.page_search
-            actions["ckanext_pages_update"] = chained_action.pages_update
-            actions["ckanext_pages_delete"] = chained_action.pages_delete
+            actions["page_search"] = _search_action("page_search")
+            actions["ckanext_pages_update"] = _chained_action("pages_update")
+            actions["ckanext_pages_delete"] = _chained_action("pages_delete")
 
         return actions
 
@@ -55,22 +87,32 @@ class SitesearchPlugin(plugins.SingletonPlugin):
 
     def get_auth_functions(self):
         auth_functions = {
-            "organization_search": auth.organization_search,
-            "group_search": auth.group_search,
-            "user_search": auth.user_search,
-            "site_search": auth.site_search,
+            "organization_search": _auth_function("organization_search"),
+            "group_search": _auth_function("group_search"),
+            "user_search": _auth_function("user_search"),
+            "site_search": _auth_function("site_search"),
+            "sitesearch_autocomplete": _auth_function("sitesearch_autocomplete"),
+            "sitesearch_metrics": _auth_function("sitesearch_metrics"),
         }
         if plugins.plugin_loaded("pages"):
-            auth_functions["page_search"] = auth.page_search
+            auth_functions["page_search"] = _auth_function("page_search")
 
         return auth_functions
 
     # IClick
 
     def get_commands(self):
+        from ckanext.sitesearch.cli import get_commands
 
         return get_commands()
 
+    # IBlueprint
+
+    def get_blueprint(self):
+        from ckanext.sitesearch.views import get_blueprints
+
+        return get_blueprints()
+
     # IPackageController
 
     def before_search(self, search_dict):
@@ -0,0 +1,105 @@
+"""
+Helpers for the benchmarks in this folder
+
+Benchmarks run against the same CKAN, Solr and database instances as the
+tests, but they are skipped by default. To run them, do:
+
+    CKANEXT_SITESEARCH_BENCHMARKS=1 pytest --ckan-ini=test.ini -s ckanext/sitesearch/tests/benchmarks
+
+The size of the synthetic datasets can be adjusted with the
+`CKANEXT_SITESEARCH_BENCHMARKS_SIZE` environment variable.
+"""
+import datetime
+import os
+import random
+import time
+import uuid
+
+import pytest
+
+from ckanext.sitesearch.lib.stats import percentile
+
+
+benchmark = pytest.mark.skipif(
+    not os.environ.get("CKANEXT_SITESEARCH_BENCHMARKS"),
+    reason="Set CKANEXT_SITESEARCH_BENCHMARKS=1 to run the benchmarks",
+)
+
+DATASET_SIZE = int(os.environ.get("CKANEXT_SITESEARCH_BENCHMARKS_SIZE", 2000))
+
+WORDS = (
+    "water health transport budget education climate energy housing "
+    "police census river school hospital road rail bus tax forest city "
+    "county region national local open data statistics survey report"
+).split()
+
+
+def _sentence(rnd, length):
+    return " ".join(rnd.choice(WORDS) for _ in range(length))
+
+
+def synthetic_organizations(count=DATASET_SIZE, seed=0):
+    """Generate dicts shaped like the output of `organization_show`"""
+    rnd = random.Random(seed)
+    created = datetime.datetime(2020, 1, 1).isoformat()
+    for i in range(count):
+        title = _sentence(rnd, 3).title()
+        yield {
+            "id": str(uuid.UUID(int=rnd.getrandbits(128))),
+            "name": "org-{}".format(i),
+            "title": title,
+            "display_name": title,
+            "description": _sentence(rnd, 30),
+            "type": "organization",
+            "is_organization": True,
+            "state": "active",
+            "approval_status": "approved",
+            "image_url": "",
+            "created": created,
+            "package_count": rnd.randint(0, 500),
+            "extras": [{"key": "theme", "value": rnd.choice(WORDS)}],
+        }
+
+
+def synthetic_users(count=DATASET_SIZE, seed=0):
+    """Generate dicts shaped like the output of `user_show`"""
+    rnd = random.Random(seed)
+    created = datetime.datetime(2020, 1, 1).isoformat()
+    for i in range(count):
+        yield {
+            "id": str(uuid.UUID(int=rnd.getrandbits(128))),
+            "name": "user-{}".format(i),
+            "fullname": _sentence(rnd, 2).title(),
+            "about": _sentence(rnd, 20),
+            "email": "user-{}@example.com".format(i),
+            "state": "active",
+            "sysadmin": False,
+            "created": created,
+        }
+
+
+def timeit(func, repeat=50):
+    """Call `func` `repeat` times and return timing stats in ms"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+    return {
+        "mean": sum(timings) / len(timings),
+        "p50": percentile(timings, 50),
+        "p95": percentile(timings, 95),
+        "max": max(timings),
+    }
+
+
+def report(title, results):
+    """Print a table with the stats returned by `timeit` for each case"""
+    print("\n{}".format(title))
+    print("{:<40} {:>10} {:>10} {:>10} {:>10}".format("", "mean", "p50", "p95", "max"))
+    for name, stats in results.items():
+        print(
+            "{:<40} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.2f}".format(
+                name, stats["mean"], stats["p50"], stats["p95"], stats["max"]
+            )
+        )
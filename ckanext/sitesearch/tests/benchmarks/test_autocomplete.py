@@ -0,0 +1,48 @@
+import time
+
+import pytest
+
+from ckanext.sitesearch.lib import autocomplete, index, query
+from ckanext.sitesearch.tests.benchmarks.helpers import (
+    benchmark,
+    report,
+    synthetic_organizations,
+    timeit,
+)
+
+
+PREFIXES = ["w", "wat", "health", "org-1", "trans"]
+
+
+@benchmark
+@pytest.mark.usefixtures("clean_db")
+def test_benchmark_autocomplete():
+
+    index.clear_all()
+    for org in synthetic_organizations():
+        index.index_organization(org, defer_commit=True)
+    index.commit()
+
+    start = time.perf_counter()
+    autocomplete.reset()
+    autocomplete.get_index()
+    build_time = time.perf_counter() - start
+
+    results = {}
+    for prefix in PREFIXES:
+        results["autocomplete: " + prefix] = timeit(
+            lambda: autocomplete.lookup(prefix, limit=10), repeat=1000
+        )
+        results["search: " + prefix] = timeit(
+            lambda: query.query_organizations({"q": prefix + "*", "rows": 10})
+        )
+
+    report(
+        "Autocomplete (build: {:.2f}s) vs prefix searches, times in ms".format(
+            build_time
+        ),
+        results,
+    )
+
+    autocomplete.reset()
+    index.clear_all()
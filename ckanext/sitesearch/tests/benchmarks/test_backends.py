@@ -0,0 +1,60 @@
+import time
+
+import pytest
+
+from ckan.plugins import toolkit
+
+from ckanext.sitesearch.lib import index, query
+from ckanext.sitesearch.tests.benchmarks.helpers import (
+    benchmark,
+    report,
+    synthetic_organizations,
+    timeit,
+)
+
+
+QUERIES = {
+    "all": {"q": "*:*", "rows": 20},
+    "single term": {"q": "water", "rows": 20},
+    "two terms": {"q": "water health", "rows": 20},
+    "or terms": {"q": "water OR river", "rows": 20},
+    "prefix": {"q": "hosp*", "rows": 20},
+    "field": {"q": "name:org-10", "rows": 20},
+    "sort + paging": {"q": "data", "sort": "title asc", "start": 100, "rows": 20},
+    "facets": {
+        "q": "data",
+        "rows": 20,
+        "facet": "on",
+        "facet.field": ["theme"],
+        "facet.limit": 10,
+    },
+}
+
+
+@benchmark
+@pytest.mark.usefixtures("clean_db")
+@pytest.mark.parametrize("backend", ["solr", "postgres"])
+def test_benchmark_backends(backend, monkeypatch):
+
+    monkeypatch.setitem(toolkit.config, "ckanext.sitesearch.backend", backend)
+
+    index.clear_all()
+
+    start = time.perf_counter()
+    for org in synthetic_organizations():
+        index.index_organization(org, defer_commit=True)
+    index.commit()
+    indexing_time = time.perf_counter() - start
+
+    results = {}
+    for name, params in QUERIES.items():
+        results[name] = timeit(lambda: query.query_organizations(dict(params)))
+
+    report(
+        "Backend: {} (indexing: {:.2f}s), query times in ms".format(
+            backend, indexing_time
+        ),
+        results,
+    )
+
+    index.clear_all()
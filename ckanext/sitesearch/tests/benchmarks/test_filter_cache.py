@@ -0,0 +1,104 @@
+import random
+import time
+
+import pytest
+
+from ckan.lib.search.query import solr_literal
+from ckan.plugins import toolkit
+
+from ckanext.sitesearch.lib import index, query
+from ckanext.sitesearch.lib.backends import get_backend
+from ckanext.sitesearch.lib.backends import solr
+from ckanext.sitesearch.tests.benchmarks.helpers import (
+    DATASET_SIZE,
+    benchmark,
+    percentile,
+    synthetic_organizations,
+)
+
+
+LABELS = ["group_id-{}".format(i) for i in range(100)]
+
+USERS = 500
+
+QUERIES_PER_USER = 4
+
+TERMS = ["*:*", "water", "health", "data"]
+
+
+def _legacy_filter(permission_labels):
+    # Filter used before the terms query parser, with the labels in the
+    # order they were provided
+    return "+permission_labels:(%s)" % " OR ".join(
+        solr_literal(p) for p in permission_labels
+    )
+
+
+def _filter_cache_stats():
+    stats = get_backend().index_info().get("filter_cache") or {}
+    return stats.get("cumulative_lookups", 0), stats.get("cumulative_hits", 0)
+
+
+@benchmark
+@pytest.mark.usefixtures("clean_db")
+@pytest.mark.parametrize("mode", ["boolean", "terms", "terms cache=false"])
+def test_benchmark_filter_cache(mode, monkeypatch):
+
+    if mode == "boolean":
+        monkeypatch.setattr(solr, "_permission_labels_filter", _legacy_filter)
+    elif mode == "terms cache=false":
+        monkeypatch.setitem(
+            toolkit.config, "ckanext.sitesearch.permission_labels.cache", False
+        )
+
+    index.clear_all()
+    rnd = random.Random(0)
+    docs = []
+    for org in synthetic_organizations():
+        doc = index.prepare_organization(org)
+        doc["permission_labels"] = ["public"] + rnd.sample(LABELS, 2)
+        docs.append(doc)
+    index.index_documents(docs, defer_commit=True)
+    index.commit()
+
+    # Users with a random set of labels, which are not always provided in
+    # the same order
+    users = [["public"] + rnd.sample(LABELS, rnd.randint(1, 20)) for _ in range(USERS)]
+    requests = []
+    for labels in users:
+        for term in rnd.sample(TERMS, QUERIES_PER_USER):
+            requests.append((term, rnd.sample(labels, len(labels))))
+    rnd.shuffle(requests)
+
+    lookups, hits = _filter_cache_stats()
+    timings = []
+    for term, labels in requests:
+        start = time.perf_counter()
+        query._run_query(
+            {"q": term, "rows": 20},
+            entity_type="organization",
+            permission_labels=labels,
+        )
+        timings.append((time.perf_counter() - start) * 1000)
+    new_lookups, new_hits = _filter_cache_stats()
+    lookups, hits = new_lookups - lookups, new_hits - hits
+
+    print(
+        "\nPermission labels filter: {} ({} docs, {} users, {} queries)".format(
+            mode, DATASET_SIZE, USERS, len(requests)
+        )
+    )
+    print(
+        "filterCache lookups: {}, hits: {}, hit rate: {:.1%}".format(
+            lookups, hits, float(hits) / lookups if lookups else 0
+        )
+    )
+    print(
+        "query times in ms, mean: {:.2f}, p50: {:.2f}, p95: {:.2f}".format(
+            sum(timings) / len(timings),
+            percentile(timings, 50),
+            percentile(timings, 95),
+        )
+    )
+
+    index.clear_all()
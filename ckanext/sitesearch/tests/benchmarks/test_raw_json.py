@@ -0,0 +1,66 @@
+import json
+import time
+
+import pytest
+
+from ckan.tests import helpers
+
+from ckanext.sitesearch.lib import index
+from ckanext.sitesearch.tests.benchmarks.helpers import (
+    benchmark,
+    percentile,
+    synthetic_organizations,
+)
+
+
+ROWS = 1000
+
+REPEAT = 20
+
+
+def _cpu_time(func):
+    """Return the CPU time of each call to `func` in ms"""
+    timings = []
+    for _ in range(REPEAT):
+        start = time.process_time()
+        func()
+        timings.append((time.process_time() - start) * 1000)
+    return timings
+
+
+@benchmark
+@pytest.mark.usefixtures("clean_db")
+def test_benchmark_raw_json():
+
+    index.clear_all()
+    for org in synthetic_organizations(count=max(ROWS, 1000)):
+        index.index_organization(org, defer_commit=True)
+    index.commit()
+
+    def parsed():
+        # What the action API does: decode the documents and serialise
+        # the results again
+        result = helpers.call_action("organization_search", q="*:*", rows=ROWS)
+        return json.dumps({"success": True, "result": result})
+
+    def raw():
+        result = helpers.call_action(
+            "organization_search", context={"raw_json": True}, q="*:*", rows=ROWS
+        )
+        return '{{"success": true, "result": {}}}'.format(result)
+
+    assert json.loads(raw()) == json.loads(parsed())
+
+    print("\nSearch API response with rows={}, CPU time in ms".format(ROWS))
+    for name, func in (("parsed", parsed), ("raw_json", raw)):
+        timings = _cpu_time(func)
+        print(
+            "{:<10} mean: {:.2f}, p50: {:.2f}, p95: {:.2f}".format(
+                name,
+                sum(timings) / len(timings),
+                percentile(timings, 50),
+                percentile(timings, 95),
+            )
+        )
+
+    index.clear_all()
@@ -0,0 +1,33 @@
+import pytest
+
+from ckanext.sitesearch.lib import utils
+from ckanext.sitesearch.tests.benchmarks.helpers import benchmark, report, timeit
+from ckanext.sitesearch.tests.test_utils import (
+    PAGE_CONTENT,
+    _sanitize_text_reference,
+)
+
+
+@benchmark
+@pytest.mark.parametrize("size", [1, 100, 2000])
+def test_benchmark_sanitize_html_text(size):
+
+    text = PAGE_CONTENT * size
+
+    cases = {
+        "strip_html_tags + unescape": lambda: _sanitize_text_reference(text),
+        "sanitize_html_text (regex)": lambda: utils.sanitize_html_text(
+            text, use_lxml=False
+        ),
+    }
+    if utils.lxml_html is not None:
+        cases["sanitize_html_text (lxml)"] = lambda: utils.sanitize_html_text(
+            text, use_lxml=True
+        )
+
+    results = {name: timeit(func, repeat=20) for name, func in cases.items()}
+
+    report(
+        "Page content sanitization, {:.0f}KB, times in ms".format(len(text) / 1024),
+        results,
+    )
@@ -0,0 +1,76 @@
+import os
+import time
+import tracemalloc
+
+import pytest
+
+from ckan.plugins import toolkit
+
+from ckanext.sitesearch.lib import index
+from ckanext.sitesearch.lib.backends import get_backend
+from ckanext.sitesearch.tests.benchmarks.helpers import (
+    DATASET_SIZE,
+    benchmark,
+    synthetic_organizations,
+)
+
+
+@benchmark
+@pytest.mark.usefixtures("clean_db")
+@pytest.mark.parametrize(
+    "compress,stream", [(False, False), (True, False), (False, True), (True, True)]
+)
+def test_benchmark_solr_client(compress, stream, monkeypatch):
+
+    if compress and not os.environ.get("CKANEXT_SITESEARCH_SOLR_GZIP"):
+        pytest.skip(
+            "Set CKANEXT_SITESEARCH_SOLR_GZIP=1 if Solr accepts compressed requests"
+        )
+
+    monkeypatch.setitem(
+        toolkit.config, "ckanext.sitesearch.solr.compress_requests", compress
+    )
+    monkeypatch.setitem(
+        toolkit.config,
+        "ckanext.sitesearch.solr.stream_rows",
+        1 if stream else DATASET_SIZE + 1,
+    )
+
+    index.clear_all()
+    docs = [index.prepare_organization(org) for org in synthetic_organizations()]
+
+    start = time.perf_counter()
+    index.index_documents(docs, defer_commit=True)
+    index.commit()
+    indexing_time = time.perf_counter() - start
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = get_backend().search(
+        {"q": "*:*", "rows": DATASET_SIZE},
+        entity_type="organization",
+        site_id=toolkit.config.get("ckan.site_id"),
+    )
+    search_time = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    assert len(result["results"]) == DATASET_SIZE
+
+    print(
+        "\nSolr client, compress requests: {}, stream responses: {}".format(
+            compress, stream
+        )
+    )
+    print(
+        "indexing {} docs: {:.2f}s, search rows={}: {:.2f}s, "
+        "peak memory: {:.1f} MB".format(
+            DATASET_SIZE,
+            indexing_time,
+            DATASET_SIZE,
+            search_time,
+            peak / 1024.0 / 1024,
+        )
+    )
+
+    index.clear_all()
@@ -0,0 +1,95 @@
+import json
+import time
+
+import pytest
+
+from ckan import model
+from ckan.plugins import toolkit
+
+from ckanext.sitesearch.lib import hydrate, index
+from ckanext.sitesearch.lib.backends import get_backend
+from ckanext.sitesearch.tests.benchmarks.helpers import (
+    benchmark,
+    report,
+    synthetic_organizations,
+    timeit,
+)
+
+
+QUERIES = {
+    "all": {"q": "*:*", "rows": 20},
+    "single term": {"q": "water", "rows": 20},
+    "rows=100": {"q": "data", "rows": 100},
+}
+
+
+def _create_organizations(orgs):
+    # Much faster than going through the actions
+    for org in orgs:
+        model.Session.add(
+            model.Group(
+                id=org["id"],
+                name=org["name"],
+                title=org["title"],
+                description=org["description"],
+                type="organization",
+                is_organization=True,
+                state="active",
+                approval_status="approved",
+            )
+        )
+    model.Session.commit()
+
+
+def _stored_size():
+    return sum(
+        len(json.dumps(doc))
+        for doc in get_backend().iter_documents(
+            toolkit.config.get("ckan.site_id"), entity_type="organization"
+        )
+    )
+
+
+@benchmark
+@pytest.mark.usefixtures("clean_db")
+@pytest.mark.parametrize("thin_documents", [False, True])
+def test_benchmark_thin_documents(thin_documents, monkeypatch):
+
+    monkeypatch.setitem(
+        toolkit.config, "ckanext.sitesearch.thin_documents", thin_documents
+    )
+    monkeypatch.setattr(hydrate, "_cache", None)
+
+    orgs = list(synthetic_organizations())
+    _create_organizations(orgs)
+
+    index.clear_all()
+
+    start = time.perf_counter()
+    for org in orgs:
+        index.index_organization(org, defer_commit=True)
+    index.commit()
+    indexing_time = time.perf_counter() - start
+
+    action = toolkit.get_action("organization_search")
+
+    def search(params, clear_cache=False):
+        if clear_cache:
+            hydrate.get_cache().clear()
+        action({"ignore_auth": True}, dict(params))
+
+    results = {}
+    for name, params in QUERIES.items():
+        if thin_documents:
+            results[name + " (no cache)"] = timeit(lambda: search(params, True))
+        results[name] = timeit(lambda: search(params))
+
+    report(
+        "Thin documents: {} (indexing: {:.2f}s, stored size: {:.1f}KB), "
+        "action times in ms".format(
+            thin_documents, indexing_time, _stored_size() / 1024.0
+        ),
+        results,
+    )
+
+    index.clear_all()
@@ -0,0 +1,71 @@
+import time
+
+import pytest
+
+from ckan.plugins import toolkit
+
+from ckanext.sitesearch.lib import index, query
+from ckanext.sitesearch.tests.benchmarks.helpers import (
+    DATASET_SIZE,
+    WORDS,
+    benchmark,
+    percentile,
+    synthetic_users,
+)
+
+
+# Leading wildcards scan all the terms of the field, so they need a large
+# index to show the difference
+USERS = DATASET_SIZE * 25
+
+# Each query is run once, as repeating it would be answered from Solr's
+# queryResultCache
+SUFFIXES = sorted({word[-3:] for word in WORDS})
+
+
+@benchmark
+@pytest.mark.usefixtures("clean_db")
+def test_benchmark_leading_wildcards(monkeypatch):
+    """
+    Leading wildcard searches on the `text` field, and rewritten to prefix
+    searches on the reversed words field
+
+    The number of results is only the same if the Solr schema defines the
+    `text_reversed` field (see the README), otherwise it is indexed as a
+    single string.
+    """
+
+    monkeypatch.setitem(toolkit.config, "ckanext.sitesearch.wildcards", "reversed")
+
+    index.clear_users()
+    batch = []
+    for user in synthetic_users(USERS):
+        batch.append(index.prepare_user(user))
+        if len(batch) == 1000:
+            index.index_documents(batch, defer_commit=True)
+            batch = []
+    index.index_documents(batch, defer_commit=True)
+    index.commit()
+
+    print("\nLeading wildcards ({} users), times in ms".format(USERS))
+    print("{:<10} {:>10} {:>10} {:>10} {:>10}".format("", "mean", "p50", "p95", "hits"))
+    for mode in ("allow", "reversed"):
+        monkeypatch.setitem(toolkit.config, "ckanext.sitesearch.wildcards", mode)
+        timings = []
+        hits = 0
+        for suffix in SUFFIXES:
+            start = time.perf_counter()
+            result = query.query_users({"q": "*" + suffix, "rows": 20})
+            timings.append((time.perf_counter() - start) * 1000)
+            hits += result["count"]
+        print(
+            "{:<10} {:>10.2f} {:>10.2f} {:>10.2f} {:>10}".format(
+                mode,
+                sum(timings) / len(timings),
+                percentile(timings, 50),
+                percentile(timings, 95),
+                hits,
+            )
+        )
+
+    index.clear_users()
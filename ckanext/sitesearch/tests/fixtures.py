@@ -2,6 +2,7 @@ import pytest
 
 from ckan.lib.search.common import make_connection
 
+from ckanext.sitesearch import db
 from ckanext.sitesearch.lib.index import clear_all
 
 
@@ -14,3 +15,14 @@ def solr():
 @pytest.fixture
 def clean_index():
     clear_all()
+
+
+@pytest.fixture
+def clean_db(reset_db):
+    """Like the core `clean_db` fixture, also creating the sitesearch tables
+
+    They are created by `ckan sitesearch init` on real sites, but the core
+    fixture drops all tables in the database.
+    """
+    reset_db()
+    db.init_db()
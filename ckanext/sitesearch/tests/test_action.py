@@ -1,4 +1,5 @@
 import datetime
+import json
 from unittest import mock
 
 import pytest
@@ -8,8 +9,9 @@ from ckan.plugins import toolkit
 from ckan.lib.search import SearchQueryError, clear_all as reset_index
 from ckan.tests import factories, helpers
 
+from ckanext.sitesearch.lib import query
 from ckanext.sitesearch.lib.index import index_page
-from ckanext.sitesearch.logic.action import parse_search_params
+from ckanext.sitesearch.logic.action import RawJSON, parse_search_params
 from ckanext.pages import db as pages_db
 
 call_action = helpers.call_action
@@ -164,6 +166,25 @@ class TestGroupOrOrgSearch(object):
         assert result["search_facets"]["extra_org_common"]["items"][1]["name"] == "pear"
         assert result["search_facets"]["extra_org_common"]["items"][1]["count"] == 1
 
+    def test_organization_search_raw_json(self):
+        params = {
+            "q": "organization",
+            "facet": "on",
+            "facet.field": ["extra_org_common"],
+        }
+
+        result = call_action(
+            "organization_search", context={"raw_json": True}, **params
+        )
+
+        assert isinstance(result, RawJSON)
+        assert json.loads(result) == call_action("organization_search", **params)
+
+    def test_group_search_raw_json_no_results(self):
+        result = call_action("group_search", context={"raw_json": True}, q="nothing")
+
+        assert json.loads(result) == {"count": 0, "results": [], "search_facets": {}}
+
 
 @pytest.fixture(scope="class")
 def user_search_fixtures():
@@ -672,6 +693,58 @@ class TestSiteSearch(object):
 
         assert "users" not in result
 
+    @pytest.mark.parametrize("q", [None, "behold"])
+    def test_site_search_counts_only(self, q):
+        params = {"q": q} if q else {}
+
+        full = call_action("site_search", **params)
+        counts = call_action("site_search", counts_only=True, **params)
+
+        assert list(counts.keys()) == list(full.keys())
+        for name, result in counts.items():
+            assert result == {
+                "count": full[name]["count"],
+                "results": [],
+                "search_facets": {},
+            }
+
+    def test_site_search_counts_only_single_query(self):
+        with mock.patch(
+            "ckanext.sitesearch.logic.action.query.count_entity_types",
+            wraps=query.count_entity_types,
+        ) as count_entity_types, mock.patch(
+            "ckanext.sitesearch.logic.action.query.query_organizations"
+        ) as query_organizations:
+            result = call_action("site_search", counts_only="true", q="behold")
+
+        assert count_entity_types.call_count == 1
+        assert sorted(count_entity_types.call_args[0][1]) == [
+            "group",
+            "organization",
+            "page",
+            "user",
+        ]
+        query_organizations.assert_not_called()
+        assert result["organizations"]["count"] == 1
+
+    def test_site_search_counts_only_namespace_params(self):
+        result = call_action(
+            "site_search", counts_only=True, **{"organizations.q": "behold"}
+        )
+
+        assert result["organizations"]["count"] == 1
+        assert result["groups"]["count"] == 1
+
+    def test_site_search_counts_only_not_auth(self):
+        user = factories.User()
+        context = {"user": user["name"], "ignore_auth": False}
+
+        result = call_action("site_search", context=context, counts_only=True)
+
+        assert "users" not in result
+        # Private pages are not counted
+        assert result["pages"]["count"] == 2
+
 
 class TestParseSearchParams(object):
     def test_parse_params(self):
@@ -0,0 +1,281 @@
+from unittest import mock
+
+import pytest
+
+from ckan import model, plugins
+from ckan.plugins import toolkit
+from ckan.tests import factories, helpers
+
+from ckanext.sitesearch.lib import autocomplete, index
+from ckanext.sitesearch.lib.backends import get_backend
+from ckanext.sitesearch.lib.generation import bump_generation
+from ckanext.pages import db as pages_db
+
+
+call_action = helpers.call_action
+
+
+def _wait_for_rebuild():
+    # Held by the background thread until it finishes
+    with autocomplete._load_lock:
+        pass
+
+
+def _entry(id_, name, title, entity_type="organization", labels=None):
+    return {
+        "id": id_,
+        "name": name,
+        "title": title,
+        "entity_type": entity_type,
+        "permission_labels": labels,
+    }
+
+
+@pytest.fixture
+def autocomplete_index():
+    autocomplete.reset()
+    yield
+    autocomplete.reset()
+
+
+class TestPrefixIndex(object):
+    def setup_method(self):
+        self.index = autocomplete.PrefixIndex()
+        self.index.load(
+            [
+                _entry("1", "dept-transport", "Department of Transport"),
+                _entry("2", "health", "Ministry of Health"),
+                _entry("3", "énergie", "Énergie Publique", entity_type="group"),
+                _entry("4", "news", "Latest news", "page", labels=["public"]),
+                _entry("5", "drafts", "Draft news", "page", labels=["sysadmin"]),
+            ]
+        )
+
+    def _ids(self, *args, **kwargs):
+        return [r["id"] for r in self.index.lookup(*args, **kwargs)]
+
+    def test_prefix_of_name_title_or_word(self):
+        assert self._ids("dept") == ["1"]
+        assert self._ids("depart") == ["1"]
+        assert self._ids("trans") == ["1"]
+        assert self._ids("ministry of h") == ["2"]
+
+    def test_normalised(self):
+        assert self._ids("  HEALTH ") == ["2"]
+        assert self._ids("energ") == ["3"]
+        assert self._ids("Éner") == ["3"]
+
+    def test_no_duplicates(self):
+        # Matches both the name and the title
+        assert self._ids("health") == ["2"]
+
+    def test_entity_types(self):
+        assert self._ids("e", entity_types=["group"]) == ["3"]
+
+    def test_permission_labels(self):
+        assert self._ids("news") == []
+        assert self._ids("news", permission_labels=["public"]) == ["4"]
+        assert sorted(
+            self._ids("news", permission_labels=["public", "sysadmin"])
+        ) == ["4", "5"]
+
+    def test_limit(self):
+        assert len(self._ids("d", limit=1)) == 1
+
+    def test_result_fields(self):
+        assert self.index.lookup("dept") == [
+            {
+                "id": "1",
+                "name": "dept-transport",
+                "title": "Department of Transport",
+                "entity_type": "organization",
+            }
+        ]
+
+    def test_add_and_remove(self):
+        self.index.add(_entry("1", "dept-roads", "Department of Roads"))
+
+        assert self._ids("roads") == ["1"]
+        assert self._ids("transport") == []
+
+        self.index.remove("organization", "dept-roads")
+
+        assert self._ids("dep") == []
+        assert len(self.index) == 4
+
+
+@pytest.mark.usefixtures("clean_db", "clean_index", "autocomplete_index")
+class TestAutocompleteAction(object):
+    def test_autocomplete(self):
+        org = factories.Organization(name="transport-org", title="Transport")
+        group = factories.Group(name="transport-group", title="Transport group")
+        factories.Organization(name="health", title="Health")
+
+        result = call_action("sitesearch_autocomplete", q="transp")
+
+        assert sorted((r["entity_type"], r["id"]) for r in result) == sorted(
+            [("organization", org["id"]), ("group", group["id"])]
+        )
+        assert set(result[0].keys()) == {"id", "name", "title", "entity_type"}
+
+    def test_entity_types(self):
+        factories.Organization(name="transport-org")
+        group = factories.Group(name="transport-group")
+
+        result = call_action(
+            "sitesearch_autocomplete", q="transport", entity_types=["group"]
+        )
+
+        assert [r["id"] for r in result] == [group["id"]]
+
+    def test_unknown_entity_types(self):
+        with pytest.raises(toolkit.ValidationError):
+            call_action("sitesearch_autocomplete", q="a", entity_types=["dataset"])
+
+    def test_q_required(self):
+        with pytest.raises(toolkit.ValidationError):
+            call_action("sitesearch_autocomplete")
+
+    def test_users_only_for_sysadmins(self):
+        factories.User(name="transport-user")
+        user = factories.User()
+        sysadmin = factories.Sysadmin()
+
+        result = helpers.call_action(
+            "sitesearch_autocomplete",
+            context={"user": user["name"], "ignore_auth": False},
+            q="transport",
+        )
+        assert result == []
+
+        result = helpers.call_action(
+            "sitesearch_autocomplete",
+            context={"user": sysadmin["name"], "ignore_auth": False},
+            q="transport",
+        )
+        assert [r["name"] for r in result] == ["transport-user"]
+
+    def test_updated_on_write(self):
+        factories.Organization(name="transport-org")
+        assert len(call_action("sitesearch_autocomplete", q="transport")) == 1
+
+        org = factories.Organization(name="transport-org-2")
+        assert len(call_action("sitesearch_autocomplete", q="transport")) == 2
+
+        call_action("organization_delete", id=org["id"])
+        assert len(call_action("sitesearch_autocomplete", q="transport")) == 1
+
+    @pytest.mark.ckan_config("ckanext.sitesearch.autocomplete.refresh_interval", 0)
+    def test_rebuilt_when_the_generation_changes(self):
+        factories.Organization(name="transport-org")
+        prefix_index = autocomplete.get_index()
+        assert autocomplete.get_index() is prefix_index
+
+        # Committed by another process
+        bump_generation()
+
+        # The previous one is used while it is rebuilt in the background
+        assert autocomplete.get_index() is prefix_index
+        _wait_for_rebuild()
+        assert autocomplete.get_index() is not prefix_index
+
+    def test_generation_read_every_refresh_interval(self):
+        autocomplete.get_index()
+
+        with mock.patch.object(autocomplete, "get_generation") as get_generation:
+            autocomplete.get_index()
+            autocomplete.get_index()
+
+        assert not get_generation.called
+
+    @pytest.mark.ckan_config("ckanext.sitesearch.autocomplete.refresh_interval", 0)
+    def test_not_rebuilt_after_own_writes(self):
+        prefix_index = autocomplete.get_index()
+
+        org = factories.Organization(name="transport-org")
+        factories.Group(name="transport-group")
+        index.index_organization(dict(org, title="Roads"), defer_commit=True)
+
+        # Deferred writes are only applied once committed
+        assert [r["title"] for r in autocomplete.lookup("roads")] == []
+        index.commit()
+        assert [r["title"] for r in autocomplete.lookup("roads")] == ["Roads"]
+
+        with mock.patch.object(autocomplete, "build") as build:
+            assert autocomplete.get_index() is prefix_index
+            _wait_for_rebuild()
+        assert not build.called
+        assert len(autocomplete.lookup("transport")) == 2
+
+    def test_built_with_the_needed_fields_only(self):
+        factories.User(name="transport-user", fullname="Transport Officer")
+        backend = get_backend()
+
+        with mock.patch.object(
+            backend, "iter_documents", wraps=backend.iter_documents
+        ) as iter_documents:
+            result = autocomplete.lookup("officer")
+
+        assert iter_documents.call_args[1]["fields"] == autocomplete.FIELDS
+        assert [r["title"] for r in result] == ["Transport Officer"]
+
+    @pytest.mark.ckan_config("ckanext.sitesearch.autocomplete.refresh_interval", 0)
+    @pytest.mark.ckan_config("ckanext.sitesearch.autocomplete.ttl", "0")
+    def test_rebuilt_after_ttl_without_generation(self):
+        with mock.patch.object(autocomplete, "get_generation", return_value=None):
+            prefix_index = autocomplete.get_index()
+            autocomplete.get_index()
+            _wait_for_rebuild()
+            assert autocomplete.get_index() is not prefix_index
+
+    @pytest.mark.ckan_config("ckanext.sitesearch.autocomplete.build_on_startup", True)
+    def test_build_on_startup(self):
+        plugin = plugins.get_plugin("sitesearch")
+
+        plugin.configure(toolkit.config)
+
+        assert autocomplete._index is not None
+
+    def test_page_permission_labels(self):
+        pages_db.init_db()
+        sysadmin = factories.Sysadmin()
+        context = {
+            "user": sysadmin["name"],
+            "auth_user_obj": model.User.get(sysadmin["id"]),
+        }
+        call_action(
+            "ckanext_pages_update",
+            context=context,
+            name="transport-public",
+            title="Transport",
+            content="",
+            private=False,
+            page_type="page",
+        )
+        call_action(
+            "ckanext_pages_update",
+            context=context,
+            name="transport-private",
+            title="Transport private",
+            content="",
+            private=True,
+            page_type="page",
+        )
+
+        result = helpers.call_action(
+            "sitesearch_autocomplete",
+            context={"user": "", "ignore_auth": False},
+            q="transport",
+        )
+        assert [r["name"] for r in result] == ["transport-public"]
+
+        result = helpers.call_action(
+            "sitesearch_autocomplete",
+            context={"user": sysadmin["name"], "ignore_auth": False},
+            q="transport",
+            entity_types=["page"],
+        )
+        assert sorted(r["name"] for r in result) == [
+            "transport-private",
+            "transport-public",
+        ]
@@ -0,0 +1,352 @@
+import gzip
+import io
+import json
+from unittest import mock
+
+import pysolr
+import pytest
+
+from ckan import model
+from ckan.plugins import toolkit
+from ckan.tests import factories, helpers
+
+from ckanext.sitesearch import db
+from ckanext.sitesearch.lib.backends import SearchBackend, get_backend
+from ckanext.sitesearch.lib.backends.postgres import PostgresBackend, _to_tsquery
+from ckanext.sitesearch.lib.backends.solr import (
+    SolrBackend,
+    SolrClient,
+    StreamedResults,
+    _permission_labels_filter,
+)
+from ckanext.sitesearch.lib.index import clear_all
+
+call_action = helpers.call_action
+
+
+def test_default_backend_is_solr():
+
+    assert isinstance(get_backend(), SolrBackend)
+
+
+@pytest.mark.ckan_config("ckanext.sitesearch.backend", "unknown")
+def test_unknown_backend():
+
+    with pytest.raises(RuntimeError):
+        get_backend()
+
+
+def test_backends_implement_all_methods():
+    class IncompleteBackend(SearchBackend):
+        def add(self, docs, commit=False):
+            pass
+
+    with pytest.raises(TypeError):
+        IncompleteBackend()
+
+
+@pytest.mark.usefixtures("clean_db")
+def test_postgres_backend_requires_table(monkeypatch):
+
+    monkeypatch.setattr(db, "_checked_tables", set())
+    db.document_table.drop(model.meta.engine)
+    try:
+        with pytest.raises(RuntimeError, match="ckan sitesearch init"):
+            PostgresBackend()
+    finally:
+        db.init_db()
+
+    assert PostgresBackend()
+
+
+def test_to_tsquery():
+
+    assert _to_tsquery("pear") == "'pear'"
+    assert _to_tsquery("pea*") == "'pea':*"
+    assert _to_tsquery("pear OR peach") == "('pear') | 'peach'"
+    assert _to_tsquery("pear peach") == "('pear') & 'peach'"
+    assert _to_tsquery('"great group"') == "('great' <-> 'group')"
+    assert _to_tsquery("*:*") is None
+
+
+def test_permission_labels_filter():
+
+    assert (
+        _permission_labels_filter(["sysadmin", "group_id-b", "public", "group_id-a"])
+        == "{!terms f=permission_labels}group_id-a,group_id-b,public,sysadmin"
+    )
+
+
+@pytest.mark.ckan_config("ckanext.sitesearch.permission_labels.cache", False)
+@pytest.mark.ckan_config("ckanext.sitesearch.permission_labels.cost", 200)
+def test_permission_labels_filter_not_cached():
+
+    assert (
+        _permission_labels_filter(["public"])
+        == "{!terms f=permission_labels cache=false cost=200}public"
+    )
+
+
+def test_solr_count_permission_labels_filter():
+
+    backend = SolrBackend()
+    with mock.patch.object(backend, "search", return_value={"facets": {}}) as search:
+        backend.count(
+            {"q": "*:*"},
+            ["organization", "page"],
+            permission_labels=["public", "member-a"],
+        )
+
+    assert search.call_args[0][0]["fq_list"] == [
+        "+entity_type:(organization OR page)",
+        '(*:* -entity_type:(page)) OR _query_:"{!terms f=permission_labels}'
+        'member-a,public"',
+    ]
+
+
+@pytest.mark.usefixtures("clean_db", "clean_index")
+def test_solr_search_filters():
+
+    factories.Organization()
+
+    query = {"q": "*:*"}
+    get_backend().search(
+        query,
+        entity_type="organization",
+        site_id="test.ckan.net",
+        permission_labels=["public"],
+    )
+
+    assert query["fq"] == [
+        "+entity_type:organization",
+        '+site_id:"test.ckan.net"',
+        "{!terms f=permission_labels}public",
+    ]
+
+
+@mock.patch.object(pysolr.Solr, "_send_request")
+def test_solr_client_compression(send_request):
+
+    conn = SolrClient("http://solr/ckan", compress_requests=True)
+    body = "<add>{}</add>".format("<doc></doc>" * 1000)
+
+    conn._send_request("post", "update/", body, {"Content-type": "text/xml"})
+
+    args, kwargs = send_request.call_args
+    assert gzip.decompress(kwargs["body"]).decode("utf-8") == body
+    assert kwargs["headers"] == {
+        "Content-type": "text/xml",
+        "Content-Encoding": "gzip",
+        "Accept-Encoding": "gzip",
+    }
+
+    # Small bodies are sent as they are
+    conn._send_request("post", "update/", "<commit />")
+
+    args, kwargs = send_request.call_args
+    assert kwargs["body"] == b"<commit />"
+    assert "Content-Encoding" not in kwargs["headers"]
+
+
+@mock.patch.object(pysolr.Solr, "_send_request")
+def test_solr_client_no_compression(send_request):
+
+    conn = SolrClient("http://solr/ckan")
+    body = "<add>{}</add>".format("<doc></doc>" * 1000)
+
+    conn._send_request("post", "update/", body)
+
+    args, kwargs = send_request.call_args
+    assert kwargs["body"] == body
+    assert kwargs["headers"] == {"Accept-Encoding": "gzip"}
+
+
+def test_streamed_results():
+
+    pytest.importorskip("ijson")
+
+    response = mock.Mock()
+    response.raw = io.BytesIO(
+        json.dumps(
+            {
+                "responseHeader": {"QTime": 3},
+                "response": {
+                    "numFound": 2,
+                    "start": 0,
+                    "docs": [{"id": "a", "extras": {"b": [1]}}, {"id": "c"}],
+                },
+                "facet_counts": {"facet_fields": {"type": ["x", 2]}},
+                "nextCursorMark": "AoE",
+            }
+        ).encode("utf-8")
+    )
+
+    results = StreamedResults(response)
+
+    assert list(results) == [{"id": "a", "extras": {"b": [1]}}, {"id": "c"}]
+    assert results.hits == 2
+    assert results.qtime == 3
+    assert results.facets == {"facet_fields": {"type": ["x", 2]}}
+    assert results.nextCursorMark == "AoE"
+    response.close.assert_called()
+
+
+def test_streamed_results_invalid_response():
+
+    pytest.importorskip("ijson")
+
+    response = mock.Mock()
+    response.raw = io.BytesIO(b'{"response": {"numFound": 2, "docs": [{"id"')
+
+    with pytest.raises(pysolr.SolrError):
+        list(StreamedResults(response))
+
+
+@pytest.mark.usefixtures("clean_db", "clean_index")
+@pytest.mark.ckan_config("ckanext.sitesearch.solr.stream_rows", 2)
+def test_solr_search_streamed():
+
+    orgs = [factories.Organization() for _ in range(3)]
+
+    query = {
+        "q": "*:*",
+        "rows": 10,
+        "sort": "name asc",
+        "facet": "true",
+        "facet.field": ["entity_type"],
+    }
+    result = get_backend().search(query, entity_type="organization")
+
+    assert result["count"] == 3
+    assert [doc["id"] for doc in result["results"]] == [
+        org["id"] for org in sorted(orgs, key=lambda org: org["name"])
+    ]
+    assert result["facets"]["entity_type"]["organization"] == 3
+
+    # Each document is decoded as it is read
+    result = get_backend().search(
+        {"q": "*:*", "rows": 10, "sort": "name asc"},
+        entity_type="organization",
+        decode=lambda doc: doc["name"],
+    )
+
+    assert result["results"] == sorted(org["name"] for org in orgs)
+
+    docs = list(
+        get_backend().iter_documents(toolkit.config.get("ckan.site_id"), batch_size=2)
+    )
+
+    assert sorted(doc["id"] for doc in docs) == sorted(org["id"] for org in orgs)
+
+    docs = list(
+        get_backend().iter_documents(
+            toolkit.config.get("ckan.site_id"), fields=["id", "title"]
+        )
+    )
+
+    assert set(docs[0].keys()) == {"id", "title"}
+
+
+@pytest.fixture
+def clean_postgres_index():
+    clear_all()
+
+
+@pytest.mark.ckan_config("ckanext.sitesearch.backend", "postgres")
+@pytest.mark.usefixtures("clean_db", "clean_postgres_index")
+class TestPostgresBackend(object):
+    def test_backend(self):
+
+        assert isinstance(get_backend(), PostgresBackend)
+
+    def test_organization_search(self):
+
+        factories.Organization(
+            name="test_org_1",
+            title="My organization 1",
+            description="Behold this great organization",
+            extras=[{"key": "extra_org_common", "value": "pear"}],
+        )
+        factories.Organization(
+            name="test_org_2",
+            title="My organization 2",
+            description="Marvel at this great organization",
+            extras=[{"key": "extra_org_common", "value": "peach"}],
+        )
+        factories.Group(name="test_group_1", description="Behold this group")
+
+        assert call_action("organization_search")["count"] == 2
+        assert call_action("organization_search", q="organization")["count"] == 2
+        assert call_action("organization_search", q="pea*")["count"] == 2
+        assert call_action("organization_search", q="pear OR peach")["count"] == 2
+
+        result = call_action("organization_search", q="behold")
+        assert result["count"] == 1
+        assert result["results"][0]["name"] == "test_org_1"
+
+        result = call_action("organization_search", q="name:test_org_2")
+        assert result["count"] == 1
+        assert result["results"][0]["name"] == "test_org_2"
+
+    def test_sort_and_paging(self):
+
+        for i in range(3):
+            factories.Organization(
+                name="test_org_{}".format(i), title="Org {}".format(i)
+            )
+
+        result = call_action("organization_search", sort="title desc", rows=2)
+        assert result["count"] == 3
+        assert [r["name"] for r in result["results"]] == ["test_org_2", "test_org_1"]
+
+        result = call_action("organization_search", sort="title desc", start=2)
+        assert [r["name"] for r in result["results"]] == ["test_org_0"]
+
+    def test_facets(self):
+
+        factories.Organization(extras=[{"key": "color", "value": "red"}])
+        factories.Organization(extras=[{"key": "color", "value": "red"}])
+        factories.Organization(extras=[{"key": "color", "value": "blue"}])
+
+        result = call_action(
+            "organization_search", **{"facet": "on", "facet.field": ["color"]}
+        )
+
+        items = result["search_facets"]["color"]["items"]
+        assert items[0] == {"name": "red", "display_name": "red", "count": 2}
+        assert items[1] == {"name": "blue", "display_name": "blue", "count": 1}
+
+    def test_delete(self):
+
+        org = factories.Organization()
+        assert call_action("organization_search")["count"] == 1
+
+        call_action("organization_delete", id=org["id"])
+
+        assert call_action("organization_search")["count"] == 0
+
+    def test_iter_documents_fields(self):
+
+        org = factories.Organization(title="Org")
+
+        docs = list(
+            get_backend().iter_documents(
+                toolkit.config.get("ckan.site_id"), fields=["id", "title"]
+            )
+        )
+
+        assert docs == [{"id": org["id"], "title": "Org"}]
+
+    def test_fq(self):
+
+        factories.Organization(name="test_org_1")
+        factories.Organization(name="test_org_2")
+
+        result = call_action("organization_search", fq="-name:test_org_1")
+        assert result["count"] == 1
+        assert result["results"][0]["name"] == "test_org_2"
+
+        result = call_action(
+            "organization_search", fq="name:(test_org_1 OR test_org_2)"
+        )
+        assert result["count"] == 2
@@ -1,3 +1,5 @@
+from unittest import mock
+
 import pytest
 
 import ckan.plugins as plugins
@@ -114,3 +116,99 @@ class TestDatasetCreationWorkflow:
         # Test organization indexed the new package
         result = helpers.call_action("organization_search", q="*:*")["results"][0]
         assert result["package_count"] == 1
+
+
+@pytest.mark.usefixtures("clean_db", "clean_index")
+class TestRawSearchAPI:
+    def test_raw_search(self, app):
+
+        factories.Organization(title="Raw org", description="Some description")
+        factories.Organization(title="Another org")
+
+        url = "/api/sitesearch/organization_search?q=raw&facet.field=%5B%22name%22%5D"
+        response = app.get(url)
+
+        assert response.headers["Content-Type"].startswith("application/json")
+        data = response.json
+        assert data["success"] is True
+        assert data["result"] == helpers.call_action(
+            "organization_search", q="raw", **{"facet.field": ["name"]}
+        )
+        assert data["result"]["count"] == 1
+        assert "help" in data
+
+    def test_raw_search_not_authorized(self, app):
+
+        factories.User()
+
+        response = app.get("/api/sitesearch/user_search", status=403)
+
+        assert response.json["success"] is False
+        assert response.json["error"]["__type"] == "Authorization Error"
+
+    def test_raw_search_validation_error(self, app):
+
+        response = app.get("/api/sitesearch/group_search?rows=invalid", status=409)
+
+        assert response.json["error"]["__type"] == "Validation Error"
+        assert "rows" in response.json["error"]
+
+    def test_raw_search_unknown_action(self, app):
+
+        app.get("/api/sitesearch/package_search", status=400)
+
+    def test_raw_search_etag(self, app):
+
+        factories.Organization()
+        url = "/api/sitesearch/organization_search?q=*:*"
+
+        response = app.get(url)
+        etag = response.headers["ETag"]
+        assert etag
+
+        with mock.patch("ckanext.sitesearch.lib.query._run_query") as run_query:
+            response = app.get(url, headers={"If-None-Match": etag}, status=304)
+        assert not run_query.called
+        assert response.headers["ETag"] == etag
+
+        # Different parameters
+        response = app.get(url + "&rows=1", headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        assert response.headers["ETag"] != etag
+
+        # The index was updated
+        factories.Organization()
+        response = app.get(url, headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        assert response.json["result"]["count"] == 2
+        assert response.headers["ETag"] != etag
+
+    @pytest.mark.ckan_config("ckanext.sitesearch.thin_documents", True)
+    def test_raw_search_no_etag_with_thin_documents(self, app):
+
+        factories.Organization()
+
+        response = app.get("/api/sitesearch/organization_search?q=*:*")
+
+        assert response.status_code == 200
+        assert "ETag" not in response.headers
+
+    @pytest.mark.ckan_config("ckan.search.solr_commit", False)
+    def test_raw_search_no_etag_without_solr_commit(self, app):
+
+        factories.Organization()
+
+        response = app.get("/api/sitesearch/organization_search?q=*:*")
+
+        assert response.status_code == 200
+        assert "ETag" not in response.headers
+
+    def test_raw_search_etag_not_authorized(self, app):
+
+        sysadmin = _get_sysadmin()
+        url = "/api/sitesearch/user_search"
+
+        response = app.get(url, extra_environ=_get_extra_environ(sysadmin))
+        etag = response.headers["ETag"]
+
+        app.get(url, headers={"If-None-Match": etag}, status=403)
@@ -1,8 +1,14 @@
+from unittest import mock
+
 import pytest
 
+from ckan import model
 from ckan.plugins import toolkit
 from ckan.tests import factories, helpers
 
+from ckanext.sitesearch.lib import dirty
+from ckanext.sitesearch.lib.backends import get_backend
+
 call_action = helpers.call_action
 
 
@@ -118,3 +124,166 @@ def test_user_delete():
     result = call_action("user_search", q="snake")
 
     assert result["count"] == 0
+
+
+@pytest.fixture
+def backend_add():
+    backend = get_backend()
+    with mock.patch.object(backend, "add", wraps=backend.add) as add:
+        yield add
+
+
+def _indexed_ids(add):
+    return sorted(doc["id"] for call in add.call_args_list for doc in call[0][0])
+
+
+@pytest.mark.usefixtures("clean_db", "clean_index")
+class TestCoalescedReindex(object):
+    def test_package_update_reindexes_each_org_once(self, backend_add):
+        sysadmin = factories.Sysadmin()
+        org1 = factories.Organization()
+        org2 = factories.Organization()
+        dataset = factories.Dataset(owner_org=org1["id"], state="draft")
+        backend_add.reset_mock()
+
+        # Changes both the owner org and the state
+        call_action(
+            "package_patch",
+            context={"user": sysadmin["name"]},
+            id=dataset["id"],
+            owner_org=org2["id"],
+            state="active",
+        )
+
+        assert backend_add.call_count == 1
+        assert _indexed_ids(backend_add) == sorted([org1["id"], org2["id"]])
+
+    def test_nested_actions_are_flushed_once(self, backend_add):
+        org = factories.Organization()
+
+        @dirty.coalesced
+        def outer(up_func, context, data_dict):
+            for _ in range(3):
+                dirty.add("organization", org["id"])
+            assert backend_add.call_count == 0
+            return up_func(context, data_dict)
+
+        outer(lambda context, data_dict: data_dict, {}, {})
+
+        assert backend_add.call_count == 1
+        assert _indexed_ids(backend_add) == [org["id"]]
+
+    def test_nested_action_with_defer_commit(self, backend_add):
+        org = factories.Organization()
+
+        @dirty.coalesced
+        def inner(up_func, context, data_dict):
+            dirty.add("organization", org["id"])
+            return data_dict
+
+        @dirty.coalesced
+        def outer(up_func, context, data_dict):
+            inner(None, {"defer_commit": True}, data_dict)
+            model.repo.commit()
+            return data_dict
+
+        outer(None, {}, {})
+
+        assert backend_add.call_count == 1
+        assert _indexed_ids(backend_add) == [org["id"]]
+        assert dirty.pending() == {}
+        assert not dirty._state().wait_for_commit
+
+    def test_deleted_entity_is_not_reindexed(self, backend_add):
+        org = factories.Organization()
+
+        @dirty.coalesced
+        def outer(up_func, context, data_dict):
+            dirty.add("organization", org["id"])
+            dirty.delete("organization", org["id"])
+            return data_dict
+
+        outer(None, {}, {})
+
+        assert backend_add.call_count == 0
+
+    def test_defer_commit_waits_for_the_transaction(self, backend_add):
+        sysadmin = factories.Sysadmin()
+        org = factories.Organization()
+        backend_add.reset_mock()
+
+        org["description"] = "Some org about snakes"
+        call_action(
+            "organization_update",
+            context={"user": sysadmin["name"], "defer_commit": True},
+            **org
+        )
+
+        assert backend_add.call_count == 0
+        assert dirty.pending() == {("organization", org["id"]): dirty.INDEX}
+
+        model.repo.commit()
+
+        assert backend_add.call_count == 1
+        assert dirty.pending() == {}
+        assert call_action("organization_search", q="snake")["count"] == 1
+
+    def test_rollback_discards_dirty_entities(self, backend_add):
+        sysadmin = factories.Sysadmin()
+        org = factories.Organization()
+        backend_add.reset_mock()
+
+        call_action(
+            "organization_update",
+            context={"user": sysadmin["name"], "defer_commit": True},
+            **org
+        )
+        model.Session.rollback()
+
+        assert dirty.pending() == {}
+        assert backend_add.call_count == 0
+
+
+@pytest.mark.usefixtures("clean_db", "clean_index")
+class TestBulkUpdate(object):
+    @pytest.mark.parametrize(
+        "action", ["bulk_update_private", "bulk_update_public", "bulk_update_delete"]
+    )
+    def test_bulk_update_reindexes_org_once(self, action, backend_add):
+        sysadmin = factories.Sysadmin()
+        org = factories.Organization()
+        datasets = [factories.Dataset(owner_org=org["id"]) for _ in range(5)]
+        backend_add.reset_mock()
+
+        call_action(
+            action,
+            context={"user": sysadmin["name"]},
+            datasets=[d["id"] for d in datasets],
+            org_id=org["id"],
+        )
+
+        assert backend_add.call_count == 1
+        assert _indexed_ids(backend_add) == [org["id"]]
+
+    def test_bulk_update_delete_reindexes_groups(self, backend_add):
+        sysadmin = factories.Sysadmin()
+        org = factories.Organization()
+        group = factories.Group()
+        datasets = [
+            factories.Dataset(owner_org=org["id"], groups=[{"id": group["id"]}])
+            for _ in range(3)
+        ]
+        backend_add.reset_mock()
+
+        call_action(
+            "bulk_update_delete",
+            context={"user": sysadmin["name"]},
+            datasets=[d["id"] for d in datasets],
+            org_id=org["id"],
+        )
+
+        assert backend_add.call_count == 1
+        assert _indexed_ids(backend_add) == sorted([org["id"], group["id"]])
+
+        result = call_action("organization_search", q="id:{}".format(org["id"]))
+        assert result["results"][0]["package_count"] == 0
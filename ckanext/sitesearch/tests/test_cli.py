@@ -5,6 +5,9 @@ from ckan.plugins import toolkit
 import ckan.tests.factories as factories
 import ckan.tests.helpers as helpers
 from ckan.cli.cli import ckan
+from ckan.lib.search import clear_all as reset_index
+
+from ckanext.sitesearch import db
 
 
 @pytest.mark.usefixtures("clean_db", "clean_index")
@@ -102,3 +105,35 @@ class TestSiteSearchCLI:
     def test_rebuild_pages_invoked_correctly(self, cli):
         result = cli.invoke(ckan, ["sitesearch", "rebuild", "pages"])
         assert not result.exit_code
+
+    def test_rebuild_shards_and_commit(self, cli):
+        orgs = [factories.Organization() for _ in range(4)]
+
+        reset_index()
+
+        for shard in ("1/2", "2/2"):
+            result = cli.invoke(
+                ckan, ["sitesearch", "rebuild", "organizations", "--shard", shard]
+            )
+            assert not result.exit_code, result.output
+
+        result = cli.invoke(ckan, ["sitesearch", "commit"])
+        assert not result.exit_code, result.output
+
+        search_result = helpers.call_action("organization_search")
+        assert sorted(o["id"] for o in search_result["results"]) == sorted(
+            o["id"] for o in orgs
+        )
+
+    def test_rebuild_invalid_shard(self, cli):
+        result = cli.invoke(ckan, ["sitesearch", "rebuild", "users", "--shard", "3/2"])
+        assert result.exit_code
+
+    def test_init(self, cli):
+        db.failure_table.drop(model.meta.engine)
+
+        result = cli.invoke(ckan, ["sitesearch", "init"])
+        assert not result.exit_code, result.output
+
+        with model.meta.engine.connect() as conn:
+            assert model.meta.engine.dialect.has_table(conn, "sitesearch_failure")
@@ -0,0 +1,109 @@
+from unittest import mock
+
+import pytest
+
+from ckan import model
+from ckan.tests import factories, helpers
+from ckan.cli.cli import ckan
+
+from ckanext.sitesearch import db
+from ckanext.sitesearch.lib import failures, index, rebuild
+
+call_action = helpers.call_action
+
+
+@pytest.fixture
+def clean_failures():
+    failures.purge()
+
+
+@pytest.mark.usefixtures("clean_db", "clean_index", "clean_failures")
+class TestFailures(object):
+    def test_rebuild_failures_are_recorded(self):
+        org = factories.Organization()
+
+        with mock.patch.dict(
+            rebuild.indexers, {"organization": mock.Mock(side_effect=ValueError("Boom"))}
+        ):
+            rebuild.rebuild_orgs(force=True)
+            rebuild.rebuild_orgs(force=True)
+
+        items = failures.get_failures()
+        assert len(items) == 1
+        assert items[0]["entity_type"] == "organization"
+        assert items[0]["entity_id"] == org["id"]
+        assert items[0]["error_class"] == "ValueError"
+        assert items[0]["message"] == "Boom"
+        assert items[0]["attempts"] == 2
+
+    def test_chained_action_failures_are_recorded(self):
+        org = factories.Organization()
+
+        with mock.patch.dict(
+            index.preparers, {"organization": mock.Mock(side_effect=ValueError("Boom"))}
+        ):
+            with pytest.raises(ValueError):
+                call_action("organization_update", id=org["id"], name=org["name"])
+
+        items = failures.get_failures("organization")
+        assert len(items) == 1
+        assert items[0]["entity_id"] == org["id"]
+
+    def test_retry(self):
+        org = factories.Organization()
+        failures.record_failure("organization", org["id"], ValueError("Boom"))
+
+        assert rebuild.retry_failures() == (1, 0)
+
+        assert failures.get_failures() == []
+        resolved = failures.get_failures(include_resolved=True)
+        assert resolved[0]["resolved"]
+
+        assert call_action("organization_search", q=org["name"])["count"] == 1
+
+    def test_retry_deleted_entity(self):
+        failures.record_failure("organization", "not-there", ValueError("Boom"))
+
+        assert rebuild.retry_failures() == (1, 0)
+        assert failures.get_failures() == []
+
+    def test_purge(self):
+        failures.record_failure("organization", "org-1", ValueError("Boom"))
+        failures.record_failure("group", "group-1", ValueError("Boom"))
+
+        assert failures.purge(entity_type="group") == 1
+        assert [f["entity_id"] for f in failures.get_failures()] == ["org-1"]
+
+    def test_stats(self):
+        failures.record_failure("organization", "org-1", ValueError("Boom"))
+        failures.record_failure("organization", "org-2", ValueError("Boom"))
+
+        stats = failures.get_failure_stats()
+        assert len(stats) == 1
+        assert stats[0][1:] == ("organization", 2, 0)
+
+    def test_cli(self, cli):
+        failures.record_failure("organization", "org-1", ValueError("Boom"))
+
+        result = cli.invoke(ckan, ["sitesearch", "failures", "list"])
+        assert not result.exit_code
+        assert "organization org-1 [index]" in result.output
+
+        result = cli.invoke(ckan, ["sitesearch", "failures", "purge"])
+        assert not result.exit_code
+        assert failures.get_failures() == []
+
+
+@pytest.mark.usefixtures("clean_db")
+def test_missing_table(monkeypatch):
+
+    monkeypatch.setattr(db, "_checked_tables", set())
+    db.failure_table.drop(model.meta.engine)
+    try:
+        # Not raised, so the original error is not hidden
+        failures.record_failure("organization", "org-1", ValueError("Boom"))
+
+        with pytest.raises(RuntimeError, match="ckan sitesearch init"):
+            failures.get_failures()
+    finally:
+        db.init_db()
@@ -0,0 +1,199 @@
+from unittest import mock
+
+import pytest
+
+from ckan import model
+from ckan.plugins import toolkit
+from ckan.tests import factories, helpers
+
+from ckanext.sitesearch.lib import hydrate, index, metrics
+
+
+call_action = helpers.call_action
+
+
+@pytest.fixture
+def hydrate_cache(monkeypatch):
+    monkeypatch.setattr(hydrate, "_cache", None)
+    yield
+    hydrate._cache = None
+
+
+class TestLRUCache(object):
+    def test_get_set(self):
+        cache = hydrate.LRUCache(2)
+        cache.set("a", 1)
+
+        assert cache.get("a") == 1
+        assert cache.get("b") is None
+
+    def test_evicts_least_recently_used(self):
+        cache = hydrate.LRUCache(2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+
+        assert len(cache) == 2
+        assert cache.get("a") == 1
+        assert cache.get("b") is None
+        assert cache.get("c") == 3
+
+    def test_disabled(self):
+        cache = hydrate.LRUCache(0)
+        cache.set("a", 1)
+
+        assert cache.get("a") is None
+
+
+@pytest.mark.usefixtures("clean_db", "clean_index", "hydrate_cache")
+@pytest.mark.ckan_config("ckanext.sitesearch.thin_documents", True)
+class TestThinDocuments(object):
+    def test_no_data_dict_stored(self, solr):
+        org = factories.Organization()
+
+        response = solr.search(
+            q="id:{}".format(org["id"]),
+            fq="+site_id:{}".format(toolkit.config.get("ckan.site_id")),
+        )
+
+        assert response.hits == 1
+        doc = response.docs[0]
+        assert "validated_data_dict" not in doc
+        assert doc["entity_type"] == "organization"
+        assert doc["metadata_modified"]
+
+    def test_organization_search(self):
+        org = factories.Organization(
+            title="Thin organization",
+            extras=[{"key": "theme", "value": "water"}],
+        )
+        factories.Dataset(owner_org=org["id"])
+
+        result = call_action("organization_search", q="thin")
+
+        assert result["count"] == 1
+        out = result["results"][0]
+        assert out["id"] == org["id"]
+        assert out["title"] == "Thin organization"
+        assert out["package_count"] == 1
+        assert out["extras"][0]["value"] == "water"
+
+    def test_group_and_user_search(self):
+        group = factories.Group(title="Thin group")
+        user = factories.User(fullname="Thin user")
+
+        groups = call_action("group_search", q="thin")["results"]
+        users = call_action("user_search", q="thin")["results"]
+
+        assert [g["id"] for g in groups] == [group["id"]]
+        assert [u["id"] for u in users] == [user["id"]]
+        assert "apikey" not in users[0]
+
+    def test_user_dataset_counts(self):
+        users = [factories.User(fullname="Thin user {}".format(i)) for i in range(3)]
+        factories.Dataset(user=users[0])
+        factories.Dataset(user=users[0])
+        factories.Dataset(user=users[1])
+
+        with mock.patch.object(
+            model.User, "number_created_packages"
+        ) as number_created_packages:
+            result = call_action("user_search", q="thin")
+
+        # Computed for all users in a single query
+        assert not number_created_packages.called
+        assert {u["id"]: u["number_created_packages"] for u in result["results"]} == {
+            users[0]["id"]: 2,
+            users[1]["id"]: 1,
+            users[2]["id"]: 0,
+        }
+
+    def test_keeps_order(self):
+        factories.Organization(title="B thin")
+        factories.Organization(title="A thin")
+        factories.Organization(title="C thin")
+
+        result = call_action("organization_search", q="thin", sort="title asc")
+
+        assert [o["title"] for o in result["results"]] == [
+            "A thin",
+            "B thin",
+            "C thin",
+        ]
+
+    @pytest.mark.ckan_config("ckanext.sitesearch.metrics.sink", "memory")
+    def test_cached_until_reindexed(self):
+        org = factories.Organization(title="Thin organization")
+        sink = metrics.get_sink()
+        sink.reset()
+
+        call_action("organization_search", q="thin")
+        call_action("organization_search", q="thin")
+
+        assert sink.counters["sitesearch.hydrate.cache_hits"] == 1
+
+        call_action("organization_patch", id=org["id"], title="Thin changed")
+
+        result = call_action("organization_search", q="thin")
+
+        assert result["results"][0]["title"] == "Thin changed"
+
+    def test_skips_entities_not_in_db(self):
+        org = factories.Organization(title="Thin organization")
+        data_dict = call_action("organization_show", id=org["id"])
+        data_dict.update(id="not-in-db", name="not-in-db")
+        index.index_organization(data_dict)
+
+        result = call_action("organization_search", q="thin")
+
+        assert [o["id"] for o in result["results"]] == [org["id"]]
+
+    def test_results_can_be_modified(self):
+        factories.Organization(title="Thin organization")
+
+        result = call_action("organization_search", q="thin")
+        result["results"][0]["title"] = "Modified"
+
+        result = call_action("organization_search", q="thin")
+
+        assert result["results"][0]["title"] == "Thin organization"
+
+
+@pytest.mark.usefixtures("clean_db", "clean_index", "hydrate_cache")
+def test_thin_documents_compared_to_full_documents(monkeypatch):
+    org = factories.Organization(title="Thin organization")
+    user = factories.User(fullname="Thin user")
+    factories.Dataset(owner_org=org["id"], user=user)
+
+    full = {
+        "organization": call_action("organization_search", q="thin")["results"][0],
+        "user": call_action("user_search", q="thin")["results"][0],
+    }
+
+    monkeypatch.setitem(toolkit.config, "ckanext.sitesearch.thin_documents", True)
+    index.index_organization(call_action("organization_show", id=org["id"]))
+    index.index_user(call_action("user_show", id=user["id"]))
+
+    thin = {
+        "organization": call_action("organization_search", q="thin")["results"][0],
+        "user": call_action("user_search", q="thin")["results"][0],
+    }
+
+    for entity_type in ("organization", "user"):
+        missing = set(full[entity_type]) - set(thin[entity_type])
+        assert missing <= set(hydrate.MISSING_FIELDS[entity_type])
+        for key in ("id", "name", "display_name", "image_display_url"):
+            assert thin[entity_type][key] == full[entity_type][key]
+
+    assert thin["organization"]["title"] == full["organization"]["title"]
+    assert thin["organization"]["package_count"] == 1
+    assert (
+        thin["organization"]["package_count"] == full["organization"]["package_count"]
+    )
+    assert thin["user"]["fullname"] == full["user"]["fullname"]
+    assert thin["user"]["number_created_packages"] == 1
+    assert (
+        thin["user"]["number_created_packages"]
+        == full["user"]["number_created_packages"]
+    )
@@ -3,6 +3,7 @@ import pytest
 from ckan.plugins import toolkit
 from ckan.tests import factories
 from ckanext.sitesearch.lib import index
+from ckanext.sitesearch.lib.generation import get_generation
 
 
 def test_index_no_id():
@@ -307,3 +308,63 @@ def test_clear_all(solr):
 
     response = solr.search(q=q, fq=fq)
     assert response.hits == 0
+
+
+@pytest.mark.usefixtures("clean_db", "clean_index")
+def test_writes_update_generation():
+
+    generation = get_generation()
+    assert generation
+    assert get_generation() == generation
+
+    org = factories.Organization()
+    assert get_generation() != generation
+
+    generation = get_generation()
+    index.delete_organization(org["id"])
+    assert get_generation() != generation
+
+    generation = get_generation()
+    index.commit()
+    assert get_generation() != generation
+
+
+@pytest.mark.usefixtures("clean_db", "clean_index")
+def test_deferred_writes_update_generation_on_commit():
+
+    org = factories.Organization()
+    generation = get_generation()
+
+    index.index_organization(org, defer_commit=True)
+    index.delete_organization(org["id"], defer_commit=True)
+    index.clear_groups(defer_commit=True)
+    assert get_generation() == generation
+
+    index.commit()
+    assert get_generation() != generation
+
+
+@pytest.mark.ckan_config("ckan.search.solr_commit", False)
+@pytest.mark.usefixtures("clean_db", "clean_index")
+def test_writes_update_generation_without_solr_commit():
+
+    # Solr's autoCommit commits the changes, so they are not deferred until
+    # a call to `commit()`
+    org = factories.Organization()
+    assert not index.generation_tracks_commits()
+
+    generation = get_generation()
+    index.index_organization(org)
+    assert get_generation() != generation
+
+    generation = get_generation()
+    index.delete_organization(org["id"])
+    assert get_generation() != generation
+
+    generation = get_generation()
+    index.clear_groups()
+    assert get_generation() != generation
+
+    generation = get_generation()
+    index.commit_unless_deferred()
+    assert get_generation() != generation
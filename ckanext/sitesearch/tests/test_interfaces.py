@@ -101,6 +101,14 @@ def test_interfaces_entities_search(fake_plugin):
     assert fake_plugin.after_page_search_called
 
 
+def test_raw_json_runs_after_hooks(fake_plugin):
+    result = helpers.call_action("organization_search", context={"raw_json": True})
+
+    # The hooks get the results as a dict
+    assert isinstance(result, dict)
+    assert fake_plugin.after_organization_search_called
+
+
 def test_site_search_interface(fake_plugin):
     assert not fake_plugin.before_site_search_called
     assert not fake_plugin.after_site_search_called
@@ -0,0 +1,160 @@
+from unittest import mock
+
+import pytest
+
+from ckan.lib.search.common import SearchError
+from ckan.plugins import toolkit
+from ckan.tests import factories, helpers
+
+from ckanext.sitesearch.lib import limits
+from ckanext.sitesearch.lib.backends import solr
+from ckanext.sitesearch.logic.action import RawJSON
+
+call_action = helpers.call_action
+
+
+def test_check_query_disabled_by_default():
+
+    errors = limits.check_query(
+        "user_search",
+        {
+            "facet.field": ["field_{}".format(i) for i in range(11)],
+            "facet.limit": -1,
+            "start": 20000,
+        },
+    )
+
+    assert errors == {}
+
+
+@pytest.mark.ckan_config("ckanext.sitesearch.limits.max_facet_fields", "10")
+@pytest.mark.ckan_config("ckanext.sitesearch.limits.max_facet_limit", "1000")
+@pytest.mark.ckan_config("ckanext.sitesearch.limits.max_start", "10000")
+def test_check_query():
+
+    assert limits.check_query("user_search", {"q": "test", "start": 20}) == {}
+    query = {"facet.field": ["a", "b"], "facet.limit": 50}
+    assert limits.check_query("user_search", query) == {}
+
+    errors = limits.check_query(
+        "user_search",
+        {
+            "facet.field": ["field_{}".format(i) for i in range(11)],
+            "facet.limit": -1,
+            "start": 20000,
+        },
+    )
+
+    assert sorted(errors.keys()) == ["facet.field", "facet.limit", "start"]
+
+
+@pytest.mark.ckan_config("ckanext.sitesearch.limits.max_start", "500")
+@pytest.mark.ckan_config("ckanext.sitesearch.limits.user_search.max_start", "100")
+@pytest.mark.ckan_config("ckanext.sitesearch.limits.group_search.max_start", "-1")
+def test_check_query_per_action():
+
+    assert "start" in limits.check_query("user_search", {"start": 200})
+    assert "start" not in limits.check_query("organization_search", {"start": 200})
+    assert "start" in limits.check_query("organization_search", {"start": 1000})
+    assert "start" not in limits.check_query("group_search", {"start": 100000})
+
+
+@pytest.mark.usefixtures("clean_db", "clean_index")
+class TestSearchLimits(object):
+    @pytest.mark.ckan_config("ckanext.sitesearch.limits.max_facet_limit", "1000")
+    def test_validation_error(self):
+
+        with pytest.raises(toolkit.ValidationError) as e:
+            call_action(
+                "organization_search", **{"facet.field": ["name"], "facet.limit": -1}
+            )
+
+        assert "facet.limit" in e.value.error_dict
+
+    @pytest.mark.ckan_config("ckanext.sitesearch.limits.page_search.max_start", "10")
+    def test_validation_error_per_action(self):
+
+        call_action("organization_search", start=20)
+
+        with pytest.raises(toolkit.ValidationError) as e:
+            call_action("page_search", start=20)
+
+        assert "start" in e.value.error_dict
+
+    def test_partial_results(self):
+
+        factories.Organization()
+        search = solr.SolrBackend.search
+
+        def partial_search(*args, **kwargs):
+            return dict(search(*args, **kwargs), partial_results=True)
+
+        with mock.patch.object(
+            solr.SolrBackend, "search", side_effect=partial_search, autospec=True
+        ):
+            result = call_action("organization_search")
+            raw_result = call_action("organization_search", context={"raw_json": True})
+
+        assert result["partial_results"] is True
+        assert result["count"] == 1
+        assert isinstance(raw_result, RawJSON)
+        assert raw_result.endswith(', "partial_results": true}')
+
+    def test_no_partial_results(self):
+
+        factories.Organization()
+
+        result = call_action("organization_search")
+
+        assert "partial_results" not in result
+
+
+@pytest.mark.ckan_config("ckanext.sitesearch.limits.time_allowed", "500")
+@pytest.mark.ckan_config("ckanext.sitesearch.limits.user_search.time_allowed", "100")
+def test_time_allowed():
+
+    backend = solr.SolrBackend()
+
+    assert backend.build_params({"q": "*:*"}, "user")["timeAllowed"] == 100
+    assert backend.build_params({"q": "*:*"}, "group")["timeAllowed"] == 500
+
+
+def test_no_time_allowed():
+
+    assert "timeAllowed" not in solr.SolrBackend().build_params({"q": "*:*"}, "user")
+
+
+@pytest.mark.ckan_config("ckanext.sitesearch.limits.expensive_queries", "1")
+@pytest.mark.ckan_config("ckanext.sitesearch.limits.expensive_queries_wait", "0")
+class TestAdmission(object):
+    def test_expensive_queries_limited(self):
+
+        with limits.admission({"q": "*test"}):
+            with pytest.raises(limits.QueryRejected):
+                with limits.admission({"q": "test", "start": 5000}):
+                    pass
+            # Other queries are not limited
+            with limits.admission({"q": "test"}):
+                pass
+
+        # Released
+        with limits.admission({"q": "*test"}):
+            pass
+
+    @pytest.mark.usefixtures("clean_db", "clean_index")
+    def test_search_rejected(self):
+
+        with limits.admission({"q": "*test"}):
+            with pytest.raises(SearchError):
+                call_action("organization_search", q="*test")
+
+            call_action("organization_search", q="test")
+
+        call_action("organization_search", q="*test")
+
+
+def test_admission_disabled():
+
+    with limits.admission({"q": "*test"}):
+        with limits.admission({"q": "*test"}):
+            pass
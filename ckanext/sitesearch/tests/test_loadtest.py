@@ -0,0 +1,137 @@
+import json
+
+import pytest
+
+from ckan.cli.cli import ckan
+from ckan.tests import factories
+
+from ckanext.sitesearch.lib import loadtest
+
+
+def test_parse_mix():
+
+    assert loadtest.parse_mix("site_search=2, user_search") == {
+        "site_search": 2.0,
+        "user_search": 1.0,
+    }
+
+
+@pytest.mark.parametrize(
+    "value", ["package_search=1", "site_search=a", "site_search=1,"]
+)
+def test_parse_mix_invalid(value):
+
+    with pytest.raises(ValueError):
+        loadtest.parse_mix(value)
+
+
+def test_synthetic_calls():
+
+    calls = loadtest.synthetic_calls(50, seed=1)
+
+    assert len(calls) == 50
+    assert calls == loadtest.synthetic_calls(50, seed=1)
+    assert calls != loadtest.synthetic_calls(50, seed=2)
+    assert {action for action, _ in calls} <= set(loadtest.DEFAULT_MIX)
+    assert all("q" in data_dict for _, data_dict in calls)
+
+
+def test_synthetic_calls_mix():
+
+    calls = loadtest.synthetic_calls(20, mix={"group_search": 1})
+
+    assert {action for action, _ in calls} == {"group_search"}
+
+
+def test_calls_from_query_log(tmp_path):
+
+    path = tmp_path / "queries.log"
+    entries = [
+        {
+            "entity_type": "organization",
+            "permission_labels": None,
+            "params": {"q": "water", "rows": 20},
+        },
+        {
+            "entity_type": "page",
+            "permission_labels": ["public"],
+            "params": {"q": "*:*", "fq": ["state:active", "private:false"]},
+        },
+    ]
+    path.write_text(
+        "".join(
+            "2023-01-01 10:00:00,000 {}\n".format(json.dumps(entry))
+            for entry in entries
+        )
+    )
+
+    calls = loadtest.calls_from_query_log(str(path), count=3)
+
+    assert calls == [
+        ("organization_search", {"q": "water", "rows": 20}),
+        ("page_search", {"q": "*:*", "fq": "(state:active) AND (private:false)"}),
+        ("organization_search", {"q": "water", "rows": 20}),
+    ]
+
+
+def test_calls_from_empty_query_log(tmp_path):
+
+    path = tmp_path / "queries.log"
+    path.write_text("")
+
+    with pytest.raises(ValueError):
+        loadtest.calls_from_query_log(str(path))
+
+
+@pytest.mark.usefixtures("clean_db", "clean_index")
+def test_run():
+
+    factories.Organization(title="Water")
+    factories.Group(title="Open data")
+    calls = loadtest.synthetic_calls(
+        20, mix={"organization_search": 1, "group_search": 1}
+    )
+
+    report = loadtest.run(calls, concurrency=2)
+
+    assert report["requests"] == 20
+    assert report["errors"] == 0
+    assert report["throughput"] > 0
+    assert set(report["actions"].keys()) == {"organization_search", "group_search"}
+    assert sum(item["requests"] for item in report["actions"].values()) == 20
+    assert report["latency"]["p50"] <= report["latency"]["max"]
+
+
+@pytest.mark.usefixtures("clean_db", "clean_index")
+def test_run_errors():
+
+    calls = [("organization_search", {"q": "*:*"}), ("user_search", {"rows": "a"})]
+
+    report = loadtest.run(calls, concurrency=1)
+
+    assert report["requests"] == 2
+    assert report["errors"] == 1
+    assert report["error_types"] == {"ValidationError": 1}
+    assert report["actions"]["user_search"]["error_rate"] == 1
+
+
+@pytest.mark.usefixtures("clean_db", "clean_index")
+def test_cli_loadtest(cli):
+
+    factories.Organization()
+
+    result = cli.invoke(
+        ckan, ["sitesearch", "loadtest", "-n", "10", "-c", "2", "--json"]
+    )
+
+    assert not result.exit_code, result.output
+    report = json.loads(result.output[result.output.index("{") :])
+    assert report["requests"] == 10
+    assert report["concurrency"] == 2
+
+
+def test_cli_loadtest_invalid_mix(cli):
+
+    result = cli.invoke(ckan, ["sitesearch", "loadtest", "--mix", "package_search"])
+
+    assert result.exit_code
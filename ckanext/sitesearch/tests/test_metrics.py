@@ -0,0 +1,130 @@
+import pytest
+
+from ckan.tests import factories, helpers
+
+from ckanext.sitesearch.lib import metrics
+from ckanext.sitesearch.tests.test_blueprints import (
+    _get_extra_environ,
+    _get_sysadmin,
+)
+
+call_action = helpers.call_action
+
+
+@pytest.fixture
+def memory_sink():
+    sink = metrics.get_sink()
+    sink.reset()
+    return sink
+
+
+@pytest.mark.ckan_config("ckanext.sitesearch.metrics.sink", "memory")
+@pytest.mark.usefixtures("clean_db", "clean_index")
+class TestMemorySink(object):
+    def test_search_action_metrics(self, memory_sink):
+
+        factories.Organization()
+
+        call_action("organization_search", q="*:*")
+
+        timings = memory_sink.timings
+        assert len(timings["sitesearch.action.latency[action=organization_search]"]) == 1
+        assert len(timings["sitesearch.query.latency[entity_type=organization]"]) == 1
+        assert len(timings["sitesearch.query.qtime[entity_type=organization]"]) == 1
+        assert len(timings["sitesearch.decode.latency[entity_type=organization]"]) == 1
+
+        observations = memory_sink.observations
+        assert observations["sitesearch.query.results[entity_type=organization]"] == [1]
+
+    def test_index_metrics(self, memory_sink):
+
+        factories.Organization()
+
+        counters = memory_sink.counters
+        assert counters["sitesearch.index.docs[entity_type=organization]"] == 1
+
+        timings = memory_sink.timings
+        assert len(timings["sitesearch.index.latency[operation=add]"]) == 1
+        assert len(timings["sitesearch.hook.latency[action=organization_create]"]) == 1
+
+    def test_query_errors(self, memory_sink):
+
+        with pytest.raises(Exception):
+            call_action("organization_search", q="name:[a TO")
+
+        assert [
+            key
+            for key in memory_sink.counters
+            if key.startswith("sitesearch.query.errors[")
+        ]
+
+
+def test_prometheus_render():
+
+    sink = metrics.PrometheusSink()
+
+    sink.timing("sitesearch.query.latency", 7, {"entity_type": "user"})
+    sink.timing("sitesearch.query.latency", 70, {"entity_type": "user"})
+    sink.incr("sitesearch.query.errors", 1, {"entity_type": "user"})
+
+    output = sink.render()
+
+    assert "# TYPE sitesearch_query_latency_ms histogram" in output
+    assert 'sitesearch_query_latency_ms_bucket{entity_type="user",le="10"} 1' in output
+    assert 'sitesearch_query_latency_ms_bucket{entity_type="user",le="100"} 2' in output
+    assert 'sitesearch_query_latency_ms_bucket{entity_type="user",le="+Inf"} 2' in output
+    assert 'sitesearch_query_latency_ms_sum{entity_type="user"} 77' in output
+    assert 'sitesearch_query_latency_ms_count{entity_type="user"} 2' in output
+    assert "# TYPE sitesearch_query_errors_total counter" in output
+    assert 'sitesearch_query_errors_total{entity_type="user"} 1' in output
+
+
+def test_prometheus_multiprocess_render(tmp_path, monkeypatch):
+    values = pytest.importorskip("prometheus_client.values")
+
+    monkeypatch.setenv("PROMETHEUS_MULTIPROC_DIR", str(tmp_path))
+    # The value class is chosen when prometheus_client is imported
+    monkeypatch.setattr(values, "ValueClass", values.MultiProcessValue())
+
+    sink = metrics.sinks["prometheus"]()
+    assert isinstance(sink, metrics.MultiprocessPrometheusSink)
+
+    sink.timing("sitesearch.query.latency", 7, {"entity_type": "user"})
+    sink.timing("sitesearch.query.latency", 70, {"entity_type": "user"})
+    sink.incr("sitesearch.query.errors", 1, {"entity_type": "user"})
+    sink.incr("sitesearch.hydrate.cache_hits", 2, {})
+
+    output = sink.render()
+
+    assert (
+        'sitesearch_query_latency_ms_bucket{entity_type="user",le="10.0"} 1.0' in output
+    )
+    assert 'sitesearch_query_latency_ms_count{entity_type="user"} 2.0' in output
+    assert 'sitesearch_query_errors_total{entity_type="user"} 1.0' in output
+    assert "sitesearch_hydrate_cache_hits_total 2.0" in output
+    # Written to the shared folder, to be aggregated with other processes
+    assert list(tmp_path.iterdir())
+
+
+def test_prometheus_per_process_without_multiproc_dir(monkeypatch):
+
+    monkeypatch.delenv("PROMETHEUS_MULTIPROC_DIR", raising=False)
+    monkeypatch.delenv("prometheus_multiproc_dir", raising=False)
+
+    assert isinstance(metrics.sinks["prometheus"](), metrics.PrometheusSink)
+
+
+@pytest.mark.ckan_config("ckanext.sitesearch.metrics.sink", "prometheus")
+@pytest.mark.usefixtures("clean_db", "clean_index")
+def test_metrics_endpoint(app):
+
+    sysadmin = _get_sysadmin()
+    factories.Organization()
+
+    app.get("/sitesearch/metrics", status=403)
+
+    response = app.get(
+        "/sitesearch/metrics", extra_environ=_get_extra_environ(sysadmin)
+    )
+
+    assert "sitesearch_index_latency_ms_count" in response.body
@@ -0,0 +1,135 @@
+import datetime
+from unittest import mock
+
+import pytest
+
+from ckan import model
+from ckan.plugins import toolkit
+from ckan.tests import factories, helpers
+
+from ckanext.sitesearch import db
+from ckanext.sitesearch.lib import dirty, index, outbox
+from ckanext.sitesearch.lib.backends import get_backend
+
+call_action = helpers.call_action
+
+
+@pytest.fixture
+def clean_outbox():
+    outbox.relay()
+
+
+@pytest.mark.ckan_config("ckanext.sitesearch.index_mode", "outbox")
+@pytest.mark.usefixtures("clean_db", "clean_index", "clean_outbox")
+class TestOutbox(object):
+    def test_actions_write_to_the_outbox(self):
+        sysadmin = factories.Sysadmin()
+        org = factories.Organization()
+        outbox.relay()
+
+        org["description"] = "Some org about snakes"
+        call_action("organization_update", context={"user": sysadmin["name"]}, **org)
+
+        assert outbox.pending_count() == 1
+        assert call_action("organization_search", q="snake")["count"] == 0
+
+        assert outbox.relay() == 1
+
+        assert outbox.pending_count() == 0
+        assert call_action("organization_search", q="snake")["count"] == 1
+
+    def test_relay_sends_one_update_per_batch(self):
+        sysadmin = factories.Sysadmin()
+        orgs = [factories.Organization() for _ in range(3)]
+        for org in orgs:
+            call_action(
+                "organization_patch",
+                context={"user": sysadmin["name"]},
+                id=org["id"],
+                description="Updated",
+            )
+
+        backend = get_backend()
+        with mock.patch.object(backend, "add", wraps=backend.add) as add:
+            outbox.relay()
+
+        assert add.call_count == 1
+        assert sorted(doc["id"] for doc in add.call_args[0][0]) == sorted(
+            org["id"] for org in orgs
+        )
+
+    def test_failed_action_does_not_write_to_the_outbox(self):
+        sysadmin = factories.Sysadmin()
+        org = factories.Organization()
+        outbox.relay()
+
+        with pytest.raises(toolkit.ValidationError):
+            call_action(
+                "organization_update",
+                context={"user": sysadmin["name"]},
+                id=org["id"],
+                name="",
+            )
+
+        assert outbox.pending_count() == 0
+
+    def test_rows_are_kept_if_the_update_fails(self):
+        factories.Organization()
+
+        backend = get_backend()
+        with mock.patch.object(backend, "add", side_effect=ValueError("Boom")):
+            with pytest.raises(ValueError):
+                outbox.relay()
+
+        assert outbox.pending_count() == 1
+
+        outbox.relay()
+
+        assert outbox.pending_count() == 0
+        assert call_action("organization_search")["count"] == 1
+
+    def test_deleted_entities_are_removed(self):
+        sysadmin = factories.Sysadmin()
+        org = factories.Organization()
+        outbox.relay()
+        assert call_action("organization_search")["count"] == 1
+
+        delete_organization = mock.Mock(wraps=index.delete_organization)
+        with mock.patch.dict(index.deleters, {"organization": delete_organization}):
+            call_action(
+                "organization_delete", context={"user": sysadmin["name"]}, id=org["id"]
+            )
+            outbox.relay()
+
+        assert call_action("organization_search")["count"] == 0
+        delete_organization.assert_called_once_with(org["id"], defer_commit=True)
+
+    def test_claimed_rows_are_skipped(self):
+        factories.Organization()
+        process = dirty.process
+        relayed_meanwhile = []
+
+        def process_and_relay(*args, **kwargs):
+            # No rows are locked while the index is updated, and the claimed
+            # ones are not processed by other relays
+            relayed_meanwhile.append(outbox.relay_batch())
+            return process(*args, **kwargs)
+
+        with mock.patch.object(dirty, "process", side_effect=process_and_relay):
+            assert outbox.relay_batch() == 1
+
+        assert relayed_meanwhile == [0]
+        assert outbox.pending_count() == 0
+
+    @pytest.mark.ckan_config("ckanext.sitesearch.outbox.claim_timeout", "60")
+    def test_expired_claims_are_processed_again(self):
+        factories.Organization()
+        with model.meta.engine.begin() as conn:
+            conn.execute(
+                db.outbox_table.update().values(
+                    claimed=datetime.datetime.utcnow() - datetime.timedelta(minutes=5)
+                )
+            )
+
+        assert outbox.relay() == 1
+        assert call_action("organization_search")["count"] == 1
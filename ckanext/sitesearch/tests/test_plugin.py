@@ -1,2 +1,135 @@
+import json
+import os
+import subprocess
+import sys
+
+from ckan.plugins import toolkit
+from ckan.tests import helpers
+
+from ckanext.sitesearch import plugin
+from ckanext.sitesearch.lib.lazy import lazy_function
+from ckanext.sitesearch.logic import action, auth, chained_action
+
+# Maximum time (in ms) that importing the plugin module can take, on top of
+# importing CKAN itself
+IMPORT_TIME_BUDGET = int(os.environ.get("CKANEXT_SITESEARCH_IMPORT_BUDGET", 100))
+
+LAZY_MODULES = (
+    "ckanext.sitesearch.cli",
+    "ckanext.sitesearch.views",
+    "ckanext.sitesearch.logic.action",
+    "ckanext.sitesearch.logic.auth",
+    "ckanext.sitesearch.logic.chained_action",
+    "ckanext.sitesearch.lib.index",
+    "ckanext.sitesearch.lib.query",
+    "ckanext.sitesearch.lib.rebuild",
+)
+
+IMPORT_SCRIPT = """
+import json
+import sys
+import time
+
+import ckan.plugins
+import ckan.plugins.toolkit
+
+start = time.perf_counter()
+import ckanext.sitesearch.plugin
+elapsed = (time.perf_counter() - start) * 1000
+
+print(json.dumps({"elapsed": elapsed, "modules": sorted(sys.modules)}))
+"""
+
+
 def test_plugin():
     pass
+
+
+def _measure_import():
+    output = subprocess.check_output([sys.executable, "-c", IMPORT_SCRIPT])
+    return json.loads(output.decode("utf-8").strip().splitlines()[-1])
+
+
+def test_plugin_import_does_not_load_heavy_modules():
+
+    result = _measure_import()
+
+    loaded = [m for m in LAZY_MODULES if m in result["modules"]]
+    assert loaded == []
+
+
+def test_plugin_import_time_budget():
+
+    # Take the best of a few runs to reduce noise
+    elapsed = min(_measure_import()["elapsed"] for _ in range(3))
+
+    assert elapsed < IMPORT_TIME_BUDGET, "Importing the plugin took {:.1f}ms".format(
+        elapsed
+    )
+
+
+def _attributes(func):
+    return {
+        k: getattr(func, k, None)
+        for k in (
+            "side_effect_free",
+            "chained_action",
+            "auth_allow_anonymous_access",
+            "__doc__",
+        )
+    }
+
+
+def test_lazy_actions_match_real_ones():
+
+    actions = plugin.SitesearchPlugin().get_actions()
+
+    for name, proxy in actions.items():
+        module = chained_action if proxy.__module__.endswith("chained_action") else action
+        real = getattr(module, proxy.__name__)
+        assert _attributes(proxy) == _attributes(real), name
+
+
+def test_lazy_auth_functions_match_real_ones():
+
+    auth_functions = plugin.SitesearchPlugin().get_auth_functions()
+
+    for name, proxy in auth_functions.items():
+        real = getattr(auth, proxy.__name__)
+        assert _attributes(proxy) == _attributes(real), name
+
+
+def test_lazy_function_is_imported_when_first_used():
+
+    proxy = lazy_function("ckanext.sitesearch.tests.test_plugin:_lazy_target")
+
+    assert proxy._function is None
+    assert proxy.__name__ == "_lazy_target"
+    assert proxy.__doc__ == "Lazy target docstring"
+    assert proxy.side_effect_free is True
+    assert proxy(2) == 4
+
+
+def test_help_show_for_lazy_actions():
+
+    result = helpers.call_action("help_show", name="sitesearch_autocomplete")
+
+    assert result.startswith("Return the entities with a name or title word")
+
+
+@toolkit.side_effect_free
+def _lazy_target(value):
+    """Lazy target docstring"""
+    return value * 2
+
+
+def test_defer_commit_read_at_call_time(monkeypatch):
+    from ckanext.sitesearch.lib.index import _get_defer_commit
+
+    monkeypatch.setitem(toolkit.config, "ckan.search.solr_commit", "false")
+    assert _get_defer_commit(None) is True
+
+    monkeypatch.setitem(toolkit.config, "ckan.search.solr_commit", "true")
+    assert _get_defer_commit(None) is False
+
+    assert _get_defer_commit(True) is True
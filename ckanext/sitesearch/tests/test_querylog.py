@@ -0,0 +1,184 @@
+import json
+import logging
+
+import pytest
+
+from ckan.plugins import toolkit
+from ckan.tests import factories, helpers
+
+from ckanext.sitesearch.lib import querylog
+from ckanext.sitesearch.lib.querylog import normalize_query, query_flags
+
+call_action = helpers.call_action
+
+
+def test_normalize_query():
+
+    query_1 = {
+        "q": "  some   query ",
+        "fq": "state:active",
+        "fq_list": ["entity_type:user"],
+        "facet.field": ["b", "a"],
+        "wt": "json",
+        "start": None,
+    }
+    query_2 = {
+        "facet.field": ["a", "b"],
+        "fq_list": ["state:active"],
+        "fq": "entity_type:user",
+        "q": "some query",
+    }
+
+    assert normalize_query(query_1) == normalize_query(query_2)
+    assert normalize_query(query_1) == {
+        "facet.field": ["a", "b"],
+        "fq": ["entity_type:user", "state:active"],
+        "q": "some query",
+    }
+
+
+def test_query_flags():
+
+    assert query_flags({"q": "test"}) == []
+    assert query_flags({"q": "test", "start": 5000}) == ["deep_paging"]
+    assert query_flags({"facet.field": ["tags"], "facet.limit": -1}) == [
+        "unbounded_facets"
+    ]
+    assert query_flags({"q": "*test"}) == ["leading_wildcard"]
+    assert query_flags({"q": "name:*test"}) == ["leading_wildcard"]
+    assert query_flags({"q": "test*"}) == []
+
+
+@pytest.mark.usefixtures("clean_db", "clean_index")
+class TestSlowQueryLog(object):
+    @pytest.mark.ckan_config("ckanext.sitesearch.slow_query.threshold", "0")
+    def test_slow_query_logged(self, caplog):
+
+        factories.Organization()
+
+        with caplog.at_level(
+            logging.WARNING, logger="ckanext.sitesearch.slow_queries"
+        ):
+            call_action("organization_search", q="*test", start=2000)
+
+        records = [
+            r for r in caplog.records if r.name == "ckanext.sitesearch.slow_queries"
+        ]
+        assert len(records) == 1
+
+        entry = json.loads(records[0].getMessage())
+        assert entry["entity_type"] == "organization"
+        assert entry["start"] == 2000
+        assert entry["flags"] == ["deep_paging", "leading_wildcard"]
+        assert entry["params"]["q"] == "*test"
+        assert entry["wall_time"] >= 0
+
+    @pytest.mark.ckan_config("ckanext.sitesearch.slow_query.threshold", "0")
+    @pytest.mark.ckan_config("ckanext.sitesearch.wildcards", "reversed")
+    def test_slow_query_logged_before_rewrite(self, caplog):
+
+        with caplog.at_level(
+            logging.WARNING, logger="ckanext.sitesearch.slow_queries"
+        ):
+            call_action("organization_search", q="*test")
+
+        records = [
+            r for r in caplog.records if r.name == "ckanext.sitesearch.slow_queries"
+        ]
+        entry = json.loads(records[0].getMessage())
+        assert entry["flags"] == ["leading_wildcard"]
+        assert entry["params"]["q"] == "*test"
+
+    @pytest.mark.ckan_config("ckanext.sitesearch.slow_query.threshold", "100000")
+    def test_fast_query_not_logged(self, caplog):
+
+        with caplog.at_level(
+            logging.WARNING, logger="ckanext.sitesearch.slow_queries"
+        ):
+            call_action("organization_search")
+
+        assert not [
+            r for r in caplog.records if r.name == "ckanext.sitesearch.slow_queries"
+        ]
+
+
+@pytest.fixture
+def sampled_query_log():
+    logger = querylog.sampled_query_log
+    yield logger
+    handler = querylog._file_handlers.pop(logger.name, None)
+    if handler:
+        logger.removeHandler(handler)
+        handler.close()
+    logger.setLevel(logging.NOTSET)
+
+
+@pytest.mark.usefixtures("clean_db", "clean_index")
+class TestSampledQueryLog(object):
+    @pytest.mark.ckan_config("ckanext.sitesearch.query_log.sample_rate", "1")
+    def test_query_sampled(self, caplog):
+
+        with caplog.at_level(logging.INFO, logger="ckanext.sitesearch.queries"):
+            call_action("organization_search", q="test", rows=5)
+
+        records = [r for r in caplog.records if r.name == "ckanext.sitesearch.queries"]
+        assert len(records) == 1
+
+        entry = json.loads(records[0].getMessage())
+        assert entry == {
+            "entity_type": "organization",
+            "permission_labels": None,
+            "params": {"q": "test", "rows": 5, "sort": "title asc"},
+        }
+
+    @pytest.mark.ckan_config("ckanext.sitesearch.query_log.sample_rate", "1")
+    @pytest.mark.ckan_config("ckanext.sitesearch.wildcards", "reversed")
+    def test_query_sampled_before_rewrite(self, caplog):
+
+        with caplog.at_level(logging.INFO, logger="ckanext.sitesearch.queries"):
+            call_action("organization_search", q="*test")
+
+        records = [r for r in caplog.records if r.name == "ckanext.sitesearch.queries"]
+        assert json.loads(records[0].getMessage())["params"]["q"] == "*test"
+
+    def test_sampling_disabled_by_default(self, caplog):
+
+        with caplog.at_level(logging.INFO, logger="ckanext.sitesearch.queries"):
+            call_action("organization_search", q="test")
+
+        assert not [
+            r for r in caplog.records if r.name == "ckanext.sitesearch.queries"
+        ]
+
+    def test_level_not_set_on_import(self, sampled_query_log):
+
+        assert sampled_query_log.level == logging.NOTSET
+
+    @pytest.mark.ckan_config("ckanext.sitesearch.query_log.sample_rate", "1")
+    def test_query_sampled_to_file(self, sampled_query_log, tmp_path, monkeypatch):
+        path = tmp_path / "queries.log"
+        monkeypatch.setitem(
+            toolkit.config, "ckanext.sitesearch.query_log.file", str(path)
+        )
+
+        call_action("organization_search", q="test")
+
+        handler = querylog._file_handlers[sampled_query_log.name]
+        assert handler.level == logging.INFO
+        assert sampled_query_log.level == logging.INFO
+        handler.flush()
+        assert '"q": "test"' in path.read_text()
+
+    @pytest.mark.ckan_config("ckanext.sitesearch.query_log.sample_rate", "1")
+    def test_configured_level_kept(self, sampled_query_log, tmp_path, monkeypatch):
+        path = tmp_path / "queries.log"
+        monkeypatch.setitem(
+            toolkit.config, "ckanext.sitesearch.query_log.file", str(path)
+        )
+        sampled_query_log.setLevel(logging.ERROR)
+
+        call_action("organization_search", q="test")
+
+        assert sampled_query_log.level == logging.ERROR
+        querylog._file_handlers[sampled_query_log.name].flush()
+        assert path.read_text() == ""
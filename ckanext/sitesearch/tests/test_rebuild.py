@@ -1,8 +1,17 @@
+from unittest import mock
+
 import pytest
 
+from ckan.lib.search import SearchIndexError
 from ckan.lib.search import clear_all as reset_index
+from ckan.lib.search.index import PackageSearchIndex
+from ckan.plugins import toolkit
 from ckan.tests import factories, helpers
 
+from ckanext.sitesearch.lib import failures, rebuild
+from ckanext.sitesearch.lib.backends.solr import SolrBackend
+from ckanext.sitesearch.lib.checkpoint import Checkpoint
+
 
 @pytest.mark.usefixtures("clean_db", "clean_index")
 class TestRebuild:
@@ -102,3 +111,268 @@ class TestRebuild:
         )
         assert result["count"] == 1
         assert result["results"][0]["package_count"] == 1
+
+
+@pytest.fixture
+def checkpoint_dir(tmp_path, monkeypatch):
+    monkeypatch.setitem(
+        toolkit.config, "ckanext.sitesearch.checkpoint_dir", str(tmp_path)
+    )
+    return tmp_path
+
+
+@pytest.mark.usefixtures("clean_db", "clean_index", "checkpoint_dir")
+class TestRebuildCheckpoints:
+    def test_checkpoint_saved_after_commit(self):
+        org_ids = sorted(factories.Organization()["id"] for i in range(3))
+
+        def index_organization(data_dict, defer_commit):
+            if data_dict["id"] == org_ids[2]:
+                raise ValueError("Boom")
+
+        with mock.patch.dict(
+            rebuild.indexers, {"organization": index_organization}
+        ), mock.patch.object(rebuild, "commit") as commit:
+            with pytest.raises(ValueError):
+                rebuild.rebuild_orgs(defer_commit=True, checkpoint_every=2)
+
+        assert commit.call_count == 1
+
+        checkpoint = Checkpoint("organization").load()
+        assert checkpoint["last_id"] == org_ids[1]
+        assert checkpoint["indexed"] == 2
+        assert checkpoint["total"] == 3
+
+    def test_resume(self):
+        org_ids = sorted(factories.Organization()["id"] for i in range(3))
+
+        Checkpoint("organization").save(org_ids[0], indexed=1, failed=0, total=3)
+
+        index_organization = mock.Mock()
+        with mock.patch.dict(rebuild.indexers, {"organization": index_organization}):
+            rebuild.rebuild_orgs(resume=True)
+
+        assert [c[0][0]["id"] for c in index_organization.call_args_list] == org_ids[1:]
+
+        # The checkpoint is removed once the rebuild completes
+        assert Checkpoint("organization").load() is None
+
+    def test_no_resume_starts_from_scratch(self):
+        org_ids = sorted(factories.Organization()["id"] for i in range(3))
+
+        Checkpoint("organization").save(org_ids[0], indexed=1, failed=0, total=3)
+
+        index_organization = mock.Mock()
+        with mock.patch.dict(rebuild.indexers, {"organization": index_organization}):
+            rebuild.rebuild_orgs()
+
+        assert index_organization.call_count == 3
+
+    def test_single_entity_does_not_use_checkpoints(self):
+        org = factories.Organization()
+
+        rebuild.rebuild_orgs(entity_id=org["id"])
+
+        assert Checkpoint("organization").load() is None
+
+
+@pytest.mark.usefixtures("clean_db", "clean_index")
+class TestRebuildDatasetsParallel(object):
+    def test_rebuild_datasets_with_workers(self):
+        org = factories.Organization()
+        datasets = [factories.Dataset(owner_org=org["id"]) for _ in range(5)]
+
+        reset_index()
+        rebuild.rebuild_orgs()
+
+        assert helpers.call_action("package_search")["count"] == 0
+
+        assert rebuild.rebuild_datasets(workers=2, chunk_size=2) == (5, 0)
+
+        result = helpers.call_action("package_search")
+        assert result["count"] == 5
+        assert sorted(d["id"] for d in result["results"]) == sorted(
+            d["id"] for d in datasets
+        )
+
+        # Other entities are not cleared
+        assert helpers.call_action("organization_search")["count"] == 1
+
+    def test_rebuild_datasets_with_workers_records_failures(self):
+        datasets = sorted(
+            (factories.Dataset() for _ in range(4)), key=lambda d: d["id"]
+        )
+        failing_id = datasets[1]["id"]
+        index_package = PackageSearchIndex.index_package
+
+        def failing_index_package(self, pkg_dict, *args, **kwargs):
+            if pkg_dict["id"] == failing_id:
+                raise ValueError("Boom")
+            return index_package(self, pkg_dict, *args, **kwargs)
+
+        # The workers are forked, so they get the patched method
+        with mock.patch.object(
+            PackageSearchIndex, "index_package", failing_index_package
+        ):
+            result = rebuild.rebuild_datasets(workers=2, chunk_size=1, force=True)
+
+        assert result == (3, 1)
+
+        recorded = failures.get_failures("dataset")
+        assert [(f["entity_id"], f["error_class"]) for f in recorded] == [
+            (failing_id, "ValueError")
+        ]
+
+        assert rebuild.retry_failures("dataset") == (1, 0)
+        assert failures.get_failures("dataset") == []
+
+    def test_rebuild_datasets_sends_one_request_per_chunk(self):
+        dataset_ids = sorted(factories.Dataset()["id"] for _ in range(5))
+        add = SolrBackend.add
+
+        reset_index()
+        # A single shard, so the chunks are indexed in this process
+        with mock.patch.object(
+            SolrBackend, "add", autospec=True, side_effect=add
+        ) as solr_add:
+            assert rebuild.rebuild_datasets(shard=(1, 1), chunk_size=2) == (5, 0)
+
+        sent = [[doc["id"] for doc in c[0][1]] for c in solr_add.call_args_list]
+        assert sent == [dataset_ids[0:2], dataset_ids[2:4], dataset_ids[4:]]
+        assert all(c[1]["commit"] is False for c in solr_add.call_args_list)
+
+        rebuild.commit_all()
+        assert helpers.call_action("package_search")["count"] == 5
+
+    def test_rebuild_datasets_rejected_chunk_sent_one_at_a_time(self):
+        dataset_ids = sorted(factories.Dataset()["id"] for _ in range(3))
+        rejected_id = dataset_ids[1]
+        add = SolrBackend.add
+
+        def rejecting_add(self, docs, commit=False):
+            if any(doc["id"] == rejected_id for doc in docs):
+                raise SearchIndexError("Rejected")
+            return add(self, docs, commit=commit)
+
+        reset_index()
+        with mock.patch.object(SolrBackend, "add", rejecting_add):
+            result = rebuild.rebuild_datasets(shard=(1, 1), chunk_size=3, force=True)
+        rebuild.commit_all()
+
+        assert result == (2, 1)
+        recorded = failures.get_failures("dataset")
+        assert [(f["entity_id"], f["error_class"]) for f in recorded] == [
+            (rejected_id, "SearchIndexError")
+        ]
+        assert sorted(
+            d["id"] for d in helpers.call_action("package_search")["results"]
+        ) == [dataset_ids[0], dataset_ids[2]]
+
+
+class TestShards(object):
+    def test_parse_shard(self):
+        assert rebuild.parse_shard("2/4") == (2, 4)
+
+    @pytest.mark.parametrize("value", ["2", "a/4", "0/4", "5/4", "1/0", "1/2/3"])
+    def test_parse_shard_invalid(self, value):
+        with pytest.raises(ValueError):
+            rebuild.parse_shard(value)
+
+    def test_shards_are_disjoint(self):
+        ids = [str(i) for i in range(1000)]
+
+        shards = [
+            set(i for i in ids if rebuild.in_shard(i, (index, 3)))
+            for index in (1, 2, 3)
+        ]
+
+        assert sum(len(shard) for shard in shards) == len(ids)
+        assert set.union(*shards) == set(ids)
+        # Roughly balanced
+        assert all(len(shard) > 250 for shard in shards)
+
+
+@pytest.mark.usefixtures("clean_db", "clean_index", "checkpoint_dir")
+class TestShardedRebuild(object):
+    def test_only_shard_entities_are_indexed(self):
+        org_ids = [factories.Organization()["id"] for i in range(6)]
+
+        indexed = []
+        for shard in ((1, 2), (2, 2)):
+            index_organization = mock.Mock()
+            with mock.patch.dict(
+                rebuild.indexers, {"organization": index_organization}
+            ), mock.patch.object(rebuild, "commit") as commit:
+                rebuild.rebuild_orgs(defer_commit=True, shard=shard)
+
+            shard_ids = [c[0][0]["id"] for c in index_organization.call_args_list]
+            assert all(rebuild.in_shard(i, shard) for i in shard_ids)
+            indexed.extend(shard_ids)
+
+            # The final commit is left to `commit_all`
+            commit.assert_not_called()
+
+        assert sorted(indexed) == sorted(org_ids)
+
+    def test_shards_have_their_own_checkpoint(self):
+        org_ids = sorted(factories.Organization()["id"] for i in range(3))
+
+        Checkpoint("organization", (1, 2)).save(
+            org_ids[-1], indexed=1, failed=0, total=3
+        )
+
+        index_organization = mock.Mock()
+        with mock.patch.dict(rebuild.indexers, {"organization": index_organization}):
+            rebuild.rebuild_orgs(resume=True, shard=(2, 2))
+
+        assert [c[0][0]["id"] for c in index_organization.call_args_list] == [
+            i for i in org_ids if rebuild.in_shard(i, (2, 2))
+        ]
+        assert Checkpoint("organization", (1, 2)).load()
+        assert Checkpoint("organization").load() is None
+
+    def test_datasets_rebuild_checkpoint_and_resume(self):
+        dataset_ids = sorted(factories.Dataset()["id"] for _ in range(4))
+        index_chunk = rebuild._index_datasets_chunk
+        calls = []
+
+        def interrupted_index_chunk(args):
+            calls.append(args[0])
+            if len(calls) == 3:
+                raise KeyboardInterrupt()
+            return index_chunk(args)
+
+        reset_index()
+        with mock.patch.object(
+            rebuild, "_index_datasets_chunk", side_effect=interrupted_index_chunk
+        ):
+            with pytest.raises(KeyboardInterrupt):
+                rebuild.rebuild_datasets(shard=(1, 1), chunk_size=1, checkpoint_every=2)
+
+        checkpoint = Checkpoint("dataset", (1, 1))
+        assert checkpoint.load()["last_id"] == dataset_ids[1]
+        assert checkpoint.load()["indexed"] == 2
+
+        indexed, failed = rebuild.rebuild_datasets(
+            shard=(1, 1), chunk_size=1, resume=True
+        )
+        rebuild.commit_all()
+
+        assert (indexed, failed) == (4, 0)
+        assert checkpoint.load() is None
+        result = helpers.call_action("package_search")
+        assert sorted(d["id"] for d in result["results"]) == dataset_ids
+
+    def test_sharded_datasets_rebuild(self):
+        datasets = [factories.Dataset() for _ in range(5)]
+
+        reset_index()
+
+        for shard in ((1, 2), (2, 2)):
+            rebuild.rebuild_datasets(shard=shard, chunk_size=2)
+        rebuild.commit_all()
+
+        result = helpers.call_action("package_search")
+        assert sorted(d["id"] for d in result["results"]) == sorted(
+            d["id"] for d in datasets
+        )
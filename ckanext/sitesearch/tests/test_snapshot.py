@@ -0,0 +1,77 @@
+import gzip
+import json
+
+import pytest
+
+from ckan.cli.cli import ckan
+from ckan.tests import factories, helpers
+
+from ckanext.sitesearch.lib import index, snapshot
+
+call_action = helpers.call_action
+
+
+@pytest.mark.usefixtures("clean_db", "clean_index")
+class TestSnapshot(object):
+    def test_snapshot_and_restore(self, tmp_path):
+        org = factories.Organization(
+            description="Some org about snakes",
+            extras=[{"key": "theme", "value": "reptiles"}],
+        )
+        group = factories.Group()
+        user = factories.User()
+        dataset = factories.Dataset(owner_org=org["id"])
+
+        path = str(tmp_path / "snapshot.ndjson.gz")
+        count = snapshot.snapshot(path, batch_size=2)
+
+        with gzip.open(path, "rt") as f:
+            docs = [json.loads(line) for line in f]
+        assert len(docs) == count
+        ids = [doc["id"] for doc in docs]
+        assert len(set(ids)) == count
+        assert {org["id"], group["id"], user["id"]} <= set(ids)
+        assert dataset["id"] not in ids
+        assert all("_version_" not in doc for doc in docs)
+
+        index.clear_organizations()
+        index.clear_groups()
+        index.clear_users()
+        index.commit()
+        assert call_action("organization_search")["count"] == 0
+
+        assert snapshot.restore(path, batch_size=2) == (count, 0)
+
+        assert call_action("organization_search", q="snakes")["count"] == 1
+        # Fields that are not stored in Solr are restored too
+        assert call_action("organization_search", fq="theme:reptiles")["count"] == 1
+        assert call_action("group_search")["results"][0]["id"] == group["id"]
+        assert call_action("user_search", q=user["name"])["count"] == 1
+        assert call_action("package_search")["results"][0]["id"] == dataset["id"]
+
+    def test_snapshot_entity_type(self, tmp_path):
+        factories.Organization()
+        factories.Group()
+
+        path = str(tmp_path / "snapshot.ndjson.gz")
+
+        assert snapshot.snapshot(path, entity_type="group") == 1
+
+    def test_cli(self, cli, tmp_path):
+        factories.Organization()
+
+        path = str(tmp_path / "snapshot.ndjson.gz")
+
+        result = cli.invoke(
+            ckan, ["sitesearch", "snapshot", path, "-t", "organization"]
+        )
+        assert not result.exit_code, result.output
+        assert "1 documents written" in result.output
+
+        index.clear_organizations()
+
+        result = cli.invoke(ckan, ["sitesearch", "restore", path])
+        assert not result.exit_code, result.output
+        assert "1 documents restored, 0 failed" in result.output
+
+        assert call_action("organization_search")["count"] == 1
@@ -0,0 +1,75 @@
+import json
+
+import pytest
+
+from ckan.plugins import toolkit
+from ckan.tests import factories
+from ckan.cli.cli import ckan
+
+from ckanext.sitesearch.lib import index, stats
+
+
+def test_percentile():
+
+    assert stats.percentile([], 95) == 0
+    assert stats.percentile([3, 1, 2], 50) == 2
+    assert stats.percentile(range(1, 101), 95) == 95
+    assert stats.percentile([5], 99) == 5
+
+
+@pytest.mark.usefixtures("clean_db", "clean_index")
+class TestStats(object):
+    def test_counts(self):
+        factories.Organization()
+        factories.Organization()
+        factories.Group()
+
+        data = stats.get_stats()
+
+        assert data["site_id"] == toolkit.config.get("ckan.site_id")
+        orgs = data["entity_types"]["organization"]
+        assert orgs["indexed"] == 2
+        assert orgs["db"] == 2
+        assert orgs["diff"] == 0
+        assert data["entity_types"]["group"]["indexed"] == 1
+        assert data["sites"][data["site_id"]] >= 3
+
+    def test_diff_with_db(self):
+        org = factories.Organization()
+        factories.Organization()
+        index.delete_organization(org["id"])
+
+        data = stats.get_stats(sizes=False)
+
+        assert data["entity_types"]["organization"]["diff"] == -1
+        assert "avg_size" not in data["entity_types"]["organization"]
+
+    def test_sizes(self):
+        factories.Organization(description="short")
+        big = factories.Organization(description="long " * 1000)
+
+        data = stats.get_stats(largest=1)
+
+        orgs = data["entity_types"]["organization"]
+        assert orgs["avg_size"] > orgs["avg_data_dict_size"] > 0
+        assert orgs["p95_size"] >= orgs["avg_size"]
+        assert len(data["largest"]) == 1
+        assert data["largest"][0]["id"] == big["id"]
+
+    def test_cli_json(self, cli):
+        factories.Organization()
+
+        result = cli.invoke(ckan, ["sitesearch", "stats", "--json"])
+
+        assert not result.exit_code, result.output
+        data = json.loads(result.output)
+        assert data["entity_types"]["organization"]["indexed"] == 1
+
+    def test_cli(self, cli):
+        factories.Organization()
+
+        result = cli.invoke(ckan, ["sitesearch", "stats"])
+
+        assert not result.exit_code, result.output
+        assert "organization" in result.output
+        assert "Largest documents" in result.output
@@ -0,0 +1,113 @@
+from html import unescape
+
+import pytest
+
+from ckanext.sitesearch.lib.utils import sanitize_html_text, strip_html_tags
+
+
+def _sanitize_text_reference(text):
+    """The page content sanitization as it was done before
+    `sanitize_html_text` was added"""
+    text = unescape(strip_html_tags(text))
+    for char in ("\r", "\n"):
+        text = text.replace(char, "")
+    for char in ("\xa0", "\t"):
+        text = text.replace(char, " ")
+    return text
+
+
+PAGE_CONTENT = """
+<h1 class="title">About   us</h1>
+<p>Some <strong>bold</strong> and <em>italic</em> text&nbsp;here.</p>
+<p><a href="https://example.com?a=1&amp;b=2" title='Go > there'>A link</a></p>
+<ul>
+\t<li>One &amp; two</li>
+\t<li>Caf&eacute; &#233; &#x41;</li>
+</ul>
+<!-- A comment -->
+<img src="image.png" alt="An image" />
+<table><tr><td>Cell 1</td><td>Cell 2</td></tr></table>
+"""
+
+CASES = [
+    "",
+    "Plain text",
+    "AT&T rocks",
+    "a &amp b",
+    "x &copy y",
+    "1 &lt 2",
+    "&#60;b&#62; stays as text",
+    "<p>a</p> <p>b</p>",
+    "x<br/>y",
+    "<p>unclosed",
+    "a <b",
+    "a < b and c > d",
+    "<<b>b>",
+    "<!-- c -->t<?pi?>",
+    "<!DOCTYPE html><html><body>z</body></html>",
+    "<![CDATA[x]]>y",
+    '<a title="x>y">l</a>',
+    "<a href=\"#\" onclick='f(\"x\")'>k</a>",
+    "<script>if (a<b) x()</script>",
+    "<SCRIPT type='text/javascript'>x<b>y</b></SCRIPT>z",
+    "<style>p>a{color: red}</style>q",
+    "line\r\nbreak\t&nbsp;x",
+    PAGE_CONTENT,
+]
+
+# Malformed markup, and the text that the lxml parser gets from it
+MALFORMED_CASES = [
+    ("<p>x</ p>", "x"),
+    ("</>x", "x"),
+    ("a</3>b", "ab"),
+    ("<p>a</p >b", "ab"),
+    ("< p>x</p>", "< p>x"),
+    ("a<!b>c", "ac"),
+    ("a<?x", "a<?x"),
+    ("x</p foo='>'>y", "xy"),
+    ("a<!-- unclosed comment b", "a<!-- unclosed comment b"),
+    ("a <!-- b > c", "a "),
+    ("a<!-- x --> b <!-- y", "a b "),
+    ("a<!--b<p>c</p>d", "a"),
+    ("<!--->a-->b", "a-->b"),
+    ("a<!-- b --!> c", "a c"),
+    ("<p>a</p><script>x", "ax"),
+    ("<style>p{}</style><style>x<p>y</p>", "p{}x<p>y</p>"),
+    ("a<script/>b", "ab"),
+    ("a<scripts>b</scripts>c", "abc"),
+]
+
+
+@pytest.mark.parametrize("text", CASES + [text for text, _ in MALFORMED_CASES])
+def test_sanitize_html_text_matches_reference(text):
+
+    assert sanitize_html_text(text, use_lxml=False) == _sanitize_text_reference(text)
+
+
+def test_sanitize_html_text_large_document():
+
+    text = PAGE_CONTENT * 500
+
+    assert sanitize_html_text(text, use_lxml=False) == _sanitize_text_reference(text)
+
+
+def test_sanitize_html_text_lxml():
+    pytest.importorskip("lxml.html")
+
+    # The lxml parser can differ on malformed markup, but not on the
+    # text of well-formed documents
+    assert " ".join(sanitize_html_text(PAGE_CONTENT, use_lxml=True).split()) == (
+        " ".join(_sanitize_text_reference(PAGE_CONTENT).split())
+    )
+
+
+@pytest.mark.parametrize("text,expected", MALFORMED_CASES)
+def test_sanitize_html_text_lxml_malformed(text, expected):
+    pytest.importorskip("lxml.html")
+
+    assert sanitize_html_text(text, use_lxml=True) == expected
+
+
+def test_sanitize_html_text_non_string():
+
+    assert sanitize_html_text(None, use_lxml=False) == "None"
@@ -0,0 +1,95 @@
+import json
+from unittest import mock
+
+import pytest
+
+from ckan.cli.cli import ckan
+from ckan.tests import factories
+
+from ckanext.sitesearch.lib import warmup
+from ckanext.sitesearch.lib.backends import solr
+
+
+ORG_QUERY = {
+    "entity_type": "organization",
+    "permission_labels": None,
+    "params": {"q": "water", "rows": 20, "sort": "title asc"},
+}
+
+PAGE_QUERY = {
+    "entity_type": "page",
+    "permission_labels": ["public"],
+    "params": {"q": "*:*", "fq": ["state:active"], "rows": 20},
+}
+
+
+@pytest.fixture
+def query_log(tmp_path):
+    path = tmp_path / "queries.log"
+    lines = [ORG_QUERY, PAGE_QUERY, ORG_QUERY]
+    path.write_text(
+        "".join(
+            "2023-01-01 10:00:00,000 {}\n".format(json.dumps(entry))
+            for entry in lines
+        )
+    )
+    # Rotated file
+    (tmp_path / "queries.log.1").write_text(
+        "2022-12-31 10:00:00,000 {}\n".format(json.dumps(PAGE_QUERY))
+        + "not a query\n"
+        + "2022-12-31 10:00:00,000 {}\n".format(json.dumps(ORG_QUERY))
+    )
+    return str(path)
+
+
+def test_top_queries(query_log):
+
+    assert warmup.top_queries(query_log) == [(3, ORG_QUERY), (2, PAGE_QUERY)]
+    assert warmup.top_queries(query_log, limit=1) == [(3, ORG_QUERY)]
+
+
+@pytest.mark.usefixtures("clean_db", "clean_index")
+def test_warmup(query_log):
+
+    factories.Organization(title="Water")
+
+    with mock.patch.object(
+        solr.SolrBackend, "search", side_effect=solr.SolrBackend.search, autospec=True
+    ) as search:
+        assert warmup.warmup(path=query_log) == (2, 0)
+
+    calls = search.call_args_list
+    assert calls[0][1]["entity_type"] == "organization"
+    assert calls[0][1]["permission_labels"] is None
+    assert calls[1][1]["entity_type"] == "page"
+    assert calls[1][1]["permission_labels"] == ["public"]
+
+
+def test_warmup_no_log():
+
+    with pytest.raises(ValueError):
+        warmup.warmup()
+
+
+def test_solr_warming_config(query_log):
+
+    config = warmup.solr_warming_config(path=query_log)
+
+    assert config.startswith(
+        '<listener event="newSearcher" class="solr.QuerySenderListener">'
+    )
+    assert '<str name="q">water</str>' in config
+    assert '<str name="fq">+entity_type:organization</str>' in config
+    assert '<str name="fq">state:active</str>' in config
+    assert '<str name="fq">{!terms f=permission_labels}public</str>' in config
+    assert config.count("<lst>") == 2
+
+
+def test_cli_solr_config(cli, query_log):
+
+    result = cli.invoke(
+        ckan, ["sitesearch", "warmup", "--solr-config", "-f", query_log]
+    )
+
+    assert not result.exit_code, result.output
+    assert "QuerySenderListener" in result.output
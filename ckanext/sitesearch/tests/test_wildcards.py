@@ -0,0 +1,131 @@
+import json
+
+import pytest
+
+from ckan.lib.search.common import SearchQueryError
+from ckan.tests import factories, helpers
+
+from ckanext.sitesearch.lib import index, wildcards
+
+call_action = helpers.call_action
+
+
+def test_reversed_words():
+
+    assert wildcards.reversed_words("john-smithson", "John Smithson", None) == (
+        "nhoj noshtims"
+    )
+
+
+def test_allowed_by_default():
+
+    assert wildcards.rewrite_query("*son a* *s*") == "*son a* *s*"
+
+
+@pytest.mark.ckan_config("ckanext.sitesearch.wildcards", "reject")
+@pytest.mark.parametrize("q", ["*son", "water *son", "name:*son", "?son", "a*"])
+def test_rejected(q):
+
+    with pytest.raises(SearchQueryError):
+        wildcards.rewrite_query(q)
+
+
+@pytest.mark.ckan_config("ckanext.sitesearch.wildcards", "reject")
+@pytest.mark.parametrize(
+    "q", ["*:*", "water", "wat*", "title:[* TO *]", '"*son"', "\\*son"]
+)
+def test_not_rejected(q):
+
+    assert wildcards.rewrite_query(q) == q
+
+
+@pytest.mark.ckan_config("ckanext.sitesearch.wildcards", "reversed")
+@pytest.mark.parametrize(
+    "q,expected",
+    [
+        ("*son", "text_reversed:nos*"),
+        ("*SON", "text_reversed:nos*"),
+        ("?son", "text_reversed:nos?"),
+        ("water -*son", "water -text_reversed:nos*"),
+        ("(*son OR health)", "(text_reversed:nos* OR health)"),
+        ("wat*", "wat*"),
+    ],
+)
+def test_reversed(q, expected):
+
+    assert wildcards.rewrite_query(q) == expected
+
+
+@pytest.mark.ckan_config("ckanext.sitesearch.wildcards", "reversed")
+@pytest.mark.parametrize("q", ["*son*", "name:*son", "*s"])
+def test_reversed_rejected(q):
+
+    with pytest.raises(SearchQueryError):
+        wildcards.rewrite_query(q)
+
+
+@pytest.mark.ckan_config("ckanext.sitesearch.wildcards", "reversed")
+@pytest.mark.ckan_config("ckanext.sitesearch.wildcards.min_chars", "4")
+def test_min_chars():
+
+    with pytest.raises(SearchQueryError):
+        wildcards.rewrite_query("wat*")
+
+
+@pytest.mark.ckan_config("ckanext.sitesearch.wildcards", "reversed")
+def test_reversed_field_indexed():
+
+    user = index.prepare_user(
+        {
+            "id": "1",
+            "name": "jsmithson",
+            "fullname": "John Smithson",
+            "created": "2023-01-01T00:00:00",
+        }
+    )
+
+    assert user["text_reversed"] == "noshtimsj nhoj noshtims"
+    assert "text_reversed" not in json.loads(user["validated_data_dict"])
+
+
+def test_reversed_field_not_indexed_by_default():
+
+    user = index.prepare_user(
+        {"id": "1", "name": "jsmithson", "created": "2023-01-01T00:00:00"}
+    )
+
+    assert "text_reversed" not in user
+
+
+@pytest.mark.usefixtures("clean_db", "clean_index")
+class TestSearch(object):
+    @pytest.mark.ckan_config("ckanext.sitesearch.wildcards", "reversed")
+    def test_reversed(self):
+
+        # Single word values, so the field works the same if it is indexed
+        # as a single string (eg by the catch-all field of the default CKAN
+        # schema)
+        for name in ("anderson", "smithson", "smith"):
+            factories.User(name=name, fullname="")
+            factories.Organization(name=name, title=name.title())
+
+        result = call_action("user_search", q="*son")
+
+        assert sorted(u["name"] for u in result["results"]) == ["anderson", "smithson"]
+
+        result = call_action("organization_search", q="*SON")
+
+        assert sorted(o["name"] for o in result["results"]) == [
+            "anderson",
+            "smithson",
+        ]
+
+    @pytest.mark.ckan_config("ckanext.sitesearch.wildcards", "reject")
+    def test_rejected(self):
+
+        factories.Organization(name="anderson")
+
+        with pytest.raises(SearchQueryError):
+            call_action("organization_search", q="*son")
+
+        assert call_action("organization_search", q="anders*")["count"] == 1
@@ -0,0 +1,192 @@
+import hashlib
+import json
+import logging
+
+from flask import Blueprint, Response, request
+
+from ckan.lib.search.common import SearchError, SearchQueryError
+from ckan import plugins as p
+from ckan.plugins import toolkit
+from ckan.views.api import _get_request_data
+
+from ckanext.sitesearch.interfaces import ISiteSearch
+from ckanext.sitesearch.lib import metrics
+from ckanext.sitesearch.lib.generation import get_generation
+from ckanext.sitesearch.lib.index import (
+    generation_tracks_commits,
+    thin_documents_enabled,
+)
+from ckanext.sitesearch.lib.querylog import normalize_query
+from ckanext.sitesearch.logic.action import RawJSON, _get_user_page_labels
+
+
+log = logging.getLogger(__name__)
+
+# Search actions that can return their results as stored in the index
+RAW_SEARCH_ACTIONS = (
+    "organization_search",
+    "group_search",
+    "user_search",
+    "page_search",
+)
+
+
+sitesearch = Blueprint("sitesearch", __name__)
+
+
+def metrics_view():
+
+    try:
+        toolkit.check_access("sitesearch_metrics", {"user": toolkit.g.user}, {})
+    except toolkit.NotAuthorized:
+        return toolkit.abort(403, toolkit._("Not authorized to see this page"))
+
+    sink = metrics.get_sink()
+    if not hasattr(sink, "render"):
+        return toolkit.abort(
+            404, toolkit._("The configured metrics sink does not expose metrics")
+        )
+
+    return Response(sink.render(), mimetype="text/plain; version=0.0.4")
+
+
+sitesearch.add_url_rule("/sitesearch/metrics", view_func=metrics_view)
+
+
+def _api_response(status, body):
+    return Response(body, status=status, mimetype="application/json")
+
+
+def _api_error(status, help_url, error):
+    return _api_response(
+        status, json.dumps({"help": help_url, "success": False, "error": error})
+    )
+
+
+def _etag(logic_function, request_data, context):
+    """Return the ETag of the search results, or None if not available
+
+    Results only change when the index generation changes, so the ETag
+    is built from it, the normalised search parameters and the user
+    permission labels (or the user itself if there are `ISiteSearch`
+    plugins, which could change the results for each user).
+
+    Not available with thin documents, as their results are built from the
+    database and can change without a new generation, nor when changes are
+    committed by Solr's autoCommit, as they can become visible after the
+    generation changed.
+    """
+    if not toolkit.asbool(toolkit.config.get("ckanext.sitesearch.etags", True)):
+        return None
+    if thin_documents_enabled() or not generation_tracks_commits():
+        return None
+
+    generation = get_generation()
+    if generation is None:
+        return None
+
+    key = [generation, logic_function, normalize_query(request_data)]
+    if logic_function == "page_search":
+        key.append(sorted(_get_user_page_labels(context["user"])))
+    if list(p.PluginImplementations(ISiteSearch)):
+        key.append(context["user"])
+
+    return hashlib.sha1(
+        json.dumps(key, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+
+
+def raw_search_view(logic_function):
+    """Same as the search action API endpoints, but the entity dicts stored
+    in the index are spliced into the response body without decoding them
+    (unless there are `ISiteSearch` plugins changing the results)
+
+    Responses include an ETag, and requests with a matching `If-None-Match`
+    header get a 304 response without running the search.
+    """
+    help_url = toolkit.url_for(
+        "api.action",
+        logic_function="help_show",
+        ver=3,
+        name=logic_function,
+        _external=True,
+    )
+
+    try:
+        if logic_function not in RAW_SEARCH_ACTIONS:
+            raise KeyError(logic_function)
+        action = toolkit.get_action(logic_function)
+    except KeyError:
+        return _api_error(
+            400,
+            help_url,
+            "Bad request - Action name not known: {}".format(logic_function),
+        )
+
+    try:
+        request_data = _get_request_data(try_url_params=True)
+    except ValueError as e:
+        log.info("Bad raw search API request data: %s", e)
+        return _api_error(400, help_url, "Bad request - JSON Error: {}".format(e))
+
+    context = {
+        "user": toolkit.g.user,
+        "auth_user_obj": toolkit.g.userobj,
+        "raw_json": True,
+    }
+    try:
+        etag = _etag(logic_function, request_data, context)
+        if etag and request.if_none_match.contains(etag):
+            # Same results as the ones cached by the client, no need to
+            # query the search backend
+            toolkit.check_access(logic_function, context, dict(request_data))
+            response = Response(status=304)
+            response.set_etag(etag)
+            return response
+
+        result = action(context, request_data)
+    except toolkit.NotAuthorized as e:
+        message = "Access denied"
+        if str(e):
+            message += ": {}".format(e)
+        return _api_error(
+            403, help_url, {"__type": "Authorization Error", "message": message}
+        )
+    except toolkit.ValidationError as e:
+        error_dict = dict(e.error_dict, __type="Validation Error")
+        return _api_error(409, help_url, error_dict)
+    except SearchQueryError as e:
+        return _api_error(
+            400,
+            help_url,
+            {
+                "__type": "Search Query Error",
+                "message": "Search Query is invalid: %r" % (e.args,),
+            },
+        )
+    except SearchError as e:
+        return _api_error(
+            409,
+            help_url,
+            {"__type": "Search Error", "message": "Search error: %r" % (e.args,)},
+        )
+
+    if not isinstance(result, RawJSON):
+        result = json.dumps(result)
+
+    response = _api_response(
+        200,
+        '{{"help": {}, "success": true, "result": {}}}'.format(
+            json.dumps(help_url), result
+        ),
+    )
+    if etag:
+        response.set_etag(etag)
+    return response
+
+
+sitesearch.add_url_rule("/api/sitesearch/<logic_function>", view_func=raw_search_view)
+
+
+def get_blueprints():
+    return [sitesearch]